@@ -9,6 +9,7 @@ from .deflectors import *
 from .lenses import *
 from .microscope import Microscope
 from .stage import *
+from .state_cache import StateCache
 from .states import *
 from instamatic import config
 from instamatic.camera import Camera
@@ -25,6 +26,23 @@ default_tem = config.microscope.name
 use_tem_server = config.settings.use_tem_server
 use_cam_server = config.settings.use_cam_server
 
+# Map the keys of `TEMController.to_dict` to the microscope getter, and the type to wrap the return value in
+header_getters = {
+    'FunctionMode': ('getFunctionMode', None),
+    'GunShift': ('getGunShift', DeflectorTuple),
+    'GunTilt': ('getGunTilt', DeflectorTuple),
+    'BeamShift': ('getBeamShift', DeflectorTuple),
+    'BeamTilt': ('getBeamTilt', DeflectorTuple),
+    'ImageShift1': ('getImageShift1', DeflectorTuple),
+    'ImageShift2': ('getImageShift2', DeflectorTuple),
+    'DiffShift': ('getDiffShift', DeflectorTuple),
+    'StagePosition': ('getStagePosition', StagePositionTuple),
+    'Magnification': ('getMagnification', None),
+    'DiffFocus': ('getDiffFocus', None),
+    'Brightness': ('getBrightness', None),
+    'SpotSize': ('getSpotSize', None),
+}
+
 
 def initialize(tem_name: str = default_tem, cam_name: str = default_cam, stream: bool = True) -> 'TEMController':
     """Initialize TEMController object giving access to the TEM and Camera
@@ -115,6 +133,7 @@ class TEMController:
         self.mode = Mode(tem)
 
         self.autoblank = False
+        self.state_cache = None
         self._saved_alignments = config.get_alignments()
 
         print()
@@ -157,6 +176,40 @@ class TEMController:
     def spotsize(self, value: int):
         self.tem.setSpotSize(value)
 
+    def enable_state_cache(self, max_age: float = 0.5, refresh_interval: float = None) -> StateCache:
+        """Keep the last known values of the microscope controls (stage,
+        deflectors, lenses, mode, beam, screen) in a `StateCache`, so that
+        reading them again within `max_age` seconds does not query the
+        microscope. The cached values are invalidated by the setters.
+
+        If `refresh_interval` is given, a background thread refreshes all
+        values every `refresh_interval` seconds, and notifies the
+        callbacks registered with `ctrl.state_cache.subscribe` of any
+        changes.
+
+        Returns the `StateCache`.
+        """
+        if self.state_cache is None:
+            self.state_cache = StateCache(self.tem, max_age=max_age)
+            for component in (self.gunshift, self.guntilt, self.beamshift, self.beamtilt,
+                              self.imageshift1, self.imageshift2, self.diffshift, self.stage,
+                              self.magnification, self.brightness, self.difffocus,
+                              self.beam, self.screen, self.mode):
+                self.state_cache.attach(component)
+        else:
+            self.state_cache.max_age = max_age
+
+        if refresh_interval:
+            self.state_cache.start(interval=refresh_interval)
+
+        return self.state_cache
+
+    def disable_state_cache(self) -> None:
+        """Stop caching the microscope state, see `enable_state_cache`."""
+        if self.state_cache is not None:
+            self.state_cache.detach()
+            self.state_cache = None
+
     def acquire_at_items(self, *args, **kwargs) -> None:
         """Class to automated acquisition at many stage locations. The
         acquisition functions must be callable (or a list of callables) that
@@ -177,7 +230,11 @@ class TEMController:
         post_acquire: callable, list of callables
             This function is run after the last acquisition item has run.
         backlash: bool
-        Move the stage with backlash correction.
+            Move the stage with backlash correction.
+        plan_path: bool
+            Visit the items in the order that minimizes the stage travel.
+        overlap: bool
+            Move to the next item while the acquisition functions after the first one run.
         """
         from instamatic.acquire_at_items import AcquireAtItems
 
@@ -466,6 +523,12 @@ class TEMController:
         if 'all' in keys or not keys:
             keys = funcs.keys()
 
+        # Collect all values in a single round trip if the tem server supports it,
+        # unless they can be taken from the state cache
+        batch = getattr(self.tem, 'batch', None)
+        if batch and self.state_cache is None:
+            return self._to_dict_batch(batch, keys)
+
         for key in keys:
             try:
                 dct[key] = funcs[key]()
@@ -475,6 +538,26 @@ class TEMController:
 
         return dct
 
+    def _to_dict_batch(self, batch, keys) -> dict:
+        """Collect the values for `self.to_dict` using a single batch call to
+        the microscope server, see `MicroscopeClient.batch`."""
+
+        keys = list(keys)
+        rets = batch([header_getters[key][0] for key in keys])
+
+        dct = {}
+
+        for key, ret in zip(keys, rets):
+            if isinstance(ret, ValueError):
+                continue
+            elif isinstance(ret, Exception):
+                raise ret
+
+            wrapper = header_getters[key][1]
+            dct[key] = wrapper(*ret) if wrapper else ret
+
+        return dct
+
     def from_dict(self, dct: dict):
         """Restore microscope parameters from dict."""
 
@@ -588,6 +671,7 @@ class TEMController:
                   plot: bool = False,
                   verbose: bool = False,
                   header_keys: Tuple[str] = 'all',
+                  header_keys_end: Tuple[str] = ('StagePosition', ),
                   ) -> Tuple[np.ndarray, dict]:
         """Retrieve image as numpy array from camera. If the exposure and
         binsize are not given, the default values are read from the config
@@ -601,6 +685,16 @@ class TEMController:
             Binning to use for the image, must be 1, 2, or 4, etc
         comment: str
             Arbitrary comment to add to the header file under 'ImageComment'
+        header_keys: str or tuple of str
+            Microscope parameters to store in the header (see `to_dict`), these
+            are read at the start of the exposure, while the camera is exposing.
+        header_keys_end: str or tuple of str
+            Parameters from `header_keys` that are read again after the
+            exposure (i.e. the stage position during a rotation). They are
+            stored as `<key>End`, and the change during the exposure as
+            `<key>Delta`. The times (`time.perf_counter`) at which the values
+            were read are stored in `ImageHeaderTimeStart`/`ImageHeaderTimeEnd`,
+            and the time between them in `ImageHeaderSkew` (s).
         out: str
             Path or filename to which the image/header is saved (defaults to tiff)
         plot: bool
@@ -624,23 +718,58 @@ class TEMController:
         if not exposure:
             exposure = self.cam.default_exposure
 
-        if not header_keys:
-            h = {}
-        else:
-            h = self.to_dict(header_keys)
+        if isinstance(header_keys, str):
+            header_keys = (header_keys, )
+        if isinstance(header_keys_end, str):
+            header_keys_end = (header_keys_end, )
 
         if self.autoblank:
             self.beam.unblank()
 
-        h['ImageGetTimeStart'] = time.perf_counter()
+        h = {}
+        t_start = time.perf_counter()
+        future = self.get_future_image(exposure=exposure, binsize=binsize)
 
-        arr = self.get_rotated_image(exposure=exposure, binsize=binsize)
+        # collect the header while the camera is exposing
+        t0 = time.perf_counter()
+        if header_keys:
+            h.update(self.to_dict(*header_keys))
+        t_header_start = (t0 + time.perf_counter()) / 2
+        mag = h['Magnification'] if 'Magnification' in h else self.magnification.value
+        mode = h['FunctionMode'] if 'FunctionMode' in h else self.mode.get()
 
-        h['ImageGetTimeEnd'] = time.perf_counter()
+        arr = future.result()
+        t_end = time.perf_counter()
 
         if self.autoblank:
             self.beam.blank()
 
+        # read the values that may have changed during the exposure again
+        keys_end = [key for key in (header_keys_end or ()) if key in h]
+        if keys_end:
+            if self.state_cache is not None:
+                for key in keys_end:
+                    self.state_cache.invalidate(header_getters[key][0])
+            t0 = time.perf_counter()
+            h_end = self.to_dict(*keys_end)
+            t_header_end = (t0 + time.perf_counter()) / 2
+
+            for key, value in h_end.items():
+                h[f'{key}End'] = value
+                if isinstance(value, tuple):
+                    h[f'{key}Delta'] = type(value)(*(end - start for start, end in zip(h[key], value)))
+                elif isinstance(value, (int, float)):
+                    h[f'{key}Delta'] = value - h[key]
+
+            h['ImageHeaderTimeStart'] = t_header_start
+            h['ImageHeaderTimeEnd'] = t_header_end
+            h['ImageHeaderSkew'] = t_header_end - t_header_start
+
+        arr = rotate_image(arr, mode=mode, mag=mag)
+
+        h['ImageGetTimeStart'] = t_start
+        h['ImageGetTimeEnd'] = t_end
+
         h['ImageGetTime'] = time.time()
         h['ImageExposureTime'] = exposure
         h['ImageBinsize'] = binsize
@@ -701,6 +830,7 @@ class TEMController:
         print(f"Microscope alignment restored from '{name}'")
 
     def close(self):
+        self.disable_state_cache()
         try:
             self.cam.close()
         except AttributeError:
@@ -395,6 +395,10 @@ class FEIMicroscope:
         else:
             return True
 
+    def waitForStage(self, delay: float = 0.1):
+        while self.isStageMoving():
+            time.sleep(delay)
+
     def stopStage(self):
         # self.stage.Status = self.goniostopped
         raise NotImplementedError
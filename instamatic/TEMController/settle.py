@@ -0,0 +1,185 @@
+import logging
+import time
+from collections import defaultdict
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+AXES = 'xyzab'
+
+# Largest change between two readouts for the stage to be considered
+# settled, nm for x/y/z and degrees for a/b
+DEFAULT_THRESHOLD = {'x': 5.0, 'y': 5.0, 'z': 5.0, 'a': 0.01, 'b': 0.01}
+
+
+class SettleDetector:
+    """Wait for the stage to settle after a movement by polling the stage
+    position, instead of sleeping for a fixed time. `getter` must return
+    the stage position as (x, y, z, a, b), i.e. `tem.getStagePosition`.
+
+    The stage is settled when the change in position between consecutive
+    readouts is below `threshold` for `n_stable` readouts in a row for
+    every axis. Optionally, `image_func` is called to collect fast (i.e.
+    short exposure, binned) images until the shift between consecutive
+    images, measured by cross correlation, is below `image_threshold`
+    pixels.
+
+    The time it takes each axis to settle is recorded. Once enough
+    movements have been seen, the detector first sleeps for most of the
+    shortest typical settle time before it starts polling, which saves
+    round trips to the microscope. Use `.stats()` to get the statistics.
+
+    Usage:
+        detector = ctrl.stage.enable_settle_detection(threshold={'x': 10, 'y': 10})
+        ctrl.stage.set_xy_with_backlash_correction(x=0, y=0)
+        print(detector.stats())
+    """
+
+    def __init__(self,
+                 getter,
+                 threshold: dict = None,
+                 interval: float = 0.02,
+                 n_stable: int = 2,
+                 timeout: float = 2.0,
+                 image_func=None,
+                 image_threshold: float = 0.5,
+                 history: int = 100,
+                 min_samples: int = 5):
+        super().__init__()
+        self._getter = getter
+
+        self.threshold = dict(DEFAULT_THRESHOLD)
+        if threshold:
+            self.threshold.update(threshold)
+
+        self.interval = interval
+        self.n_stable = n_stable
+        self.timeout = timeout
+        self.image_func = image_func
+        self.image_threshold = image_threshold
+        self.min_samples = min_samples
+
+        self._history = defaultdict(lambda: deque(maxlen=history))
+        self.timeouts = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(interval={self.interval}, n_stable={self.n_stable}, timeout={self.timeout})'
+
+    def _position(self) -> tuple:
+        position = self._getter()
+        return time.perf_counter(), dict(zip(AXES, position))
+
+    def expected_settle_time(self, axes: str = AXES) -> float:
+        """Return the time (s) that the slowest of `axes` needs at least to
+        settle, based on the previous movements. Returns 0 until each axis
+        has been seen `min_samples` times."""
+        times = []
+        for axis in axes:
+            history = self._history[axis]
+            if len(history) < self.min_samples:
+                return 0.0
+            times.append(np.percentile(history, 10))
+        # stay below the shortest settle times, so that they can still
+        # decrease if the stage settles faster
+        return 0.75 * max(times)
+
+    def wait(self, axes: str = AXES) -> float:
+        """Block until `axes` (i.e. 'xy') have settled. Returns the time
+        (s) it took."""
+        t0 = time.perf_counter()
+
+        delay = self.expected_settle_time(axes)
+        if delay:
+            time.sleep(delay)
+
+        settled = self._wait_position(axes, t0)
+
+        if self.image_func:
+            settled['image'] = self._wait_image(t0)
+
+        for axis, t in settled.items():
+            if t is None:
+                self.timeouts += 1
+            else:
+                self._history[axis].append(t)
+
+        return time.perf_counter() - t0
+
+    def _wait_position(self, axes: str, t0: float) -> dict:
+        """Poll the stage position. Returns the settle time of each axis,
+        or None if it did not settle in time."""
+        t_prev, previous = self._position()
+        stable_since = {axis: None for axis in axes}
+        n_stable = {axis: 0 for axis in axes}
+        settled = {}
+
+        while len(settled) < len(axes):
+            if t_prev - t0 > self.timeout:
+                logger.warning('Stage did not settle within %.1f s (axes: %s)', self.timeout, ''.join(sorted(set(axes) - set(settled))))
+                settled.update({axis: None for axis in axes if axis not in settled})
+                break
+
+            time.sleep(self.interval)
+            t, current = self._position()
+
+            for axis in axes:
+                if axis in settled:
+                    continue
+                if abs(current[axis] - previous[axis]) <= self.threshold[axis]:
+                    if n_stable[axis] == 0:
+                        stable_since[axis] = t_prev - t0
+                    n_stable[axis] += 1
+                    if n_stable[axis] >= self.n_stable:
+                        settled[axis] = stable_since[axis]
+                else:
+                    n_stable[axis] = 0
+
+            t_prev, previous = t, current
+
+        return settled
+
+    def _wait_image(self, t0: float) -> float:
+        """Collect images until the shift between consecutive images is
+        below `image_threshold`. Returns the settle time, or None if the
+        image did not settle in time."""
+        from skimage.registration import phase_cross_correlation
+
+        previous = self.image_func()
+        t_prev = time.perf_counter()
+
+        while t_prev - t0 <= self.timeout:
+            img = self.image_func()
+            t = time.perf_counter()
+
+            shift, error, phasediff = phase_cross_correlation(previous, img, upsample_factor=10)
+            if np.linalg.norm(shift) <= self.image_threshold:
+                return t_prev - t0
+
+            t_prev, previous = t, img
+
+        logger.warning('Image did not settle within %.1f s', self.timeout)
+        return None
+
+    def stats(self) -> dict:
+        """Return the statistics of the settle times (s) per axis (and
+        'image'), and the number of timeouts."""
+        stats = {}
+        for axis, history in self._history.items():
+            if not history:
+                continue
+            stats[axis] = {
+                'n': len(history),
+                'mean': np.mean(history),
+                'median': np.median(history),
+                'p90': np.percentile(history, 90),
+                'max': np.max(history),
+            }
+        stats['timeouts'] = self.timeouts
+        return stats
+
+    def reset(self) -> None:
+        """Forget the recorded settle times."""
+        self._history.clear()
+        self.timeouts = 0
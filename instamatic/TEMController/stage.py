@@ -5,6 +5,7 @@ from typing import Tuple
 
 import numpy as np
 
+from .settle import SettleDetector
 
 # namedtuples to store results from .get()
 StagePositionTuple = namedtuple('StagePositionTuple', ['x', 'y', 'z', 'a', 'b'])
@@ -19,6 +20,7 @@ class Stage:
         self._setter = self._tem.setStagePosition
         self._getter = self._tem.getStagePosition
         self._wait = True  # properties only
+        self.settle_detector = None
 
     def __repr__(self):
         x, y, z, a, b = self.get()
@@ -191,6 +193,29 @@ class Stage:
         yield
         self._wait = True
 
+    def enable_settle_detection(self, **kwargs) -> SettleDetector:
+        """Wait for the stage to settle by monitoring the stage position
+        instead of sleeping for `settle_delay`. The keyword arguments are
+        passed to `SettleDetector`. Returns the detector, which keeps the
+        statistics of the settle times."""
+        self.settle_detector = SettleDetector(self._tem.getStagePosition, **kwargs)
+        return self.settle_detector
+
+    def disable_settle_detection(self) -> None:
+        """Sleep for `settle_delay` to let the stage settle."""
+        self.settle_detector = None
+
+    def settle(self, delay: float = 0.200, axes: str = 'xyzab') -> None:
+        """Wait for the stage to settle after a movement. Sleeps for
+        `delay` seconds, or waits until `axes` have settled if settle
+        detection is enabled. Does nothing if `delay` is 0."""
+        if not delay:
+            return
+        if self.settle_detector:
+            self.settle_detector.wait(axes)
+        else:
+            time.sleep(delay)
+
     def stop(self) -> None:
         """This will halt the stage preemptively if `wait=False` is passed to
         Stage.set."""
@@ -238,12 +263,10 @@ class Stage:
         """
         wait = True
         self.set(x=x - step, y=y - step)
-        if settle_delay:
-            time.sleep(settle_delay)
+        self.settle(settle_delay, axes='xy')
 
         self.set(x=x, y=y, wait=wait)
-        if settle_delay:
-            time.sleep(settle_delay)
+        self.settle(settle_delay, axes='xy')
 
     def move_xy_with_backlash_correction(self, shift_x: int = None, shift_y: int = None, step: float = 5000, settle_delay: float = 0.200, wait=True) -> None:
         """Move xy by given shifts in stage coordinates with backlash
@@ -286,12 +309,10 @@ class Stage:
             target_y = None
 
         self.set(x=pre_x, y=pre_y)
-        if settle_delay:
-            time.sleep(settle_delay)
+        self.settle(settle_delay, axes='xy')
 
         self.set(x=target_x, y=target_y, wait=wait)
-        if settle_delay:
-            time.sleep(settle_delay)
+        self.settle(settle_delay, axes='xy')
 
     def eliminate_backlash_xy(self, step: float = 10000, settle_delay: float = 0.200) -> None:
         """Eliminate backlash by in XY by moving the stage away from the
@@ -334,4 +355,4 @@ class Stage:
 
         for i in reversed(range(n_steps)):
             self.a = current - s * i * step
-            time.sleep(settle_delay)
+            self.settle(settle_delay, axes='a')
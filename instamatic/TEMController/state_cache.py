@@ -0,0 +1,244 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Setting any of these may change the other values on the microscope
+INVALIDATE_ALL = ('setFunctionMode', 'setMagnification', 'setMagnificationIndex')
+
+CachedValue = namedtuple('CachedValue', ['value', 'timestamp'])
+
+
+class StateCache:
+    """Mirror of the microscope state, which keeps the last known value of
+    the microscope getters (i.e. `getBeamShift`) together with the time it
+    was read.
+
+    A value is read from the microscope only if it is older than
+    `max_age` seconds, so that polling the same value repeatedly does not
+    cost a round trip every time. Every setter invalidates the value it
+    sets (setting the function mode or magnification invalidates all
+    values). Note that values changed outside of instamatic (i.e. using
+    the microscope knobs) may be up to `max_age` seconds old. After a
+    non-blocking stage movement (`wait=False`), the stage position is
+    not cached until the stage has stopped moving.
+
+    A background thread can be started with `.start()` to refresh all
+    values periodically. Callbacks registered with `.subscribe()` are
+    called with `(name, value)` whenever a value is found to change.
+    Callbacks are called from the thread that read the value, GUI code
+    must pass the value to its main loop.
+
+    Usage:
+        cache = ctrl.enable_state_cache(max_age=0.5)
+        cache.subscribe(lambda name, value: print(name, value))
+        cache.start(interval=0.5)
+    """
+
+    def __init__(self, tem, max_age: float = 0.5):
+        super().__init__()
+        self._tem = tem
+        self.max_age = max_age
+
+        self._getters = {}
+        self._values = {}
+        self._published = {}
+        self._lock = threading.RLock()
+        self._generation = 0  # incremented on every invalidation
+        self._moving = {}  # getter name -> function that returns True while the value changes
+
+        self._callbacks = []
+        self._attached = []
+
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(max_age={self.max_age}, values={len(self._values)}, running={self.is_running})'
+
+    def getter(self, func):
+        """Return a cached version of the microscope getter `func`."""
+        name = func.__name__
+        self._getters[name] = func
+
+        def cached_getter():
+            return self.get(name)
+
+        cached_getter.__name__ = name
+        return cached_getter
+
+    def setter(self, func, name: str = None, is_moving=None):
+        """Return a version of the microscope setter `func` that invalidates
+        the cached value of getter `name` (all values if None).
+
+        If `is_moving` is given, the value of `name` is not cached after
+        the setter is called with `wait=False`, until `is_moving()`
+        returns False."""
+        if func.__name__ in INVALIDATE_ALL:
+            name = None
+
+        def invalidating_setter(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if is_moving is not None and name is not None and kwargs.get('wait', True) is False:
+                    with self._lock:
+                        self._moving[name] = is_moving
+                self.invalidate(name)
+
+        invalidating_setter.__name__ = func.__name__
+        return invalidating_setter
+
+    def attach(self, component) -> None:
+        """Replace the getter/setter of the microscope control `component`
+        (i.e. `ctrl.beamshift`) by the cached versions."""
+        original = {attr: getattr(component, attr) for attr in ('_getter', '_setter', '_indexgetter', '_indexsetter')
+                    if getattr(component, attr, None) is not None}
+
+        for attr, func in original.items():
+            if attr.endswith('getter'):
+                setattr(component, attr, self.getter(func))
+            elif attr == '_setter' and '_getter' in original:
+                is_moving = getattr(component, 'is_moving', None)
+                setattr(component, attr, self.setter(func, original['_getter'].__name__, is_moving=is_moving))
+            else:
+                setattr(component, attr, self.setter(func))
+
+        self._attached.append((component, original))
+
+    def detach(self) -> None:
+        """Restore the original getters/setters of all attached controls."""
+        self.stop()
+        for component, original in self._attached:
+            for attr, func in original.items():
+                setattr(component, attr, func)
+        self._attached = []
+
+    def get(self, name: str, max_age: float = None):
+        """Return the value of getter `name`, read from the microscope if
+        the cached value is older than `max_age` (default: `self.max_age`)
+        seconds."""
+        if max_age is None:
+            max_age = self.max_age
+
+        with self._lock:
+            is_moving = self._moving.get(name)
+
+        if is_moving is not None:
+            if is_moving():
+                return self._getters[name]()
+            with self._lock:
+                self._moving.pop(name, None)
+            return self.refresh(name)
+
+        with self._lock:
+            cached = self._values.get(name)
+
+        if cached is not None and time.perf_counter() - cached.timestamp <= max_age:
+            return cached.value
+
+        return self.refresh(name)
+
+    def refresh(self, name: str):
+        """Read the value of getter `name` from the microscope."""
+        generation = self._generation
+        value = self._getters[name]()
+        self._update(name, value, generation)
+        return value
+
+    def refresh_all(self) -> None:
+        """Read all values from the microscope, in a single round trip if
+        the microscope server supports it. Getters that raise an error
+        (i.e. `getDiffFocus` in imaging mode) are skipped."""
+        names = list(self._getters)
+        generation = self._generation
+
+        batch = getattr(self._tem, 'batch', None)
+        if batch:
+            rets = batch(names)
+        else:
+            rets = []
+            for name in names:
+                try:
+                    rets.append(self._getters[name]())
+                except Exception as e:
+                    rets.append(e)
+
+        for name, ret in zip(names, rets):
+            if name in self._moving:
+                continue
+            elif isinstance(ret, Exception):
+                logger.debug('Cannot refresh %s: %s', name, ret)
+            else:
+                self._update(name, ret, generation)
+
+    def _update(self, name: str, value, generation: int) -> None:
+        with self._lock:
+            # do not store values that may have been read before a setter was called
+            if generation != self._generation:
+                return
+            self._values[name] = CachedValue(value, time.perf_counter())
+            changed = name not in self._published or self._published[name] != value
+            if changed:
+                self._published[name] = value
+
+        if changed:
+            for callback in list(self._callbacks):
+                try:
+                    callback(name, value)
+                except Exception:
+                    logger.exception('Error in state change callback %s', callback)
+
+    def invalidate(self, name: str = None) -> None:
+        """Discard the cached value of getter `name`, or all values if
+        `name` is None."""
+        with self._lock:
+            self._generation += 1
+            if name is None:
+                self._values.clear()
+            else:
+                self._values.pop(name, None)
+
+    def snapshot(self) -> dict:
+        """Return the cached values as a dict `{name: (value, timestamp)}`
+        without reading from the microscope."""
+        with self._lock:
+            return dict(self._values)
+
+    def subscribe(self, callback) -> None:
+        """Call `callback(name, value)` whenever a value changes."""
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback) -> None:
+        self._callbacks.remove(callback)
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.5) -> None:
+        """Refresh all values every `interval` seconds in a background
+        thread."""
+        if self.is_running:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name='StateCache', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the background thread."""
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval: float) -> None:
+        while not self._stop_event.is_set():
+            try:
+                self.refresh_all()
+            except Exception:
+                logger.exception('Error refreshing the microscope state')
+            self._stop_event.wait(interval)
@@ -1,8 +1,12 @@
+import time
 from collections import defaultdict
 
 import numpy as np
 from tqdm.auto import tqdm
 
+from instamatic.stage_path import get_moves
+from instamatic.stage_path import plan_stage_path
+
 
 class AcquireAtItems:
     """Class to automated acquisition at many stage locations. The acquisition
@@ -29,7 +33,24 @@ class AcquireAtItems:
         e.g. every_n={2: every_2nd, 3: every_3rd}. These will be called in
         sequence _after_ the main acquisition function.
     backlash: bool
-        Move the stage with backlash correction.
+        Move the stage with backlash correction. Positions are always
+        approached from the same direction, the extra backlash move is
+        skipped if the stage already moves in that direction.
+    plan_path: bool
+        Visit the items in the order that minimizes the stage travel (see
+        `instamatic.stage_path.plan_stage_path`) instead of the given
+        order. `ctrl.current_i` always refers to the index of the item in
+        `nav_items`.
+    overlap: bool
+        Start moving the stage to the next item as soon as the first
+        `acquire` function returns, and run the other functions (including
+        those in `every_n`) while the stage is moving. The first function
+        must capture all data that need the stage at the current item.
+    step: float
+        Step size (nm) for the backlash correction.
+    settle_delay: float
+        Delay (s) after each stage movement to allow the stage to settle
+        (only with backlash correction), see `Stage.settle`.
 
     Returns
     -------
@@ -43,7 +64,11 @@ class AcquireAtItems:
                  pre_acquire=None,
                  post_acquire=None,
                  every_n: dict = {},
-                 backlash: bool = True):
+                 backlash: bool = True,
+                 plan_path: bool = False,
+                 overlap: bool = False,
+                 step: float = 10000,
+                 settle_delay: float = 0.200):
         super().__init__()
 
         self.nav_items = nav_items
@@ -69,6 +94,14 @@ class AcquireAtItems:
             print(f'Post-acquire:', ', '.join([func.__name__ for func in self._post_acquire]))
 
         self.backlash = backlash
+        self.plan_path = plan_path
+        self.overlap = overlap
+        self.step = step if backlash else 0
+        self.settle_delay = settle_delay if backlash else 0
+
+        self._moves = []
+        self._moving = False
+        self._last_target = None
 
     # blank placeholders
     _acquire = ()
@@ -95,9 +128,13 @@ class AcquireAtItems:
         for func in self._post_acquire:
             func(ctrl)
 
-    def acquire(self, ctrl, i: int = 1):
+    def acquire(self, ctrl, i: int = 1, next_item=None):
         """Handler to call functions at each stage position/NavItem (or at
-        specific intervals)."""
+        specific intervals).
+
+        If `next_item` is given, the stage starts moving to it after
+        the first function has been called.
+        """
         r = self._acquire_intervals
         tasks = r[(i + 1) % r == 0]
         for interval in tasks:
@@ -105,9 +142,16 @@ class AcquireAtItems:
             for func in funcs:
                 # print(f" >> {interval}: {func.__name__}")
                 func(ctrl)
+                if next_item is not None:
+                    self.start_move(next_item)
+                    next_item = None
 
-    def move_to_item(self, item):
-        """Move the stage to the stage coordinates given by the NavItem."""
+        if next_item is not None:
+            self.start_move(next_item)
+
+    def get_coords(self, item) -> tuple:
+        """Return the stage coordinates (x, y, z) in nm given by the NavItem
+        or coordinate. `z` is None if it is not defined."""
         try:
             x = item.stage_x * 1000  # um -> nm
             y = item.stage_y * 1000  # um -> nm
@@ -121,15 +165,58 @@ class AcquireAtItems:
             else:
                 raise IndexError(f'Coordinate must have 2 (x, y) or 3 (x, y, z) elements: {item}')
 
+        return x, y, z
+
+    def get_order(self, nav_items: list) -> 'np.array':
+        """Return the order in which to visit the `nav_items`."""
+        if not self.plan_path:
+            return np.arange(len(nav_items))
+
+        coords = [self.get_coords(item)[0:2] for item in nav_items]
+        x, y, z, a, b = self.ctrl.stage.get()
+        return plan_stage_path(coords, start=(x, y), step=self.step)
+
+    def _start_position(self):
+        """Return the position the stage moves from, or None if the stage
+        has not moved to the last target (i.e. it was moved by one of the
+        acquisition functions) and the backlash state is unknown."""
+        if self._last_target is None:
+            return None
+
+        x, y, z, a, b = self.ctrl.stage.get()
+        if max(abs(x - self._last_target[0]), abs(y - self._last_target[1])) > self.step / 10:
+            return None
+        return self._last_target
+
+    def start_move(self, item):
+        """Start moving the stage to the stage coordinates given by the
+        NavItem without waiting for the movement to finish. Call
+        `.finish_move()` to complete the movement."""
+        x, y, z = self.get_coords(item)
+
         if z is not None:
             self.ctrl.stage.set(z=z)
 
-        if self.backlash:
-            set_xy = self.ctrl.stage.set_xy_with_backlash_correction
-        else:
-            set_xy = self.ctrl.stage.set
+        self._moves = get_moves(self._start_position(), (x, y), step=self.step)
+        self._last_target = (x, y)
+        self.ctrl.stage.set(*self._moves.pop(0), wait=False)
+        self._moving = True
+
+    def finish_move(self):
+        """Wait for the stage movement started by `.start_move()` to
+        complete."""
+        self.ctrl.stage.wait()
+        self._moving = False
+        self.ctrl.stage.settle(self.settle_delay, axes='xy')
 
-        set_xy(x=x, y=y)
+        while self._moves:
+            self.ctrl.stage.set(*self._moves.pop(0))
+            self.ctrl.stage.settle(self.settle_delay, axes='xy')
+
+    def move_to_item(self, item):
+        """Move the stage to the stage coordinates given by the NavItem."""
+        self.start_move(item)
+        self.finish_move()
 
     def start(self, start_index: int = 0):
         """Start serial acquisition protocol.
@@ -139,32 +226,43 @@ class AcquireAtItems:
         start_index : int
             Start acquisition from this item.
         """
-        import time
-        import msvcrt
-
         ctrl = self.ctrl
         nav_items = self.nav_items[start_index:]
 
         ntot = len(nav_items)
 
+        order = self.get_order(nav_items)
+        self.order = order + start_index
+
         print(f'\nAcquiring on {ntot} items.')
         print('Press <Ctrl-C> or ⬛ to interrupt.\n')
 
-        self.move_to_item(nav_items[0])  # pre-move
+        self._last_target = None
+        self.move_to_item(nav_items[order[0]])  # pre-move
         self.pre_acquire(ctrl)
 
         t0 = time.perf_counter()
 
-        for i, item in enumerate(tqdm(nav_items)):
+        for n, j in enumerate(tqdm(order)):
             # Run script in try/except block so that Keyboard interrupt
             # will safely break out of the loop
+            item = nav_items[j]
             try:
-                i += start_index
+                i = n + start_index
                 ctrl.current_item = item
-                ctrl.current_i = i
+                ctrl.current_i = j + start_index
+
+                if n == 0 or not self.overlap:
+                    self.move_to_item(item)
+                else:
+                    self.finish_move()
 
-                self.move_to_item(item)
-                self.acquire(ctrl, i=i)
+                if self.overlap and n + 1 < ntot:
+                    next_item = nav_items[order[n + 1]]
+                else:
+                    next_item = None
+
+                self.acquire(ctrl, i=i, next_item=next_item)
 
             except (Exception, KeyboardInterrupt) as e:
                 print(repr(e.with_traceback(None)))
@@ -173,9 +271,12 @@ class AcquireAtItems:
 
         t1 = time.perf_counter()
 
+        if self._moving:
+            self.finish_move()
+
         self.post_acquire(ctrl)
 
         dt = t1 - t0
-        n_items = i + 1
+        n_items = n + 1
         print(f'Total time taken: {dt:.0f} s for {n_items} items ({dt/n_items:.2f} s/item)')
         print('\nAll done!')
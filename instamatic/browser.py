@@ -2,11 +2,11 @@ import os
 import time
 
 import matplotlib.pyplot as plt
-import mrcfile
 import numpy as np
 from pyserialem import read_nav_file
 
 from instamatic.formats import read_tiff
+from instamatic.formats.mrc import MRCStack
 
 
 class Browser:
@@ -25,7 +25,7 @@ class Browser:
 
         Must be mrc format and contain multiple pages.
         """
-        self.mmap = mrcfile.mmap(mmm)
+        self.mmap = MRCStack.open(mmm)
 
     def set_nav_file(self, nav: str = 'output.nav'):
         """Set the `.nav` file to load the stage/image coordinates from."""
@@ -5,10 +5,10 @@ import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .filenames import *
 from .fit import fit_affine_transformation
+from .registration import ImageRegistration
 from instamatic import config
 from instamatic.image_utils import autoscale
 from instamatic.image_utils import imgscale
@@ -114,7 +114,7 @@ class CalibBeamShift:
             return beamshift
 
 
-def calibrate_beamshift_live(ctrl, gridsize=None, stepsize=None, save_images=False, outdir='.', **kwargs):
+def calibrate_beamshift_live(ctrl, gridsize=None, stepsize=None, save_images=False, outdir='.', workers=None, **kwargs):
     """Calibrate pixel->beamshift coordinates live on the microscope.
 
     ctrl: instance of `TEMController`
@@ -127,6 +127,9 @@ def calibrate_beamshift_live(ctrl, gridsize=None, stepsize=None, save_images=Fal
     exposure: `float` or None
         exposure time
     binsize: `int` or None
+    workers: `int` or None
+        Number of threads to cross correlate the images in the background
+        while the beam is moved to the next position
 
     In case paramers are not defined, camera specific default parameters are retrieved
 
@@ -166,25 +169,25 @@ def calibrate_beamshift_live(ctrl, gridsize=None, stepsize=None, save_images=Fal
     x_grid, y_grid = np.meshgrid(np.arange(-n, n + 1) * stepsize, np.arange(-n, n + 1) * stepsize)
     tot = gridsize * gridsize
 
-    i = 0
-    for dx, dy in np.stack([x_grid, y_grid]).reshape(2, -1).T:
-        ctrl.beamshift.set(x=x_cent + dx, y=y_cent + dy)
+    with ImageRegistration(workers=workers) as registration:
+        i = 0
+        for dx, dy in np.stack([x_grid, y_grid]).reshape(2, -1).T:
+            ctrl.beamshift.set(x=x_cent + dx, y=y_cent + dy)
 
-        printer('Position: {}/{}: {}'.format(i + 1, tot, ctrl.beamshift))
+            printer('Position: {}/{}: {}'.format(i + 1, tot, ctrl.beamshift))
 
-        outfile = os.path.join(outdir, 'calib_beamshift_{i:04d}') if save_images else None
+            outfile = os.path.join(outdir, 'calib_beamshift_{i:04d}') if save_images else None
 
-        comment = f'Calib image {i}: dx={dx} - dy={dy}'
-        img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=comment, header_keys='BeamShift')
-        img = imgscale(img, scale)
+            comment = f'Calib image {i}: dx={dx} - dy={dy}'
+            img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=comment, header_keys='BeamShift')
 
-        shift, error, phasediff = phase_cross_correlation(img_cent, img, upsample_factor=10)
+            beamshift = np.array(h['BeamShift'])
+            beampos.append(beamshift)
+            shifts.append(registration.submit(img_cent, img, scale=scale))
 
-        beamshift = np.array(h['BeamShift'])
-        beampos.append(beamshift)
-        shifts.append(shift)
+            i += 1
 
-        i += 1
+        shifts = [future.result()[0] for future in shifts]
 
     print('')
     # print "\nReset to center"
@@ -233,6 +236,7 @@ def calibrate_beamshift_from_image_fn(center_fn, other_fn):
 
     shifts = []
     beampos = []
+    registration = ImageRegistration()
 
     for fn in other_fn:
         img, h = load_img(fn)
@@ -243,7 +247,7 @@ def calibrate_beamshift_from_image_fn(center_fn, other_fn):
         print('Image:', fn)
         print('Beamshift: x={} | y={}'.format(*beamshift))
 
-        shift, error, phasediff = phase_cross_correlation(img_cent, img, upsample_factor=10)
+        shift, error, phasediff = registration.register(img_cent, img)
 
         beampos.append(beamshift)
         shifts.append(shift)
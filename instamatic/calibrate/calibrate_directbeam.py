@@ -5,10 +5,10 @@ import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
-from skimage.registration import phase_cross_correlation
 
 from .filenames import *
 from .fit import fit_affine_transformation
+from .registration import ImageRegistration
 from instamatic import config
 from instamatic.image_utils import autoscale
 from instamatic.image_utils import imgscale
@@ -175,7 +175,7 @@ class CalibDirectBeam:
             plt.show()
 
 
-def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=None, save_images=False, outdir='.', **kwargs):
+def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=None, save_images=False, outdir='.', workers=None, **kwargs):
     """Calibrate pixel->beamshift coordinates live on the microscope.
 
     ctrl: instance of `TEMController`
@@ -189,6 +189,9 @@ def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=Non
     exposure: `float` or None
         exposure time
     binsize: `int` or None
+    workers: `int` or None
+        Number of threads to cross correlate the images in the background
+        while the beam is moved to the next position
 
     In case paramers are not defined, camera specific default parameters are
 
@@ -225,24 +228,24 @@ def calibrate_directbeam_live(ctrl, key='DiffShift', gridsize=None, stepsize=Non
     x_grid, y_grid = np.meshgrid(np.arange(-n, n + 1) * stepsize, np.arange(-n, n + 1) * stepsize)
     tot = gridsize * gridsize
 
-    for i, (dx, dy) in enumerate(np.stack([x_grid, y_grid]).reshape(2, -1).T):
-        i += 1
+    with ImageRegistration(workers=workers) as registration:
+        for i, (dx, dy) in enumerate(np.stack([x_grid, y_grid]).reshape(2, -1).T):
+            i += 1
 
-        attr.set(x=x_cent + dx, y=y_cent + dy)
+            attr.set(x=x_cent + dx, y=y_cent + dy)
 
-        printer(f'Position: {i}/{tot}: {attr}')
+            printer(f'Position: {i}/{tot}: {attr}')
 
-        outfile = os.path.join(outdir, f'calib_db_{key}_{i:04d}') if save_images else None
+            outfile = os.path.join(outdir, f'calib_db_{key}_{i:04d}') if save_images else None
 
-        comment = f'Calib image {i}: dx={dx} - dy={dy}'
-        img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=comment, header_keys=key)
-        img = imgscale(img, scale)
+            comment = f'Calib image {i}: dx={dx} - dy={dy}'
+            img, h = ctrl.get_image(exposure=exposure, binsize=binsize, out=outfile, comment=comment, header_keys=key)
 
-        shift, error, phasediff = phase_cross_correlation(img_cent, img, upsample_factor=10)
+            readout = np.array(h[key])
+            readouts.append(readout)
+            shifts.append(registration.submit(img_cent, img, scale=scale))
 
-        readout = np.array(h[key])
-        readouts.append(readout)
-        shifts.append(shift)
+        shifts = [future.result()[0] for future in shifts]
 
     print('')
     # print "\nReset to center"
@@ -276,6 +279,7 @@ def calibrate_directbeam_from_file(center_fn, other_fn, key='DiffShift'):
 
     shifts = []
     readouts = []
+    registration = ImageRegistration()
 
     for i, fn in enumerate(other_fn):
         print(fn)
@@ -287,7 +291,7 @@ def calibrate_directbeam_from_file(center_fn, other_fn, key='DiffShift'):
         print('Image:', fn)
         print('{}: dx={} | dy={}'.format(key, *readout))
 
-        shift, error, phasediff = phase_cross_correlation(img_cent, img, upsample_factor=10)
+        shift, error, phasediff = registration.register(img_cent, img)
 
         readouts.append(readout)
         shifts.append(shift)
@@ -4,10 +4,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import yaml
 from scipy import stats
-from skimage.registration import phase_cross_correlation
 
 from instamatic import config
 from instamatic.calibrate.fit import fit_affine_transformation
+from instamatic.calibrate.registration import ImageRegistration
 from instamatic.formats import read_tiff
 from instamatic.formats import write_tiff
 from instamatic.image_utils import rotate_image
@@ -38,17 +38,28 @@ def get_outlier_filter(data, threshold: float = 2.0) -> list:
     return sel
 
 
-def cross_correlate_image_pairs(pairs: tuple) -> list:
-    """Cross correlate image pairs."""
+def cross_correlate_image_pairs(pairs: tuple, coarse_binsize: int = None, workers: int = None) -> list:
+    """Cross correlate image pairs, see `ImageRegistration` for the
+    parameters."""
+    with ImageRegistration(coarse_binsize=coarse_binsize, workers=workers) as registration:
+        results = list(registration.map(pairs))
+    return collect_translations(results)
+
+
+def collect_translations(results) -> list:
+    """Return the translations from the results of the cross correlation
+    (`(translation, error, phasediff)`), which may also be futures."""
     translations = []
-    for img0, img1 in pairs:
-        translation, error, phasediff = phase_cross_correlation(img0, img1, upsample_factor=10)
+    for result in results:
+        if hasattr(result, 'result'):
+            result = result.result()
+        translation, error, phasediff = result
         print(f'shift {translation} error {error:.4f} phasediff {phasediff:.4f}')
         translations.append(translation)
     return translations
 
 
-def calibrate_stage_from_file(drc: str, plot: bool = False):
+def calibrate_stage_from_file(drc: str, plot: bool = False, coarse_binsize: int = None):
     """Calibrate the stage from the saved log/tiff files. This is essentially
     the same function as below, with the exception that it reads the `log.yaml`
     to recalculate the stage matrix.
@@ -59,6 +70,8 @@ def calibrate_stage_from_file(drc: str, plot: bool = False):
         Directory containing the `log.yaml` and tiff files.
     plot : bool
         Plot the results of the fitting.
+    coarse_binsize : int
+        Register the images coarse-to-fine, starting with this binning.
 
     Returns
     -------
@@ -89,7 +102,7 @@ def calibrate_stage_from_file(drc: str, plot: bool = False):
 
             last_img = img
 
-    translations = cross_correlate_image_pairs(pairs)
+    translations = cross_correlate_image_pairs(pairs, coarse_binsize=coarse_binsize)
 
     # Filter outliers
     sel = get_outlier_filter(translations)
@@ -119,6 +132,8 @@ def calibrate_stage_from_stageshifts(ctrl,
                                      *args,
                                      plot: bool = False,
                                      drc=None,
+                                     registration: ImageRegistration = None,
+                                     wait: bool = True,
                                      ) -> np.array:
     """Run the calibration algorithm on the given X/Y ranges. An image will be
     taken at each position for cross correlation with the previous. An affine
@@ -137,6 +152,13 @@ def calibrate_stage_from_stageshifts(ctrl,
         specified to be run in sequence.
     plot: bool
         Plot the fitting result.
+    registration: `ImageRegistration`
+        Used to cross correlate the images in the background while the
+        stage moves to the next position.
+    wait: bool
+        If False, return a function that returns the stagematrix once all
+        images have been registered, so that the next calibration can
+        be started in the meantime.
 
     Returns
     -------
@@ -153,6 +175,10 @@ def calibrate_stage_from_stageshifts(ctrl,
     if drc:
         drc = Path(drc)
 
+    own_registration = registration is None
+    if own_registration:
+        registration = ImageRegistration(workers=1)
+
     stage_x, stage_y = ctrl.stage.xy
 
     stage_shifts = []  # um
@@ -161,7 +187,7 @@ def calibrate_stage_from_stageshifts(ctrl,
     mode = ctrl.mode.get()
     binning = ctrl.cam.getBinning()
 
-    pairs = []
+    results = []
 
     for i, (n_steps, step) in enumerate(args):
         j = 0
@@ -184,7 +210,7 @@ def calibrate_stage_from_stageshifts(ctrl,
             if drc:
                 write_tiff(drc / f'{i}_{j}.tiff', img)
 
-            pairs.append((last_img, img))
+            results.append(registration.submit(last_img, img))
             stage_shifts.append((dx, dy))
 
             current_stage_pos = ctrl.stage
@@ -196,7 +222,35 @@ def calibrate_stage_from_stageshifts(ctrl,
         # return to original position
         ctrl.stage.xy = (stage_x, stage_y)
 
-    translations = cross_correlate_image_pairs(pairs)
+    log = {
+        'n_ranges': len(args),
+        'stage_x': stage_x,
+        'stage_y': stage_y,
+        'mode': mode,
+        'magnification': mag,
+        'args': args,
+        'binning': binning,
+    }
+
+    def fit():
+        try:
+            return fit_stagematrix(results, stage_shifts, log, plot=plot, drc=drc)
+        finally:
+            if own_registration:
+                registration.close()
+
+    if wait:
+        return fit()
+    else:
+        return fit
+
+
+def fit_stagematrix(results, stage_shifts, log: dict, plot: bool = False, drc=None) -> np.array:
+    """Fit the stagematrix to the results of the cross correlation (see
+    `collect_translations`) and the corresponding stage shifts. The fit
+    results are written to `log.yaml` in `drc` together with the items in
+    `log`, which must include the image `binning`."""
+    translations = collect_translations(results)
 
     # Filter outliers
     sel = get_outlier_filter(translations)
@@ -210,19 +264,13 @@ def calibrate_stage_from_stageshifts(ctrl,
 
     if drc:
         d = {
-            'n_ranges': len(args),
-            'stage_x': stage_x,
-            'stage_y': stage_y,
-            'mode': mode,
-            'magnification': mag,
-            'args': args,
+            **log,
             'translations': translations,
             'stage_shifts': stage_shifts,
             'r': r,
             't': t,
-            'binning': binning,
         }
-        yaml.dump(d, open(drc / 'log.yaml', 'w'))
+        yaml.dump(d, open(Path(drc) / 'log.yaml', 'w'))
 
     if plot:
         r_i = np.linalg.inv(r)
@@ -233,7 +281,7 @@ def calibrate_stage_from_stageshifts(ctrl,
         plt.legend()
         plt.show()
 
-    stagematrix = r / binning
+    stagematrix = r / log['binning']
 
     return stagematrix
 
@@ -247,6 +295,8 @@ def calibrate_stage(ctrl,
                     max_n_step: int = 15,
                     plot: bool = False,
                     drc: str = None,
+                    registration: ImageRegistration = None,
+                    wait: bool = True,
                     ) -> np.array:
     """Calibrate the stage movement (nm) and the position of the camera
     (pixels) at a specific magnification.
@@ -277,6 +327,11 @@ def calibrate_stage(ctrl,
         Plot the fitting result.
     drc: str
         Path to store the raw data (optional).
+    registration: `ImageRegistration`
+        Used to cross correlate the images in the background.
+    wait: bool
+        If False, return a function that returns the stagematrix, see
+        `calibrate_stage_from_stageshifts`.
 
     Returns
     -------
@@ -323,6 +378,8 @@ def calibrate_stage(ctrl,
         *args,
         plot=plot,
         drc=drc,
+        registration=registration,
+        wait=wait,
     )
 
     return stagematrix
@@ -336,6 +393,9 @@ def calibrate_stage_all(ctrl,
                         min_n_step: int = 5,
                         max_n_step: int = 9,
                         save: bool = False,
+                        coarse_binsize: int = None,
+                        workers: int = None,
+                        resume_file: str = None,
                         ) -> dict:
     """Run the stagematrix calibration routine for all magnifications
     specified. Return the updates values for the configuration file.
@@ -360,6 +420,16 @@ def calibrate_stage_all(ctrl,
         calibration. This is used for higher magnifications.
     save: bool
         Save the data to the data directory.
+    coarse_binsize: int
+        Register the images coarse-to-fine, starting with this binning.
+    workers: int
+        Number of threads to register the images in the background. The
+        images of a magnification are registered and fitted while the
+        next magnification is being collected.
+    resume_file: str
+        The calibrated values are stored in this yaml file after every
+        magnification. If the file exists, the magnifications it contains
+        are skipped, so that an interrupted calibration can be resumed.
 
     Returns
     -------
@@ -371,37 +441,64 @@ def calibrate_stage_all(ctrl,
     if not mag_ranges:
         mag_ranges = config.microscope.ranges
 
-    cfg = {mode: {} for mode in modes if mode in mag_ranges}
-
-    for mode in modes:
-        if mode not in mag_ranges:
-            continue
-
-        cfg[mode] = {'stagematrix': {}, 'pixelsize': {}}
-
-        for mag in mag_ranges[mode]:
-            msg = f'Calibrating `{mode}` @ {mag}x'
-            if save:
-                drc = get_new_work_subdirectory(f'stagematrix_{mode}')
-                msg += f' -> {drc}'
-            else:
-                drc = None
-
-            try:
-                stagematrix = calibrate_stage(ctrl,
-                                              mode=mode,
-                                              mag=mag,
-                                              overlap=overlap,
-                                              min_n_step=min_n_step,
-                                              max_n_step=max_n_step,
-                                              drc=drc,
-                                              )
-            except ValueError as e:  # raises if pixelsize is 0 or 1.0
-                print(e)
-                continue
-
-            cfg[mode]['pixelsize'][mag] = float(stagematrix_to_pixelsize(stagematrix))
-            cfg[mode]['stagematrix'][mag] = stagematrix.round(4).flatten().tolist()
+    cfg = {mode: {'stagematrix': {}, 'pixelsize': {}} for mode in modes if mode in mag_ranges}
+
+    if resume_file:
+        resume_file = Path(resume_file)
+        if resume_file.exists():
+            done = yaml.safe_load(open(resume_file, 'r')) or {}
+            for mode in cfg:
+                for key in cfg[mode]:
+                    cfg[mode][key].update(done.get(mode, {}).get(key, {}))
+            print(f'Resuming from {resume_file}')
+
+    def update(mode, mag, fit):
+        stagematrix = fit()
+        cfg[mode]['pixelsize'][mag] = float(stagematrix_to_pixelsize(stagematrix))
+        cfg[mode]['stagematrix'][mag] = stagematrix.round(4).flatten().tolist()
+        if resume_file:
+            yaml.dump(cfg, open(resume_file, 'w'))
+
+    pending = None
+
+    with ImageRegistration(coarse_binsize=coarse_binsize, workers=workers) as registration:
+        for mode in cfg:
+            for mag in mag_ranges[mode]:
+                if mag in cfg[mode]['stagematrix']:
+                    print(f'Skipping `{mode}` @ {mag}x (done)')
+                    continue
+
+                msg = f'Calibrating `{mode}` @ {mag}x'
+                if save:
+                    drc = get_new_work_subdirectory(f'stagematrix_{mode}')
+                    msg += f' -> {drc}'
+                else:
+                    drc = None
+
+                try:
+                    fit = calibrate_stage(ctrl,
+                                          mode=mode,
+                                          mag=mag,
+                                          overlap=overlap,
+                                          stage_length=stage_length,
+                                          min_n_step=min_n_step,
+                                          max_n_step=max_n_step,
+                                          drc=drc,
+                                          registration=registration,
+                                          wait=False,
+                                          )
+                except ValueError as e:  # raises if pixelsize is 0 or 1.0
+                    print(e)
+                    continue
+
+                # fit the previous magnification, its images have been
+                # registered while collecting this one
+                if pending:
+                    update(*pending)
+                pending = (mode, mag, fit)
+
+        if pending:
+            update(*pending)
 
     print('\nUpdate this config file:\n  ', config.locations['calibration'])
 
@@ -455,6 +552,17 @@ The stagematrix takes the image binning into account."""
     parser.add_argument('-s', '--save', action='store_true', dest='save',
                         help=f'Save the data to the data directory [{data_drc}].')
 
+    parser.add_argument('-c', '--coarse_binsize', dest='coarse_binsize', type=int, metavar='N',
+                        help=('Register the images coarse-to-fine, starting with this binning '
+                              '(faster for large images).'))
+
+    parser.add_argument('-w', '--workers', dest='workers', type=int, metavar='N',
+                        help='Number of threads to register the images in the background.')
+
+    parser.add_argument('-r', '--resume', dest='resume_file', type=str, metavar='FILE',
+                        help=('Store the calibrated values in FILE after every magnification, '
+                              'and skip the magnifications already in FILE.'))
+
     parser.set_defaults(mode=(),
                         mags=(),
                         overlap=0.8,
@@ -464,6 +572,9 @@ The stagematrix takes the image binning into account."""
                         plot=False,
                         drc=None,
                         save=False,
+                        coarse_binsize=None,
+                        workers=None,
+                        resume_file=None,
                         )
 
     options = parser.parse_args()
@@ -484,6 +595,9 @@ The stagematrix takes the image binning into account."""
         'stage_length': options.stage_length,
         'min_n_step': options.min_n_step,
         'max_n_step': options.max_n_step,
+        'coarse_binsize': options.coarse_binsize,
+        'workers': options.workers,
+        'resume_file': options.resume_file,
     }
 
     if mode == 'all':
@@ -495,7 +609,7 @@ The stagematrix takes the image binning into account."""
     elif options.all_mags:
         calibrate_stage_all(
             ctrl,
-            mode=mode,
+            modes=(mode, ),
             save=options.save,
             **kwargs,
         )
@@ -0,0 +1,135 @@
+import concurrent.futures
+
+import numpy as np
+from scipy.signal import windows
+from skimage.registration import phase_cross_correlation
+
+from instamatic.image_utils import imgscale
+
+
+def bin_image(img: np.ndarray, binsize: int) -> np.ndarray:
+    """Bin the image by averaging blocks of `binsize` x `binsize` pixels.
+    Pixels that do not fit in a whole block are dropped."""
+    if binsize == 1:
+        return img
+    nx, ny = img.shape[0] // binsize, img.shape[1] // binsize
+    img = img[:nx * binsize, :ny * binsize].astype(float)
+    return img.reshape(nx, binsize, ny, binsize).mean(axis=(1, 3))
+
+
+def phase_cross_correlation_coarse_to_fine(reference: np.ndarray,
+                                           moving: np.ndarray,
+                                           binsize: int = 4,
+                                           window: int = 256,
+                                           upsample_factor: int = 10) -> tuple:
+    """Find the translation between `reference` and `moving`, like
+    `skimage.registration.phase_cross_correlation`, in two steps.
+
+    The integer shift is first found from images binned by `binsize`.
+    The images are then aligned with this shift, and the remaining
+    (subpixel) shift is found from a `window` x `window` region in the
+    middle of the overlap between the images. This avoids the cross
+    correlation of the full size images, which is the slow part for large
+    images.
+
+    Returns the shift, error, and phase difference of the fine step. Falls
+    back to the full size registration if the overlap is smaller than
+    `window`.
+    """
+    coarse, _, _ = phase_cross_correlation(bin_image(reference, binsize), bin_image(moving, binsize))
+    coarse = np.round(coarse * binsize).astype(int)
+
+    shape = np.array(reference.shape)
+    # reference[r] ~ moving[r - shift]; window must fit in both images
+    lo = np.maximum(0, coarse)
+    hi = np.minimum(shape, shape + coarse)
+    size = np.minimum(window, hi - lo)
+
+    if np.any(size < min(window, *shape)):
+        return phase_cross_correlation(reference, moving, upsample_factor=upsample_factor)
+
+    start = (lo + hi - size) // 2
+    ref_window = reference[start[0]:start[0] + size[0], start[1]:start[1] + size[1]]
+    start = start - coarse
+    mov_window = moving[start[0]:start[0] + size[0], start[1]:start[1] + size[1]]
+
+    # taper the edges, which would otherwise pull the shift towards 0
+    taper = np.outer(windows.hann(size[0]), windows.hann(size[1]))
+    ref_window = (ref_window - ref_window.mean()) * taper
+    mov_window = (mov_window - mov_window.mean()) * taper
+
+    fine, error, phasediff = phase_cross_correlation(ref_window, mov_window, upsample_factor=upsample_factor)
+
+    return coarse + fine, error, phasediff
+
+
+class ImageRegistration:
+    """Find the translation between pairs of images with fixed settings,
+    optionally in background threads while the microscope moves to the
+    next position.
+
+    upsample_factor: int
+        Images are registered to within 1 / upsample_factor of a pixel
+    coarse_binsize: int or None
+        If given, register the images coarse-to-fine, see
+        `phase_cross_correlation_coarse_to_fine`
+    window: int
+        Size of the region used for the fine registration
+    workers: int or None
+        Number of background threads for `submit`
+
+    Usage:
+        with ImageRegistration(coarse_binsize=4) as registration:
+            future = registration.submit(img0, img1)  # returns immediately
+            ...  # move the stage, collect the next image
+            shift, error, phasediff = future.result()
+    """
+
+    def __init__(self, upsample_factor: int = 10, coarse_binsize: int = None, window: int = 256, workers: int = None):
+        super().__init__()
+        self.upsample_factor = upsample_factor
+        self.coarse_binsize = coarse_binsize
+        self.window = window
+        self.workers = workers
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def register(self, reference: np.ndarray, moving: np.ndarray, scale: float = None) -> tuple:
+        """Return the shift, error, and phase difference between `reference`
+        and `moving`. `moving` is scaled by `scale` first (see
+        `instamatic.image_utils.imgscale`) if given."""
+        if scale is not None:
+            moving = imgscale(moving, scale)
+
+        if self.coarse_binsize:
+            return phase_cross_correlation_coarse_to_fine(reference, moving,
+                                                          binsize=self.coarse_binsize,
+                                                          window=self.window,
+                                                          upsample_factor=self.upsample_factor)
+        else:
+            return phase_cross_correlation(reference, moving, upsample_factor=self.upsample_factor)
+
+    def submit(self, reference: np.ndarray, moving: np.ndarray, scale: float = None) -> concurrent.futures.Future:
+        """Register the images in a background thread, returns a future for
+        the shift, error, and phase difference."""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ImageRegistration')
+        return self._executor.submit(self.register, reference, moving, scale)
+
+    def map(self, pairs):
+        """Register all image pairs in `pairs` in the background, yields the
+        shift, error, and phase difference in order."""
+        futures = [self.submit(reference, moving) for reference, moving in pairs]
+        for future in futures:
+            yield future.result()
+
+    def close(self) -> None:
+        """Wait for the pending images and stop the background threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -1,7 +1,10 @@
+import asyncio
 import atexit
 import socket
 import subprocess as sp
 import time
+import uuid
+from functools import partial
 from functools import wraps
 
 import numpy as np
@@ -9,16 +12,22 @@ import numpy as np
 from instamatic import config
 from instamatic.exceptions import exception_list
 from instamatic.exceptions import TEMCommunicationError
+from instamatic.server.frame_stream import Frame
+from instamatic.server.protocol import AsyncConnection
+from instamatic.server.protocol import configure_socket
+from instamatic.server.protocol import Connection
+from instamatic.server.serializer import array_loader
 from instamatic.server.serializer import pickle_dumper as dumper
-from instamatic.server.serializer import pickle_loader as loader
+from instamatic.server.serializer import pickle_loader
 
 
 if config.settings.cam_use_shared_memory:
-    from multiprocessing import shared_memory
+    from instamatic.server.frame_ring import FrameRing
+
+loader = partial(array_loader, loader=pickle_loader)
 
 HOST = config.settings.cam_server_host
 PORT = config.settings.cam_server_port
-BUFSIZE = 4096
 
 
 class ServerError(Exception):
@@ -42,6 +51,13 @@ class CamClient:
 
     For documentation, see the actual python interface to the camera
     API.
+
+    Frames can be streamed from the server to acquire at the native
+    frame rate of the camera:
+
+        cam.start_stream(exposure=0.1, n=100)
+        for frame in cam.iter_frames():
+            print(frame.index, frame.timestamp, frame.image.shape)
     """
 
     def __init__(
@@ -53,7 +69,6 @@ class CamClient:
 
         self.name = name
         self.interface = interface
-        self._bufsize = BUFSIZE
         self.streamable = False  # overrides cam settings
         self.verbose = False
 
@@ -78,17 +93,15 @@ class CamClient:
         print('Use shared memory:', self.use_shared_memory)
 
         self.buffers = {}
-        self.shms = {}
+
+        self._stream = None
+        self.stream_stats = {}
 
         self._init_dict()
         self._init_attr_dict()
 
         atexit.register(self.s.close)
 
-        xres, yres = self.getImageDimensions()
-        bitdepth = 4
-        self._imagebufsize = bitdepth * xres * yres + self._bufsize
-
     @property
     def is_local_connection(self):
         """Check if the socket connection is a local connection."""
@@ -97,6 +110,8 @@ class CamClient:
     def connect(self):
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.connect((HOST, PORT))
+        configure_socket(self.s)
+        self._conn = Connection(self.s)
         print(f'Connected to CAM server ({HOST}:{PORT})')
 
     def __getattr__(self, attr_name):
@@ -120,19 +135,16 @@ class CamClient:
 
     def _eval_dct(self, dct):
         """Takes approximately 0.2-0.3 ms per call if HOST=='localhost'."""
-        self.s.send(dumper(dct))
-
-        acquiring_image = dct['attr_name'] == 'getImage'
+        status, data = loader(self._conn.request(dumper(dct)))
 
-        if acquiring_image and not self.use_shared_memory:
-            response = self.s.recv(self._imagebufsize)
-        else:
-            response = self.s.recv(self._bufsize)
+        return self._parse_reply(dct, status, data)
 
-        if response:
-            status, data = loader(response)
+    def _parse_reply(self, dct, status: int, data):
+        """Return the data for request `dct`, or raise the error returned by
+        the server."""
+        acquiring_image = dct['attr_name'] == 'getImage'
 
-        if self.use_shared_memory and acquiring_image:
+        if self.use_shared_memory and acquiring_image and status == 200 and isinstance(data, dict):
             data = self.get_data_from_shared_memory(**data)
 
         if status == 200:
@@ -145,6 +157,94 @@ class CamClient:
         else:
             raise ConnectionError(f'Unknown status code: {status}')
 
+    def _stream_request(self, exposure: float = None, binsize: int = None, n: int = None, maxsize: int = 8) -> dict:
+        if self._stream is not None:
+            raise RuntimeError('A stream is already running, call `iter_frames` or `stop_stream` first')
+
+        self._stream_id = uuid.uuid4().hex
+        self.stream_stats = {'acquired': 0, 'dropped': 0}
+
+        return {'attr_name': 'start_stream',
+                'args': (self._stream_id, ),
+                'kwargs': {'exposure': exposure, 'binsize': binsize, 'n': n, 'maxsize': maxsize}}
+
+    def _parse_stream_reply(self, status: int, data):
+        """Parse a reply from the stream, returns a `Frame`, None for the
+        reply to `start_stream`, or `StopIteration` at the end of the
+        stream."""
+        if status != 200:
+            # `start_stream` failed, no frames will follow
+            self._stream = None
+            self._parse_reply({'attr_name': 'start_stream'}, status, data)
+
+        if data is None:
+            return None
+
+        self.stream_stats = {'acquired': data.get('acquired', data['index']), 'dropped': data['dropped']}
+
+        if data['index'] is None:
+            self._stream = None
+            if data['error']:
+                self._parse_reply({'attr_name': 'start_stream'}, 500, data['error'])
+            return StopIteration
+
+        image = data['image']
+        if isinstance(image, dict):
+            image = self.get_data_from_shared_memory(**image)
+
+        return Frame(data['index'], data['timestamp'], image)
+
+    def start_stream(self, exposure: float = None, binsize: int = None, n: int = None, maxsize: int = 8) -> None:
+        """Start acquiring frames back-to-back on the server, the frames
+        are pushed to the client as they come in. Use `iter_frames` to
+        retrieve them.
+
+        exposure:
+            Exposure time in seconds
+        binsize:
+            Which binning to use
+        n:
+            Number of frames to acquire, acquire until `stop_stream` if None
+        maxsize:
+            Maximum number of frames queued on the server. If the client
+            cannot keep up, new frames are dropped (see `stream_stats`)
+        """
+        dct = self._stream_request(exposure=exposure, binsize=binsize, n=n, maxsize=maxsize)
+        self._stream = self._conn.open_stream(dumper(dct))
+
+    def stop_stream(self) -> None:
+        """Stop the acquisition, the frames already acquired are still
+        returned by `iter_frames`."""
+        if self._stream is not None:
+            self._eval_dct({'attr_name': 'stop_stream', 'args': (self._stream_id, )})
+
+    def iter_frames(self):
+        """Yield the frames from the stream started with `start_stream` as
+        `Frame` tuples (index, timestamp, image) until the stream ends.
+
+        The number of frames acquired and dropped are kept in
+        `stream_stats`.
+        """
+        request_id = self._stream
+        if request_id is None:
+            raise RuntimeError('No stream is running, call `start_stream` first')
+
+        try:
+            while True:
+                status, data = loader(self._conn.receive_stream(request_id))
+                frame = self._parse_stream_reply(status, data)
+                if frame is StopIteration:
+                    break
+                elif frame is not None:
+                    yield frame
+        finally:
+            if self._stream is not None:
+                # stopped early, discard the remaining frames
+                self.stop_stream()
+                while self._parse_stream_reply(*loader(self._conn.receive_stream(request_id))) is not StopIteration:
+                    pass
+            self._conn.close_stream(request_id)
+
     def _init_dict(self):
         """Get list of functions and their doc strings from the uninitialized
         class."""
@@ -161,29 +261,124 @@ class CamClient:
     def __dir__(self):
         return tuple(self._dct.keys()) + tuple(self._attr_dct.keys())
 
-    def get_data_from_shared_memory(self, name: str, shape: tuple, dtype: str, **kwargs):
-        """Grab image data from shared buffer."""
-        dtype = getattr(np, dtype)
-
-        # Initialize shared memory object
-        if name not in self.shms:
-            shm = shared_memory.SharedMemory(name=name)
-            self.shms[name] = shm
-            if self.verbose:
-                print('Read shared memory: `{name}`')
+    def get_data_from_shared_memory(self, name: str, shape: tuple, dtype: str, nslots: int, slot: int, seq: int, **kwargs):
+        """Grab image data from the shared ring buffer.
 
-        # Initialize shared memory buffer
+        Returns a zero-copy view of the frame. The server will not reuse
+        the slot as long as the view (or any array derived from it) is
+        alive, so there is no need to copy the data. Copy the data
+        (`np.copy`) when holding on to many frames at the same time, so
+        that the slots become available to the server again.
+        """
         if name not in self.buffers:
             if self.verbose:
-                print(f'Connect to buffer: `{name}` | {shape} ({dtype})')
-            shm = self.shms[name]
-            self.buffers[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                print(f'Connect to buffer: `{name}` | {shape} ({dtype}) x {nslots}')
+            self.buffers[name] = FrameRing.attach(name, shape=shape, dtype=dtype, nslots=nslots)
 
-        # Copy data from shared image buffer
         if self.verbose:
-            print(f'Retrieve data from buffer `{name}`')
+            print(f'Retrieve data from buffer `{name}` (slot={slot}, seq={seq})')
 
-        buffer = self.buffers[name]
-        data = buffer[:]
+        ring = self.buffers[name]
+        data = ring.view(slot, seq)
 
         return data
+
+
+class AsyncCamClient(CamClient):
+    """asyncio version of `CamClient`.
+
+    All camera functions are coroutines that return the result from the
+    server when awaited, this includes the camera attributes (e.g.
+    `await cam.default_exposure`). The server must be running already.
+
+    Usage:
+        async with AsyncCamClient(name, interface) as cam:
+            arr, dims = await asyncio.gather(cam.getImage(exposure=0.1), cam.getImageDimensions())
+
+            await cam.start_stream(exposure=0.1, n=100)
+            async for frame in cam.iter_frames():
+                ...
+    """
+
+    def __init__(
+        self,
+        name: str,
+        interface: str,
+    ):
+        self.name = name
+        self.interface = interface
+        self.streamable = False  # overrides cam settings
+        self.verbose = False
+
+        self.use_shared_memory = False
+
+        self.buffers = {}
+
+        self._stream = None
+        self.stream_stats = {}
+
+        self._attr_dct = {}
+        self._init_dict()
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def is_local_connection(self):
+        """Check if the socket connection is a local connection."""
+        writer = self._conn.writer
+        return writer.get_extra_info('peername')[0] == writer.get_extra_info('sockname')[0]
+
+    async def connect(self):
+        self._conn = await AsyncConnection.open(HOST, PORT)
+        print(f'Connected to CAM server ({HOST}:{PORT})')
+
+        self.use_shared_memory = config.settings.cam_use_shared_memory and self.is_local_connection
+        print('Use shared memory:', self.use_shared_memory)
+
+        self._attr_dct = await self.get_attrs()
+
+    async def close(self):
+        await self._conn.close()
+
+    async def _eval_dct(self, dct):
+        status, data = loader(await self._conn.request(dumper(dct)))
+
+        return self._parse_reply(dct, status, data)
+
+    async def start_stream(self, exposure: float = None, binsize: int = None, n: int = None, maxsize: int = 8) -> None:
+        """See `CamClient.start_stream`."""
+        dct = self._stream_request(exposure=exposure, binsize=binsize, n=n, maxsize=maxsize)
+        self._stream = self._conn.open_stream(dumper(dct))
+        await self._conn.writer.drain()
+
+    async def stop_stream(self) -> None:
+        """See `CamClient.stop_stream`."""
+        if self._stream is not None:
+            await self._eval_dct({'attr_name': 'stop_stream', 'args': (self._stream_id, )})
+
+    async def iter_frames(self):
+        """Asynchronous generator version of `CamClient.iter_frames`."""
+        request_id = self._stream
+        if request_id is None:
+            raise RuntimeError('No stream is running, call `start_stream` first')
+
+        try:
+            while True:
+                status, data = loader(await self._conn.receive_stream(request_id))
+                frame = self._parse_stream_reply(status, data)
+                if frame is StopIteration:
+                    break
+                elif frame is not None:
+                    yield frame
+        finally:
+            if self._stream is not None:
+                # stopped early, discard the remaining frames
+                await self.stop_stream()
+                while self._parse_stream_reply(*loader(await self._conn.receive_stream(request_id))) is not StopIteration:
+                    pass
+            self._conn.close_stream(request_id)
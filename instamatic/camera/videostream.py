@@ -1,15 +1,81 @@
 import atexit
+import collections
+import queue
 import threading
+import time
+from concurrent.futures import Future
 
 from .camera import Camera
+from instamatic.server.frame_stream import Frame
+
+
+class FrameQueue:
+    """Bounded queue of frames for a consumer of the `VideoStream`.
+
+    The grabber never waits for the consumer: if the queue is full, new
+    frames are dropped and counted in `dropped`. Iterating over the
+    queue yields the frames until the queue is closed.
+    """
+
+    def __init__(self, maxsize: int = 16):
+        super().__init__()
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __iter__(self):
+        while True:
+            frame = self.get()
+            if frame is None:
+                break
+            yield frame
+
+    def put(self, frame: Frame) -> None:
+        with self._condition:
+            if len(self._frames) >= self.maxsize:
+                self.dropped += 1
+                return
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def get(self, timeout: float = None) -> Frame:
+        """Return the next frame, or None if the queue has been closed and
+        all frames have been consumed.
+
+        Raises `queue.Empty` if no frame arrives within `timeout`.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._frames or self.closed, timeout=timeout):
+                raise queue.Empty
+            if self._frames:
+                return self._frames.popleft()
+            return None
+
+    def close(self) -> None:
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
 
 
 class ImageGrabber:
     """Continuously read out the camera for continuous acquisition.
 
-    When the continousCollectionEvent is set, the camera will set the exposure to `frametime`, otherwise, the default camera exposure is used.
+    The grabber acquires frames in its own thread, in order of priority:
+
+    1. Frames requested through `request` (i.e. `VideoStream.getImage`)
+    2. Back-to-back frames for a stream started with `start_stream`
+    3. Live view frames with exposure `frametime`, unless the
+       continousCollectionEvent is set (the grabber then idles).
 
-    The callback function is used to send the frame back to the parent routine.
+    Every frame gets a sequence number and a timestamp, and is passed as
+    a `Frame` to the callback function (to send the frame back to the
+    parent routine) and to all subscribed `FrameQueue`s.
     """
 
     def __init__(self, cam, callback, frametime: float = 0.05):
@@ -35,23 +101,106 @@ class ImageGrabber:
 
         self.lock = threading.Lock()
 
+        self.nframes = 0
+        self.requests = queue.Queue()
+        self.subscribers = []
+
+        self.stream = None
+        self.stream_args = None
+        self.stream_count = 0
+        self.stream_error = None
+
         self.stopEvent = threading.Event()
-        self.acquireInitiateEvent = threading.Event()
-        self.acquireCompleteEvent = threading.Event()
         self.continuousCollectionEvent = threading.Event()
 
     def run(self):
         while not self.stopEvent.is_set():
+            idle = self.stream is None and self.continuousCollectionEvent.is_set()
+
+            try:
+                request = self.requests.get(timeout=0.1) if idle else self.requests.get_nowait()
+            except queue.Empty:
+                request = None
+
+            if request is not None:
+                self.acquire_requested(*request)
+            elif self.stream is not None:
+                self.acquire_stream()
+            elif not idle:
+                self.acquire(exposure=self.frametime, binsize=self.binsize)
+
+    def acquire(self, exposure: float, binsize: int, acquire: bool = False) -> Frame:
+        """Acquire a single frame, and pass it on to all consumers."""
+        image = self.cam.getImage(exposure=exposure, binsize=binsize)
+
+        self.nframes += 1
+        frame = Frame(self.nframes, time.time(), image)
+
+        self.callback(frame, acquire=acquire)
+        for subscriber in self.subscribers:
+            subscriber.put(frame)
+
+        return frame
+
+    def acquire_requested(self, exposure: float, binsize: int, future: Future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            frame = self.acquire(exposure=exposure, binsize=binsize, acquire=True)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(frame)
+
+    def acquire_stream(self):
+        frames = self.stream
+        if frames is None:
+            return
+
+        exposure, binsize, n = self.stream_args
+
+        try:
+            frame = self.acquire(exposure=exposure, binsize=binsize)
+        except Exception as e:
+            self.stream_error = e
+            self.stop_stream()
+            return
+
+        self.stream_count += 1
+        frames.put(frame._replace(index=self.stream_count))
+
+        if n is not None and self.stream_count >= n:
+            self.stop_stream()
+
+    def request(self, exposure: float = None, binsize: int = None) -> Future:
+        """Request a frame with the given exposure/binsize, returns a future
+        that receives the `Frame`."""
+        if exposure:
+            self.exposure = exposure
+        if binsize:
+            self.binsize = binsize
+
+        future = Future()
+        self.requests.put((self.exposure, self.binsize, future))
+        return future
 
-            if self.acquireInitiateEvent.is_set():
-                self.acquireInitiateEvent.clear()
+    def start_stream(self, frames: FrameQueue, exposure: float, binsize: int, n: int = None):
+        """Acquire frames back-to-back and put them in `frames` until `n`
+        frames have been acquired or `stop_stream` is called."""
+        if self.stream is not None:
+            raise RuntimeError('A stream is already running')
 
-                frame = self.cam.getImage(exposure=self.exposure, binsize=self.binsize)
-                self.callback(frame, acquire=True)
+        self.stream_args = (exposure, binsize, n)
+        self.stream_count = 0
+        self.stream_error = None
+        self.stream = frames
 
-            elif not self.continuousCollectionEvent.is_set():
-                frame = self.cam.getImage(exposure=self.frametime, binsize=self.binsize)
-                self.callback(frame)
+    def stop_stream(self):
+        frames = self.stream
+        self.stream = None
+        if frames is not None:
+            frames.close()
 
     def start_loop(self):
         self.thread = threading.Thread(target=self.run, args=(), daemon=True)
@@ -63,7 +212,12 @@ class ImageGrabber:
 
 
 class VideoStream(threading.Thread):
-    """Handle the continuous stream of incoming data from the ImageGrabber."""
+    """Handle the continuous stream of incoming data from the ImageGrabber.
+
+    The last frame is kept in `frame` for the live view. Consumers that
+    need every frame can `subscribe` to the stream, or start a stream of
+    back-to-back frames with `start_stream`/`iter_frames`.
+    """
 
     def __init__(self, cam='simulate'):
         threading.Thread.__init__(self)
@@ -82,6 +236,12 @@ class VideoStream(threading.Thread):
 
         self.frametime = self.default_exposure
 
+        self.frame = None
+        self.last_frame = None
+
+        self._stream = None
+        self.stream_stats = {}
+
         self.grabber = self.setup_grabber()
 
         self.streamable = self.cam.streamable
@@ -102,16 +262,10 @@ class VideoStream(threading.Thread):
     def start(self):
         self.grabber.start_loop()
 
-    def send_frame(self, frame, acquire=False):
-        if acquire:
-            self.grabber.lock.acquire(True)
-            self.acquired_frame = self.frame = frame
-            self.grabber.lock.release()
-            self.grabber.acquireCompleteEvent.set()
-        else:
-            self.grabber.lock.acquire(True)
-            self.frame = frame
-            self.grabber.lock.release()
+    def send_frame(self, frame: Frame, acquire: bool = False):
+        with self.lock:
+            self.last_frame = frame
+            self.frame = frame.image
 
     def setup_grabber(self):
         grabber = ImageGrabber(self.cam, callback=self.send_frame, frametime=self.frametime)
@@ -119,26 +273,75 @@ class VideoStream(threading.Thread):
         return grabber
 
     def getImage(self, exposure=None, binsize=None):
-        current_frametime = self.grabber.frametime
-
-        # set to 0 to prevent it lagging data acquisition
-        self.grabber.frametime = 0
-        if exposure:
-            self.grabber.exposure = exposure
-        if binsize:
-            self.grabber.binsize = binsize
-
-        self.grabber.acquireInitiateEvent.set()
-
-        self.grabber.acquireCompleteEvent.wait()
-
-        self.grabber.lock.acquire(True)
-        frame = self.acquired_frame
-        self.grabber.lock.release()
+        return self.get_frame(exposure=exposure, binsize=binsize).image
+
+    def get_frame(self, exposure=None, binsize=None) -> Frame:
+        """Acquire a single image, returns a `Frame` with the sequence number
+        and timestamp of the image."""
+        return self.grabber.request(exposure=exposure, binsize=binsize).result()
+
+    def subscribe(self, maxsize: int = 16) -> FrameQueue:
+        """Return a queue that receives every frame from the stream (live
+        view and acquired), until `unsubscribe` is called."""
+        frames = FrameQueue(maxsize=maxsize)
+        self.grabber.subscribers = self.grabber.subscribers + [frames]
+        return frames
+
+    def unsubscribe(self, frames: FrameQueue):
+        self.grabber.subscribers = [item for item in self.grabber.subscribers if item is not frames]
+        frames.close()
+
+    def start_stream(self, exposure: float = None, binsize: int = None, n: int = None, maxsize: int = 16) -> None:
+        """Acquire frames back-to-back, use `iter_frames` to retrieve them.
+        The live view is paused, but shows the frames from the stream.
+
+        exposure:
+            Exposure time in seconds
+        binsize:
+            Which binning to use
+        n:
+            Number of frames to acquire, acquire until `stop_stream` if None
+        maxsize:
+            Maximum number of frames waiting to be consumed, new frames are
+            dropped if the consumer cannot keep up (see `stream_stats`)
+        """
+        if not exposure:
+            exposure = self.default_exposure
+        if not binsize:
+            binsize = self.grabber.binsize
+
+        self._stream = FrameQueue(maxsize=maxsize)
+        self.stream_stats = {'acquired': 0, 'dropped': 0}
+        self.grabber.start_stream(self._stream, exposure=exposure, binsize=binsize, n=n)
+
+    def stop_stream(self) -> None:
+        """Stop the acquisition, the frames already acquired are still
+        returned by `iter_frames`."""
+        self.grabber.stop_stream()
+
+    def iter_frames(self):
+        """Yield the frames from the stream started with `start_stream` as
+        `Frame` tuples (index, timestamp, image) until the stream ends.
+
+        The number of frames acquired and dropped are kept in
+        `stream_stats`.
+        """
+        frames = self._stream
+        if frames is None:
+            raise RuntimeError('No stream is running, call `start_stream` first')
 
-        self.grabber.acquireCompleteEvent.clear()
-        self.grabber.frametime = current_frametime
-        return frame
+        try:
+            for frame in frames:
+                self.stream_stats = {'acquired': self.grabber.stream_count, 'dropped': frames.dropped}
+                yield frame
+        finally:
+            if frames is self.grabber.stream:
+                self.stop_stream()
+            self._stream = None
+            self.stream_stats = {'acquired': self.grabber.stream_count, 'dropped': frames.dropped}
+
+        if self.grabber.stream_error is not None:
+            raise self.grabber.stream_error
 
     def update_frametime(self, frametime):
         self.frametime = frametime
@@ -172,10 +375,16 @@ class VideoStream(threading.Thread):
         i = 0
 
         self.block()
+
+        future = self.grabber.request(exposure=exposure)
         while go_on:
             i += 1
 
-            img = self.getImage(exposure=exposure)
+            img = future.result().image
+
+            # request the next frame before handling this one (double buffering)
+            if callback or i < n:
+                future = self.grabber.request(exposure=exposure)
 
             if callback:
                 go_on = callback(img)
@@ -183,6 +392,9 @@ class VideoStream(threading.Thread):
                 buffer.append(img)
                 go_on = i < n
 
+        # discard the last request if it has not been started yet
+        future.cancel()
+
         self.unblock()
 
         if not callback:
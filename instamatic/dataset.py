@@ -0,0 +1,278 @@
+"""Lazy, indexed access to the images in an experiment directory.
+
+The directory is scanned once, and an index with the frame number,
+path, timestamp, rotation angle, and a few key header fields of every
+image is cached next to the data (`.instamatic_index.json`). The next
+time the dataset is opened, only new or modified files are read. The
+image data are only loaded on access, in parallel if several frames are
+requested at once:
+
+    ds = Dataset('cred_1', pattern='tiff/*.tif*')
+    print(len(ds), ds.timestamps)
+    img, h = ds[0]
+    for number, img, h in ds.iter_buffer():
+        ...
+
+`ds.to_buffer()` returns the frames as a buffer for `ImgConversion`.
+"""
+import concurrent.futures
+import json
+import logging
+import os
+import re
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from instamatic.formats import read_image
+from instamatic.formats import read_tiff_headers
+from instamatic.formats.metadata import decode_header
+from instamatic.formats.metadata import encode_header
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = '.instamatic_index.json'
+INDEX_VERSION = 1
+
+# header fields stored in the index
+KEYS = (
+    'ImageGetTime',
+    'ImageExposureTime',
+    'ImageBinsize',
+    'ImageResolution',
+    'StagePosition',
+    'Magnification',
+    'Mode',
+    # TVIPS/EMMENU
+    'Time',
+    'ExposureTime',
+    'TemMagnification',
+)
+
+Entry = namedtuple('Entry', 'number path timestamp angle header mtime size')
+Entry.__doc__ = """Index entry for a single image, `header` contains only
+the key fields (see `KEYS`)."""
+
+
+def get_frame_number(path: Path, default: int) -> int:
+    """Return the frame number from the trailing digits of the file name,
+    i.e. `00012.tiff` or `image_12.tif` -> 12."""
+    match = re.search(r'(\d+)$', path.stem)
+    return int(match.group(1)) if match else default
+
+
+def get_timestamp(header: dict) -> float:
+    for key in ('ImageGetTime', 'Time'):
+        value = header.get(key)
+        if isinstance(value, (int, float)):
+            return float(value)
+    return np.nan
+
+
+def get_angle(header: dict) -> float:
+    try:
+        return float(header['StagePosition'][3])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return np.nan
+
+
+def read_headers(fns: list) -> list:
+    """Read the headers of the images in `fns`, only the TIFF headers can
+    be read without reading the image data."""
+    headers = []
+    for fn in fns:
+        if fn.suffix.lower() in ('.tif', '.tiff'):
+            header, = read_tiff_headers([fn])
+        else:
+            img, header = read_image(fn)
+        headers.append(header or {})
+    return headers
+
+
+class Dataset:
+    """Indexed collection of images in directory `drc` matching
+    `pattern`.
+
+    drc:
+        Path to the experiment directory
+    pattern:
+        Glob pattern to find the images, relative to `drc`
+    keys:
+        Header fields to store in the index
+    workers:
+        Number of threads to read headers and images
+    cache:
+        Read/write the index from/to `drc/.instamatic_index.json`
+    """
+
+    def __init__(self, drc: str, pattern: str = 'tiff/*.tif*', keys: tuple = KEYS, workers: int = 8, cache: bool = True):
+        super().__init__()
+        self.drc = Path(drc)
+        self.pattern = pattern
+        self.keys = tuple(keys)
+        self.workers = workers
+        self.cache = cache
+
+        self.index_file = self.drc / INDEX_FILE
+        self.entries = self.scan()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.drc)!r}, pattern={self.pattern!r}, nframes={len(self)})'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, n: int) -> (np.array, dict):
+        """Load the image and full header at position `n`."""
+        return read_image(self.path(n))
+
+    def __iter__(self):
+        for number, img, h in self.iter_buffer():
+            yield img, h
+
+    def path(self, n: int) -> Path:
+        return self.drc / self.entries[n].path
+
+    @property
+    def numbers(self) -> np.array:
+        return np.array([entry.number for entry in self.entries])
+
+    @property
+    def timestamps(self) -> np.array:
+        return np.array([entry.timestamp for entry in self.entries])
+
+    @property
+    def angles(self) -> np.array:
+        return np.array([entry.angle for entry in self.entries])
+
+    @property
+    def headers(self) -> list:
+        """Key header fields (see `keys`) of all images."""
+        return [entry.header for entry in self.entries]
+
+    def _load_index(self) -> dict:
+        if not (self.cache and self.index_file.exists()):
+            return {}
+
+        try:
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning('Cannot read index %s: %s', self.index_file, e)
+            return {}
+
+        if index.get('version') != INDEX_VERSION or index.get('pattern') != self.pattern or tuple(index.get('keys', ())) != self.keys:
+            return {}
+
+        entries = {}
+        for item in index['entries']:
+            item['header'] = decode_header(item['header'].encode()) or {}
+            entries[item['path']] = Entry(**item)
+        return entries
+
+    def _save_index(self) -> None:
+        items = []
+        for entry in self.entries:
+            item = entry._asdict()
+            item['timestamp'] = None if np.isnan(entry.timestamp) else entry.timestamp
+            item['angle'] = None if np.isnan(entry.angle) else entry.angle
+            try:
+                item['header'] = encode_header(entry.header).decode()
+            except (TypeError, ValueError):
+                item['header'] = encode_header({}).decode()
+            items.append(item)
+
+        index = {'version': INDEX_VERSION, 'pattern': self.pattern, 'keys': self.keys, 'entries': items}
+
+        try:
+            with open(self.index_file, 'w') as f:
+                json.dump(index, f)
+        except OSError as e:
+            logger.warning('Cannot write index %s: %s', self.index_file, e)
+
+    def scan(self) -> list:
+        """Scan the directory and update the index, only files that are new
+        or have been modified since the last scan are read.
+
+        Returns the list of entries sorted by frame number.
+        """
+        cached = self._load_index()
+
+        fns = sorted(self.drc.glob(self.pattern))
+        entries = []
+        new = []
+
+        for i, fn in enumerate(fns):
+            relpath = fn.relative_to(self.drc).as_posix()
+            stat = os.stat(fn)
+            entry = cached.get(relpath)
+            if entry and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+                entry = entry._replace(timestamp=np.nan if entry.timestamp is None else entry.timestamp,
+                                       angle=np.nan if entry.angle is None else entry.angle)
+                entries.append(entry)
+            else:
+                new.append((i, fn, relpath, stat))
+
+        if new:
+            logger.info('Reading %d headers in %s', len(new), self.drc)
+
+            chunks = [new[i::self.workers] for i in range(self.workers)]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(lambda chunk: read_headers([fn for _, fn, _, _ in chunk]), chunks)
+
+                for chunk, headers in zip(chunks, results):
+                    for (i, fn, relpath, stat), header in zip(chunk, headers):
+                        entries.append(Entry(number=get_frame_number(fn, default=i + 1),
+                                             path=relpath,
+                                             timestamp=get_timestamp(header),
+                                             angle=get_angle(header),
+                                             header={key: header[key] for key in self.keys if key in header},
+                                             mtime=stat.st_mtime,
+                                             size=stat.st_size))
+
+        entries.sort(key=lambda entry: (entry.number, entry.path))
+        self.entries = entries
+
+        if self.cache and (new or len(cached) != len(entries)):
+            self._save_index()
+
+        return entries
+
+    def load(self, indices=None) -> list:
+        """Load the images and full headers at positions `indices` (all if
+        None) in parallel.
+
+        Returns a list of tuples (image, header).
+        """
+        if indices is None:
+            indices = range(len(self))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self.__getitem__, indices))
+
+    def iter_buffer(self, indices=None, prefetch: int = None):
+        """Iterate over the frames at positions `indices` (all if None),
+        yields tuples (frame number, image, header).
+
+        Up to `prefetch` (default: 2x the number of workers) frames are
+        read ahead in the background.
+        """
+        if indices is None:
+            indices = range(len(self))
+        indices = list(indices)
+        if prefetch is None:
+            prefetch = 2 * self.workers
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.__getitem__, n) for n in indices[:prefetch]]
+            for k, n in enumerate(indices):
+                if k + prefetch < len(indices):
+                    futures.append(executor.submit(self.__getitem__, indices[k + prefetch]))
+                img, h = futures[k].result()
+                futures[k] = None
+                yield self.entries[n].number, img, h
+
+    def to_buffer(self, indices=None) -> list:
+        """Return the frames as an image buffer, a list of tuples (frame
+        number, image data, header), as used by `ImgConversion`."""
+        return list(self.iter_buffer(indices))
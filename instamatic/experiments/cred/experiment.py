@@ -9,7 +9,8 @@ import numpy as np
 import instamatic
 from instamatic import config
 from instamatic.formats import write_tiff
-from instamatic.processing.ImgConversionTPX import ImgConversionTPX as ImgConversion
+from instamatic.image_utils import rotate_image
+from instamatic.processing.ImgConversionStream import ImgConversionStream
 
 # degrees to rotate before activating data collection procedure
 ACTIVATION_THRESHOLD = 0.2
@@ -49,6 +50,8 @@ class Experiment:
         Image interval only - Exposure time for defocused images
     write_tiff, write_xds, write_dials, write_red:
         Specify which data types/input files should be written
+    write_hdf5:
+        Also write all frames to a single HDF5 file (`data.h5`)
     stop_event:
         Instance of `threading.Event()` that signals the experiment to be terminated.
     """
@@ -69,6 +72,7 @@ class Experiment:
                  write_xds: bool = True,
                  write_dials: bool = True,
                  write_red: bool = True,
+                 write_hdf5: bool = False,
                  stop_event=None,
                  ):
         super().__init__()
@@ -92,6 +96,7 @@ class Experiment:
         self.write_xds = write_xds
         self.write_dials = write_dials
         self.write_red = write_red
+        self.write_hdf5 = write_hdf5
         self.write_pets = write_tiff  # TODO
 
         self.image_interval_enabled = enable_image_interval
@@ -244,7 +249,6 @@ class Experiment:
         self.setup_paths()
         self.log_start_status()
 
-        buffer = []
         image_buffer = []
 
         if self.ctrl.mode != 'diff':
@@ -257,45 +261,56 @@ class Experiment:
         if self.relax_beam_before_experiment:
             self.relax_beam()
 
+        # acquire frames back-to-back on the camera server if possible
+        use_stream = not self.image_interval_enabled and hasattr(self.ctrl.cam, 'start_stream')
+
         self.start_angle = self.start_rotation()
-        self.ctrl.cam.block()
 
-        i = 1
+        # the diffraction data are converted and written during data collection
+        buffer = self.setup_conversion()
 
-        t0 = time.perf_counter()
+        if use_stream:
+            t0 = time.perf_counter()
+            i = self.acquire_stream(buffer)
+        else:
+            self.ctrl.cam.block()
 
-        while not self.stopEvent.is_set():
-            if i % self.image_interval == 0:
-                t_start = time.perf_counter()
-                acquisition_time = (t_start - t0) / (i - 1)
+            i = 1
 
-                self.ctrl.difffocus.set(self.diff_focus_defocused, confirm_mode=False)
-                img, h = self.ctrl.get_image(exposure_image, header_keys=None)
-                self.ctrl.difffocus.set(self.diff_focus_proper, confirm_mode=False)
+            t0 = time.perf_counter()
 
-                image_buffer.append((i, img, h))
+            while not self.stopEvent.is_set():
+                if i % self.image_interval == 0:
+                    t_start = time.perf_counter()
+                    acquisition_time = (t_start - t0) / (i - 1)
 
-                next_interval = t_start + acquisition_time
-                # print(f"{i} BLOOP! {next_interval-t_start:.3f} {acquisition_time:.3f} {t_start-t0:.3f}")
+                    self.ctrl.difffocus.set(self.diff_focus_defocused, confirm_mode=False)
+                    img, h = self.ctrl.get_image(exposure_image, header_keys=None)
+                    self.ctrl.difffocus.set(self.diff_focus_proper, confirm_mode=False)
 
-                while time.perf_counter() > next_interval:
-                    next_interval += acquisition_time
-                    i += 1
-                    # print(f"{i} "SKIP!  {next_interval-t_start:.3f} {acquisition_time:.3f}")
+                    image_buffer.append((i, img, h))
 
-                diff = next_interval - time.perf_counter()  # seconds
+                    next_interval = t_start + acquisition_time
+                    # print(f"{i} BLOOP! {next_interval-t_start:.3f} {acquisition_time:.3f} {t_start-t0:.3f}")
 
-                if self.track_stage_position and diff > 0.1:
-                    self.stage_positions.append((i, self.ctrl.stage.get()))
+                    while time.perf_counter() > next_interval:
+                        next_interval += acquisition_time
+                        i += 1
+                        # print(f"{i} "SKIP!  {next_interval-t_start:.3f} {acquisition_time:.3f}")
 
-                time.sleep(diff)
+                    diff = next_interval - time.perf_counter()  # seconds
 
-            else:
-                img, h = self.ctrl.get_image(self.exposure, header_keys=None)
-                # print(f"{i} Image!")
-                buffer.append((i, img, h))
+                    if self.track_stage_position and diff > 0.1:
+                        self.stage_positions.append((i, self.ctrl.stage.get()))
 
-            i += 1
+                    time.sleep(diff)
+
+                else:
+                    img, h = self.ctrl.get_image(self.exposure, header_keys=None)
+                    # print(f"{i} Image!")
+                    buffer.append((i, img, h))
+
+                i += 1
 
         t1 = time.perf_counter()
 
@@ -304,7 +319,8 @@ class Experiment:
 
         self.stopEvent.clear()
 
-        self.ctrl.cam.unblock()
+        if not use_stream:
+            self.ctrl.cam.unblock()
 
         if self.mode == 'simulate':
             # simulate somewhat realistic end numbers
@@ -328,6 +344,7 @@ class Experiment:
         # in case something went wrong starting data collection, return gracefully
         if i == 1:
             print_and_log(f'Data collection interrupted', logger=self.logger)
+            buffer.discard()
             return False
 
         self.spotsize = self.ctrl.spotsize
@@ -352,7 +369,8 @@ class Experiment:
         self.log_end_status()
 
         if self.nframes <= 3:
-            print_and_log(f'Not enough frames collected. Data will not be written (nframes={self.nframes})', logger=self.logger)
+            print_and_log(f'Not enough frames collected. The data files have been removed, and input files will not be written (nframes={self.nframes})', logger=self.logger)
+            buffer.discard()
             return False
 
         self.write_data(buffer)
@@ -373,34 +391,88 @@ class Experiment:
 
         return True
 
-    def write_data(self, buffer: list):
-        """Write diffraction data in the buffer.
-
-        The image buffer is passed as a list of tuples, where each tuple contains the
-        index (int), image data (2D numpy array), metadata/header (dict).
+    def acquire_stream(self, buffer: list) -> int:
+        """Acquire diffraction data using the streaming mode of the camera
+        server (`CamClient.start_stream`) until `stopEvent` is set. The
+        frames are acquired back-to-back by the server, so that the data
+        are collected at the native frame rate of the camera.
 
-        The buffer index must start at 1.
+        The frames are appended to `buffer` as tuples of the index, image
+        data, and header. The index is the frame number counted by the
+        server, so that dropped frames are skipped like in the regular
+        data collection. Returns the index of the next frame.
         """
+        cam = self.ctrl.cam
+        binsize = cam.default_binsize
+
+        mag = self.ctrl.magnification.value
+        mode = self.ctrl.mode.get()
+
+        header = {
+            'ImageExposureTime': self.exposure,
+            'ImageBinsize': binsize,
+            'ImageComment': '',
+            'ImageCameraName': cam.name,
+            'ImageCameraDimensions': cam.getCameraDimensions(),
+        }
+
+        cam.start_stream(exposure=self.exposure, binsize=binsize)
 
-        img_conv = ImgConversion(buffer=buffer,
-                                 osc_angle=self.osc_angle,
-                                 start_angle=self.start_angle,
-                                 end_angle=self.end_angle,
-                                 rotation_axis=self.rotation_axis,
-                                 acquisition_time=self.acquisition_time,
-                                 flatfield=self.flatfield,
-                                 pixelsize=self.pixelsize,
-                                 physical_pixelsize=self.physical_pixelsize,
-                                 wavelength=self.wavelength,
-                                 stretch_amplitude=self.stretch_amplitude,
-                                 stretch_azimuth=self.stretch_azimuth,
-                                 )
+        i = 1
+        stopping = False
+
+        for frame in cam.iter_frames():
+            if self.stopEvent.is_set() and not stopping:
+                cam.stop_stream()
+                stopping = True
+
+            # copy the data to release the frame on the server
+            img = rotate_image(np.array(frame.image), mode=mode, mag=mag)
+
+            h = dict(header)
+            h['ImageGetTime'] = frame.timestamp
+            h['ImageResolution'] = img.shape
+
+            i = frame.index
+            buffer.append((i, img, h))
+            i += 1
+
+        dropped = cam.stream_stats['dropped']
+        if dropped:
+            print_and_log(f'{dropped} frames were dropped by the camera server', logger=self.logger)
+
+        return i
 
+    def setup_conversion(self) -> ImgConversionStream:
+        """Set up the conversion of the diffraction data, so that the frames
+        can be written while the data are being collected.
+
+        Frames are added as tuples of the index (int), image data (2D
+        numpy array), metadata/header (dict), using `.append`. The index
+        must start at 1.
+        """
+        return ImgConversionStream(start_angle=self.start_angle,
+                                   rotation_axis=config.camera.camera_rotation_vs_stage_xy,
+                                   flatfield=self.flatfield,
+                                   physical_pixelsize=config.camera.physical_pixelsize,
+                                   wavelength=config.microscope.wavelength,
+                                   stretch_amplitude=config.camera.stretch_amplitude,
+                                   stretch_azimuth=config.camera.stretch_azimuth,
+                                   tiff_path=self.tiff_path,
+                                   smv_path=self.smv_path,
+                                   mrc_path=self.mrc_path,
+                                   hdf5_path=self.path / 'data.h5' if self.write_hdf5 else None,
+                                   )
+
+    def write_data(self, img_conv: ImgConversionStream):
+        """Finish writing the diffraction data, and write the input files
+        that depend on the parameters of the whole data collection."""
         print('Writing data files...')
-        img_conv.threadpoolwriter(tiff_path=self.tiff_path,
-                                  mrc_path=self.mrc_path,
-                                  smv_path=self.smv_path,
-                                  workers=8)
+        img_conv.finalize(osc_angle=self.osc_angle,
+                          end_angle=self.end_angle,
+                          acquisition_time=self.acquisition_time,
+                          pixelsize=self.pixelsize,
+                          )
 
         print('Writing input files...')
         if self.write_dials:
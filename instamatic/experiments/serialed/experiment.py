@@ -11,10 +11,8 @@ from instamatic import config
 from instamatic.calibrate import CalibBeamShift
 from instamatic.calibrate import CalibDirectBeam
 from instamatic.formats import *
-from instamatic.processing.find_crystals import find_crystals
-from instamatic.processing.find_crystals import find_crystals_timepix
-from instamatic.processing.flatfield import apply_flatfield_correction
-from instamatic.processing.flatfield import remove_deadpixels
+from instamatic.processing.find_crystals import CrystalFinder
+from instamatic.processing.flatfield import FlatfieldCorrector
 
 
 def make_grid_on_stage(startpoint, endpoint, padding=2.0):
@@ -242,16 +240,28 @@ class Experiment:
         self.change_spotsize = self.diff_spotsize != self.image_spotsize
         self.crystal_spread = kwargs.get('crystal_spread', 0.6)
 
+        # write all images to `images.h5` and `data.h5`, instead of one file per image
+        self.hdf5_stack = kwargs.get('hdf5_stack', False)
+
+        # segment the images with `random_walker` or the faster `watershed`
+        segmentation_mode = kwargs.get('segmentation_mode', 'random_walker')
+        # move on to the next `look_ahead` positions while the images are segmented, and
+        # return to the positions with crystals afterwards (0: wait for the segmentation
+        # at every position). With `scan_ahead`, all positions of a scan area are imaged first.
+        self.look_ahead = kwargs.get('look_ahead', 1)
+        self.scan_ahead = kwargs.get('scan_ahead', False)
+
         if self.ctrl.cam.name == 'timepix':
-            self.find_crystals = find_crystals_timepix
+            self.crystal_finder = CrystalFinder.timepix(self.magnification, spread=self.crystal_spread, mode=segmentation_mode)
             self.flatfield = kwargs.get('flatfield', 'flatfield.tiff')
         else:
-            self.find_crystals = find_crystals
+            self.crystal_finder = CrystalFinder(self.magnification, spread=self.crystal_spread, mode=segmentation_mode)
             self.flatfield = None
 
         if self.flatfield is not None:
             self.flatfield, h_flatfield = read_tiff(self.flatfield)
             self.deadpixels = h_flatfield['deadpixels']
+            self.flatfield_corrector = FlatfieldCorrector(self.flatfield, deadpixels=self.deadpixels)
 
         # self.sample_rotation_angles = ( -10, -5, 5, 10 )
         # self.sample_rotation_angles = (-5, 5)
@@ -359,6 +369,7 @@ class Experiment:
                 print()
                 continue
             else:
+                self.stage_xy = (x, y)
                 self.log.info('Stage position: center %d/%d -> (x=%0.1f, y=%0.1f)', i, ncenters, x, y)
                 yield i, (x, y)
 
@@ -384,13 +395,26 @@ class Experiment:
                     print()
                     continue
                 else:
-                    time.sleep(delay)
+                    self.ctrl.stage.settle(delay, axes='xy')
                     t.set_description(f'Stage(x={x:7.0f}, y={y:7.0f})')
 
-                    dct = {'exp_scan_number': i, 'exp_image_number': j, 'exp_scan_offset': (x_offset, y_offset), 'exp_scan_center': (center_x, center_y), 'exp_stage_position': (x, y)}
+                    # the stage may return here later, see `return_to_position`
+                    approach, self.stage_xy = self.stage_xy, (x, y)
+
+                    dct = {'exp_scan_number': i, 'exp_image_number': j, 'exp_scan_offset': (x_offset, y_offset), 'exp_scan_center': (center_x, center_y), 'exp_stage_position': (x, y), 'exp_stage_approach': approach}
                     dct['ImageComment'] = 'scan {exp_scan_number} image {exp_image_number}'.format(**dct)
                     yield dct
 
+    def return_to_position(self, d_pos, delay=0.05):
+        """Move the stage back to the position of an earlier image. The
+        stage first moves to the position it came from when the image was
+        taken (`exp_stage_approach`), so that the final move has the same
+        direction, and the backlash is the same as for the image."""
+        for x, y in (d_pos['exp_stage_approach'], d_pos['exp_stage_position']):
+            self.ctrl.stage.set(x=x, y=y)
+            self.ctrl.stage.settle(delay, axes='xy')
+        self.stage_xy = (x, y)
+
     def loop_crystals(self, crystal_coords, delay=0):
         """Loop over crystal coordinates (pixels) Switch to diffraction mode,
         and shift the beam to be on the crystal.
@@ -431,72 +455,76 @@ class Experiment:
 
             yield dct
 
+    def write_image(self, outfile, img, h, stack: str = 'data'):
+        """Write the image to `outfile` (HDF5), or append it to the image/
+        data stack if `hdf5_stack` is set.
+
+        In the stack, the file name is stored in the header as
+        `exp_filename`, so that the individual files can be exported
+        with `HDF5StackReader.export(..., template='{exp_filename}')`.
+        """
+        if self.hdf5_stack:
+            h['exp_filename'] = outfile.name
+            stack = self.image_stack if stack == 'image' else self.data_stack
+            stack.append(img, header=h)
+        else:
+            write_hdf5(outfile, img, header=h)
+
     def apply_corrections(self, img, h):
         if self.flatfield is not None:
-            img = remove_deadpixels(img, deadpixels=self.deadpixels)
+            img = self.flatfield_corrector(img)
             h['DeadPixelCorrection'] = True
-            img = apply_flatfield_correction(img, flatfield=self.flatfield)
             h['FlatfieldCorrection'] = True
         return img, h
 
-    def run(self, ctrl=None, **kwargs):
-        """Run serial electron diffraction experiment."""
-
-        self.initialize_microscope()
-
-        header_keys = kwargs.get('header_keys', None)
+    def collect_image(self, i, d_pos, d_image, header_keys=None):
+        """Collect an image at the current stage position, and start
+        looking for crystals in the background.
 
-        d_image = {
-            'exp_neutral_diffshift': self.neutral_beamshift,
-            'exp_neutral_beamshift': self.neutral_diffshift,
-            'exp_image_spotsize': self.image_spotsize,
-            'exp_magnification': self.magnification,
-            'ImageDimensions': self.image_dimensions,
-        }
-        d_diff = {
-            'exp_neutral_diffshift': self.neutral_beamshift,
-            'exp_neutral_beamshift': self.neutral_diffshift,
-            'exp_diff_brightness': self.diff_brightness,
-            'exp_diff_spotsize': self.diff_spotsize,
-            'exp_diff_cameralength': self.diff_cameralength,
-            'exp_diff_difffocus': self.diff_difffocus,
-            'ImagePixelsize': self.diff_pixelsize,
-        }
+        Returns a tuple (i, d_pos, img, h, future), where `future` gives
+        the crystal positions, or None if the image is too dark.
+        """
+        if self.change_spotsize:
+            self.ctrl.tem.setSpotSize(self.image_spotsize)
 
-        self.log.info('d_image', d_image)
-        self.log.info('d_tiff', d_diff)
+        img, h = self.ctrl.get_image(exposure=self.image_exposure, binsize=self.image_binsize, header_keys=header_keys)
 
-        input("\nPress <ENTER> to start experiment ('Ctrl-C' to interrupt)\n")
+        if self.change_spotsize:
+            self.ctrl.tem.setSpotSize(self.image_spotsize)
 
-        for i, d_pos in enumerate(self.loop_positions()):
+        self.ctrl.tem.setSpotSize(self.diff_spotsize)
 
-            outfile = self.imagedir / f'image_{i:04d}'
+        im_mean = img.mean()
+        if im_mean < self.image_threshold:
+            # self.log.debug("Dark image detected (mean=%f)", im_mean)
+            return None
 
-            if self.change_spotsize:
-                self.ctrl.tem.setSpotSize(self.image_spotsize)
+        img, h = self.apply_corrections(img, h)
 
-            img, h = self.ctrl.get_image(exposure=self.image_exposure, binsize=self.image_binsize, header_keys=header_keys)
+        for d in (d_image, d_pos):
+            h.update(d)
 
-            if self.change_spotsize:
-                self.ctrl.tem.setSpotSize(self.image_spotsize)
+        return i, d_pos, img, h, self.crystal_finder.submit(img)
 
-            self.ctrl.tem.setSpotSize(self.diff_spotsize)
+    def collect_crystals(self, pending, d_diff, header_keys=None):
+        """Write the images in `pending` (see `collect_image`) once the
+        crystals have been found, and collect the diffraction patterns.
 
-            im_mean = img.mean()
-            if im_mean < self.image_threshold:
-                # self.log.debug("Dark image detected (mean=%f)", im_mean)
-                continue
+        With `look_ahead`/`scan_ahead`, the stage is moved back to the
+        position of each image with crystals first. Returns True if the
+        stage was moved.
+        """
+        moved = False
 
-            img, h = self.apply_corrections(img, h)
+        for i, d_pos, img, h, future in pending:
+            outfile = self.imagedir / f'image_{i:04d}'
 
-            crystal_positions = self.find_crystals(img, self.magnification, spread=self.crystal_spread) * self.image_binsize
-            crystal_coords = [(crystal.x, crystal.y) for crystal in crystal_positions]
+            crystal_positions = future.result()
+            crystal_coords = [(crystal.x * self.image_binsize, crystal.y * self.image_binsize) for crystal in crystal_positions]
 
-            for d in (d_image, d_pos):
-                h.update(d)
             h['exp_crystal_coords'] = crystal_coords
 
-            write_hdf5(outfile, img, header=h)
+            self.write_image(outfile, img, h, stack='image')
 
             ncrystals = len(crystal_coords)
             if ncrystals == 0:
@@ -504,6 +532,10 @@ class Experiment:
 
             self.log.info('%d crystals found in %s', ncrystals, outfile)
 
+            if self.look_ahead or self.scan_ahead:
+                self.return_to_position(d_pos)
+                moved = True
+
             for k, d_cryst in enumerate(self.loop_crystals(crystal_coords)):
                 outfile = self.datadir / f'image_{i:04d}_{k:04d}'
                 comment = f'Image {i} Crystal {k}'
@@ -522,7 +554,7 @@ class Experiment:
                 # quality = neural_network.predict(img_processed)
                 # h["crystal_quality"] = quality
 
-                write_hdf5(outfile, img, header=h)
+                self.write_image(outfile, img, h, stack='data')
 
                 if self.sample_rotation_angles:
                     for rotation_angle in self.sample_rotation_angles:
@@ -536,12 +568,74 @@ class Experiment:
                         for d in (d_diff, d_pos, d_cryst):
                             h.update(d)
 
-                        write_hdf5(outfile, img, header=h)
+                        self.write_image(outfile, img, h, stack='data')
 
                     self.ctrl.stage.a = 0
 
             self.image_mode()
 
+        return moved
+
+    def run(self, ctrl=None, **kwargs):
+        """Run serial electron diffraction experiment."""
+
+        self.initialize_microscope()
+
+        header_keys = kwargs.get('header_keys', None)
+
+        d_image = {
+            'exp_neutral_diffshift': self.neutral_beamshift,
+            'exp_neutral_beamshift': self.neutral_diffshift,
+            'exp_image_spotsize': self.image_spotsize,
+            'exp_magnification': self.magnification,
+            'ImageDimensions': self.image_dimensions,
+        }
+        d_diff = {
+            'exp_neutral_diffshift': self.neutral_beamshift,
+            'exp_neutral_beamshift': self.neutral_diffshift,
+            'exp_diff_brightness': self.diff_brightness,
+            'exp_diff_spotsize': self.diff_spotsize,
+            'exp_diff_cameralength': self.diff_cameralength,
+            'exp_diff_difffocus': self.diff_difffocus,
+            'ImagePixelsize': self.diff_pixelsize,
+        }
+
+        self.log.info('d_image', d_image)
+        self.log.info('d_tiff', d_diff)
+
+        input("\nPress <ENTER> to start experiment ('Ctrl-C' to interrupt)\n")
+
+        if self.hdf5_stack:
+            self.image_stack = HDF5StackWriter(self.expdir / 'images.h5', mode='a')
+            self.data_stack = HDF5StackWriter(self.expdir / 'data.h5', mode='a')
+
+        pending = []
+
+        for i, d_pos in enumerate(self.loop_positions()):
+            if pending and d_pos['exp_scan_number'] != pending[-1][1]['exp_scan_number']:
+                # visit the positions of the previous scan area, and come back
+                if self.collect_crystals(pending, d_diff, header_keys=header_keys):
+                    self.return_to_position(d_pos)
+                pending = []
+
+            item = self.collect_image(i, d_pos, d_image, header_keys=header_keys)
+            if item is not None:
+                pending.append(item)
+
+            if not self.scan_ahead:
+                # the last `look_ahead` images are segmented while the stage moves on
+                n = len(pending) - self.look_ahead
+                if n > 0:
+                    self.collect_crystals(pending[:n], d_diff, header_keys=header_keys)
+                    pending = pending[n:]
+
+        self.collect_crystals(pending, d_diff, header_keys=header_keys)
+        self.crystal_finder.close()
+
+        if self.hdf5_stack:
+            self.image_stack.close()
+            self.data_stack.close()
+
         print('\n\nData collection finished.')
 
 
@@ -13,8 +13,14 @@ from .csvIO import read_csv
 from .csvIO import read_ycsv
 from .csvIO import write_csv
 from .csvIO import write_ycsv
+from .hdf5stack import HDF5StackReader
+from .hdf5stack import HDF5StackWriter
+from .metadata import TIFF_TAG
+from .metadata import decode_header
+from .metadata import encode_header
 from .mrc import read_image as read_mrc
 from .mrc import write_image as write_mrc
+from .xdscbf import read as read_cbf
 from .xdscbf import write as write_cbf
 
 
@@ -45,17 +51,43 @@ def write_tiff(fname: str, data, header: dict = None):
         numpy array containing image data
     header: dict,
         dictionary containing the metadata that should be saved
-        key/value pairs are stored as yaml in the TIFF ImageDescription tag
+        key/value pairs are stored as compact JSON in a private TIFF tag
+        (see `instamatic.formats.metadata`), or as yaml in the TIFF
+        ImageDescription tag if they cannot be encoded as JSON
     """
+    extratags = []
     if isinstance(header, dict):
-        header = yaml.dump(header)
+        try:
+            meta = encode_header(header)
+        except (TypeError, ValueError):
+            header = yaml.dump(header)
+        else:
+            extratags.append((TIFF_TAG, 7, len(meta), meta, True))
+            header = ''
     if not header:
         header = ''
 
     fname = Path(fname).with_suffix('.tiff')
 
     with tifffile.TiffWriter(fname) as f:
-        f.save(data=data, software='instamatic', description=header)
+        f.save(data=data, software='instamatic', description=header, extratags=extratags)
+
+
+def _read_tiff_header(tiff) -> dict:
+    page = tiff.pages[0]
+
+    if page.software == 'instamatic':
+        tag = page.tags.get(TIFF_TAG)
+        header = decode_header(tag.value) if tag else None
+        if header is None:
+            # legacy, header stored as yaml
+            header = yaml.load(page.tags['ImageDescription'].value, Loader=yaml.Loader)
+    elif tiff.is_tvips:
+        header = tiff.tvips_metadata
+    else:
+        header = {}
+
+    return header
 
 
 def read_tiff(fname: str) -> (np.array, dict):
@@ -68,19 +100,29 @@ def read_tiff(fname: str) -> (np.array, dict):
         image: np.ndarray, header: dict
             a tuple of the image as numpy array and dictionary with all the tem parameters and image attributes
     """
-    tiff = tifffile.TiffFile(fname)
+    with tifffile.TiffFile(fname) as tiff:
+        img = tiff.pages[0].asarray()
+        header = _read_tiff_header(tiff)
 
-    page = tiff.pages[0]
-    img = page.asarray()
+    return img, header
 
-    if page.software == 'instamatic':
-        header = yaml.load(page.tags['ImageDescription'].value, Loader=yaml.Loader)
-    elif tiff.is_tvips:
-        header = tiff.tvips_metadata
-    else:
-        header = {}
 
-    return img, header
+def read_tiff_headers(fnames: list) -> list:
+    """Read only the headers of a list of tiff files, without reading the
+    image data.
+
+    fnames: list,
+        paths or filenames to the images
+
+    Returns:
+        headers: list
+            list of the header dictionaries in the same order as `fnames`
+    """
+    headers = []
+    for fname in fnames:
+        with tifffile.TiffFile(fname) as tiff:
+            headers.append(_read_tiff_header(tiff))
+    return headers
 
 
 def write_hdf5(fname: str, data, header: dict = None):
@@ -118,8 +160,3 @@ def read_hdf5(fname: str) -> (np.array, dict):
 
     f = h5py.File(fname, 'r')
     return np.array(f['data']), dict(f['data'].attrs)
-
-
-def read_cbf(fname: str):
-    """CBF reader not implemented."""
-    raise NotImplementedError('CBF reader not implemented.')
@@ -19,13 +19,8 @@ def swap_needed(header: dict) -> bool:
         return True
 
 
-def write_adsc(fname: str, data: np.array, header: dict = {}):
-    """Write adsc format."""
-    if 'SIZE1' not in header and 'SIZE2' not in header:
-        dim2, dim1 = data.shape
-        header['SIZE1'] = dim1
-        header['SIZE2'] = dim2
-
+def format_header(header: dict) -> bytes:
+    """Format the adsc header, padded to a multiple of 512 bytes."""
     out = b'{\n'
     for key in header:
         out += '{:}={:};\n'.format(key, header[key]).encode()
@@ -39,6 +34,18 @@ def write_adsc(fname: str, data: np.array, header: dict = {}):
     out += b'}' + (pad + 1) * b'\x00'
     assert len(out) % 512 == 0, 'Header is not multiple of 512'
 
+    return out
+
+
+def write_adsc(fname: str, data: np.array, header: dict = {}):
+    """Write adsc format."""
+    if 'SIZE1' not in header and 'SIZE2' not in header:
+        dim2, dim1 = data.shape
+        header['SIZE1'] = dim1
+        header['SIZE2'] = dim2
+
+    out = format_header(header)
+
     # NOTE: XDS can handle only "SMV" images of TYPE=unsigned_short.
     dtype = np.uint16
     data = np.round(data, 0).astype(dtype, copy=False)  # copy=False ensures that no copy is made if dtype is already satisfied
@@ -50,6 +57,23 @@ def write_adsc(fname: str, data: np.array, header: dict = {}):
         outf.write(data.tostring())
 
 
+def update_adsc_header(fname: str, header: dict):
+    """Replace the header of an existing adsc file without touching the
+    image data.
+
+    The new header must have the same size (`HEADER_BYTES`) as the
+    header in the file.
+    """
+    out = format_header(header)
+
+    with open(fname, 'r+b') as f:
+        old = readheader(f)
+        if int(old['HEADER_BYTES']) != len(out):
+            raise ValueError(f'Header size of {fname} does not match ({old["HEADER_BYTES"]} != {len(out)})')
+        f.seek(0)
+        f.write(out)
+
+
 def readheader(infile):
     """read an adsc header."""
     header = {}
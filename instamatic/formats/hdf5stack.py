@@ -0,0 +1,390 @@
+"""Single-file HDF5 storage for image series (cRED/serialED).
+
+All frames are stored in one chunked (and optionally compressed) HDF5
+file with a NeXus-like layout, instead of writing one file per frame:
+
+    /entry                      NXentry
+    /entry/data                 (nframes, ny, nx), one chunk per frame
+    /entry/index                (nframes,) sequence number of the frame
+    /entry/metadata/<key>       (nframes,) one column per header key
+    /entry/metadata_types/<key> (nframes,) type of the values, only for
+                                numeric columns with mixed bool/int/float
+
+Numeric header values are stored as float64 columns (NaN if the value
+is absent for a frame), all other values (strings, tuples, dicts, ...)
+as JSON strings (empty if absent). Tuples are therefore read back as
+lists.
+
+Frames can be appended while the data are being collected, and read
+back in any order with `HDF5StackReader`:
+
+    with HDF5StackWriter('data.h5') as f:
+        for i, (img, h) in enumerate(frames, start=1):
+            f.append(img, h, index=i)
+
+    f = HDF5StackReader('data.h5')
+    img, h = f[10]
+"""
+import json
+import numbers
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+NUMBER = 'number'
+JSON = 'json'
+
+# Python types of numeric values, `metadata_types` stores the position in this list
+TYPES = ('bool', 'int', 'float')
+
+
+def _compression_kwargs(compression: str, compression_opts=None) -> dict:
+    """Return the keyword arguments for `h5py.Group.create_dataset` for the
+    given compression filter.
+
+    `gzip` and `lzf` are built into h5py, `lz4` and `bitshuffle` need
+    the `hdf5plugin` package.
+    """
+    if compression is None:
+        return {}
+    elif compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if compression_opts is None else compression_opts}
+    elif compression == 'lzf':
+        return {'compression': 'lzf'}
+    elif compression in ('lz4', 'bitshuffle'):
+        if hdf5plugin is None:
+            raise ImportError(f'Compression with `{compression}` requires the `hdf5plugin` package.')
+        if compression == 'lz4':
+            return dict(hdf5plugin.LZ4())
+        else:
+            return dict(hdf5plugin.Bitshuffle(cname='lz4'))
+    else:
+        raise ValueError(f"Unknown compression: {compression!r}, must be one of {{None, 'gzip', 'lzf', 'lz4', 'bitshuffle'}}")
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def _cast(value, kind: str):
+    if kind == 'int':
+        return int(value)
+    elif kind == 'bool':
+        return bool(value)
+    return float(value)
+
+
+def _type_name(value) -> str:
+    if isinstance(value, np.generic):
+        value = value.item()
+    name = type(value).__name__
+    return name if name in TYPES else 'float'
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (numbers.Number, np.number, np.bool_)) and not isinstance(value, complex)
+
+
+def _column_name(key: str) -> str:
+    """Header keys may contain `/`, which separates groups in HDF5."""
+    return str(key).replace('/', '|')
+
+
+class HDF5StackWriter:
+    """Append frames and their headers to a single HDF5 file.
+
+    fname:
+        Path to the HDF5 file
+    mode:
+        'w' to create a new file, 'a' to append to an existing file
+    compression:
+        None, 'gzip', 'lzf', 'lz4', or 'bitshuffle' (the last two need
+        `hdf5plugin`)
+    compression_opts:
+        Compression level for gzip (default: 4)
+
+    The data set is created when the first frame is appended, all frames
+    must have the same shape and dtype. The file is flushed after every
+    frame, so that the data collected so far can be recovered if the
+    acquisition is interrupted.
+    """
+
+    def __init__(self, fname: str, mode: str = 'w', compression: str = 'gzip', compression_opts=None):
+        super().__init__()
+        if mode not in ('w', 'a'):
+            raise ValueError(f"Invalid mode: {mode!r}, must be 'w' or 'a'")
+
+        self.fname = Path(fname)
+        self.compression = _compression_kwargs(compression, compression_opts)
+
+        self.f = h5py.File(self.fname, mode)
+        self.entry = self.f.require_group('entry')
+        self.entry.attrs.setdefault('NX_class', 'NXentry')
+        self.metadata = self.entry.require_group('metadata')
+
+        self.data = self.entry.get('data')
+        self.index = self.entry.get('index')
+
+    def __len__(self):
+        return 0 if self.data is None else self.data.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def _create_data(self, img: np.ndarray) -> None:
+        self.data = self.entry.create_dataset('data',
+                                              shape=(0, *img.shape),
+                                              maxshape=(None, *img.shape),
+                                              chunks=(1, *img.shape),
+                                              dtype=img.dtype,
+                                              **self.compression)
+        self.data.attrs['NX_class'] = 'NXdata'
+        self.index = self.entry.create_dataset('index', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,))
+
+    def _create_column(self, key: str, value, n: int):
+        if _is_number(value):
+            column = self.metadata.create_dataset(_column_name(key), shape=(n,), maxshape=(None,), dtype=np.float64,
+                                                  chunks=(1024,), fillvalue=np.nan)
+            column.attrs['kind'] = NUMBER
+            column.attrs['type'] = _type_name(value)
+        else:
+            column = self.metadata.create_dataset(_column_name(key), shape=(n,), maxshape=(None,), dtype=h5py.string_dtype(),
+                                                  chunks=(1024,))
+            column.attrs['kind'] = JSON
+        column.attrs['key'] = str(key)
+        return column
+
+    def _column_types(self, column, create: bool = False):
+        """Return the data set with the type of every value in `column`, if
+        the column has values of mixed types (i.e. int and float)."""
+        name = column.name.rsplit('/', 1)[-1]
+        types = self.entry.get('metadata_types')
+        if types is not None and name in types:
+            return types[name]
+        elif create:
+            types = self.entry.require_group('metadata_types')
+            return types.create_dataset(name, shape=column.shape, maxshape=(None,), dtype=np.int8,
+                                        chunks=(1024,), fillvalue=-1)
+        return None
+
+    def _column_to_json(self, column):
+        """Convert a numeric column to JSON, if a non-numeric value is
+        encountered for this key."""
+        name = column.name
+        key = column.attrs['key']
+        type_ = column.attrs['type']
+        values = column[:]
+
+        column_types = self._column_types(column)
+        if column_types is None:
+            types = [type_] * len(values)
+        else:
+            types = [TYPES[code] if code >= 0 else type_ for code in column_types[:]]
+            del self.f[column_types.name]
+
+        del self.f[name]
+
+        column = self._create_column(key, '', len(values))
+        column[:] = ['' if np.isnan(val) else json.dumps(_cast(val, kind)) for val, kind in zip(values, types)]
+        return column
+
+    def append(self, img: np.ndarray, header: dict = None, index: int = None) -> int:
+        """Append a frame with its header.
+
+        `index` is the sequence number of the frame, by default the
+        number of frames in the file + 1.
+
+        Returns the position of the frame in the file.
+        """
+        img = np.asarray(img)
+        if self.data is None:
+            self._create_data(img)
+        elif img.shape != self.data.shape[1:]:
+            raise ValueError(f'Frame shape {img.shape} does not match the data set {self.data.shape[1:]}')
+
+        n = len(self)
+        if index is None:
+            index = n + 1
+
+        self.data.resize(n + 1, axis=0)
+        self.data[n] = img
+        self.index.resize(n + 1, axis=0)
+        self.index[n] = index
+
+        header = header or {}
+
+        for column in self.metadata.values():
+            column.resize(n + 1, axis=0)
+        for column in self.entry.get('metadata_types', {}).values():
+            column.resize(n + 1, axis=0)
+
+        for key, value in header.items():
+            name = _column_name(key)
+            if name in self.metadata:
+                column = self.metadata[name]
+            else:
+                column = self._create_column(key, value, n + 1)
+
+            if column.attrs['kind'] == NUMBER:
+                if _is_number(value):
+                    type_ = _type_name(value)
+                    if type_ != column.attrs['type']:
+                        self._column_types(column, create=True)[n] = TYPES.index(type_)
+                    column[n] = value
+                    continue
+                column = self._column_to_json(column)
+
+            column[n] = json.dumps(value, default=_json_default)
+
+        self.f.flush()
+
+        return n
+
+    def flush(self) -> None:
+        self.f.flush()
+
+    def close(self) -> None:
+        self.f.close()
+
+
+class HDF5StackReader:
+    """Random access to the frames in a file written by `HDF5StackWriter`.
+
+    The metadata columns are read into memory when the file is opened,
+    the image data are read on demand.
+    """
+
+    def __init__(self, fname: str):
+        super().__init__()
+        self.fname = Path(fname)
+        if not self.fname.exists():
+            raise FileNotFoundError(f"No such file: '{fname}'")
+
+        self.f = h5py.File(self.fname, 'r')
+        entry = self.f['entry']
+        self.data = entry['data']
+        self.index = entry['index'][:]
+
+        types = entry.get('metadata_types', {})
+
+        self.columns = {}
+        for name, column in entry['metadata'].items():
+            column_types = types[name][:] if name in types else None
+            self.columns[column.attrs['key']] = (column.attrs['kind'], column.attrs.get('type'), column[:], column_types)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def __getitem__(self, n: int) -> (np.array, dict):
+        return self.read_frame(n)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.read_frame(n)
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    def read_header(self, n: int) -> dict:
+        """Return the header of the frame at position `n`."""
+        header = {}
+        for key, (kind, type_, values, types) in self.columns.items():
+            value = values[n]
+            if kind == NUMBER:
+                if not np.isnan(value):
+                    if types is not None and types[n] >= 0:
+                        type_ = TYPES[types[n]]
+                    header[key] = _cast(value, type_)
+            else:
+                value = _decode(value)
+                if value:
+                    header[key] = json.loads(value)
+        return header
+
+    def read_frame(self, n: int) -> (np.array, dict):
+        """Return the image and header of the frame at position `n`."""
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(f'Frame {n} out of range for {len(self)} frames')
+        return self.data[n], self.read_header(n)
+
+    def get_column(self, key: str) -> np.array:
+        """Return the values of header `key` for all frames.
+
+        Missing values are NaN for numeric columns and None otherwise.
+        """
+        kind, type_, values, types = self.columns[key]
+        if kind == NUMBER:
+            return values
+        return np.array([json.loads(_decode(val)) if val else None for val in values], dtype=object)
+
+    def to_buffer(self) -> list:
+        """Return the frames as an image buffer, a list of tuples (index,
+        image data, header), as used by `ImgConversion`.
+
+        This can be used to produce SMV/MRC/TIFF data on demand, i.e.
+        `ImgConversion(buffer=reader.to_buffer(), ...).threadpoolwriter(...)`.
+        """
+        return [(int(self.index[n]), *self.read_frame(n)) for n in range(len(self))]
+
+    def export(self, path: str, fmt: str = 'tiff', template: str = '{index:05d}') -> list:
+        """Write every frame to its own file in the directory `path`.
+
+        `fmt` is one of 'tiff', 'h5', or 'mrc', and `template` is
+        formatted with the header values, and the `index` and position
+        `n` of the frame to get the file name.
+
+        Returns the list of written files.
+        """
+        from instamatic.formats import write_hdf5
+        from instamatic.formats import write_mrc
+        from instamatic.formats import write_tiff
+
+        writers = {'tiff': write_tiff, 'h5': write_hdf5, 'mrc': write_mrc}
+        try:
+            writer = writers[fmt]
+        except KeyError:
+            raise ValueError(f"Unknown format: {fmt!r}, must be one of {set(writers)}") from None
+
+        path = Path(path)
+        path.mkdir(exist_ok=True, parents=True)
+
+        fns = []
+        for n in range(len(self)):
+            img, h = self.read_frame(n)
+            name = template.format(**{**h, 'index': self.index[n], 'n': n})
+            fn = path / f'{name}.{fmt}'
+            if fmt == 'mrc':
+                writer(fn, img)
+            else:
+                writer(fn, img, header=h)
+            fns.append(fn)
+        return fns
+
+    def close(self) -> None:
+        self.f.close()
@@ -0,0 +1,112 @@
+"""Compact encoding of image headers for the private instamatic TIFF tag.
+
+Headers are stored as JSON in TIFF tag `TIFF_TAG` (private range), which
+is much faster to write and read than the YAML used before in the
+`ImageDescription` tag (~0.1 ms vs several ms for a typical header),
+and does not need the unsafe `yaml.Loader` to read back:
+
+    {"version": 1, "header": {...}}
+
+Numpy scalars are stored as python numbers. Numpy arrays and tuples are
+tagged, so that they are restored as such:
+
+    {"__ndarray__": [[1, 2], [3, 4]], "dtype": "<i8"}
+    {"__tuple__": [1, 2]}
+    {"__datetime__": "2020-01-31T12:00:00.500000"}
+    {"__date__": "2020-01-31"}
+
+Headers that cannot be represented this way (e.g. non-string keys or
+arbitrary objects) are written as YAML in the `ImageDescription` tag,
+as before. `decode_header` returns None for data it does not recognize,
+so that the reader can fall back to YAML.
+"""
+import json
+import re
+from datetime import date
+from datetime import datetime
+
+import numpy as np
+
+TIFF_TAG = 65000
+VERSION = 1
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def _parse_datetime(s: str) -> datetime:
+    """Parse the output of `datetime.isoformat` (`datetime.fromisoformat`
+    needs Python 3.7)."""
+    # strptime (< 3.7) does not accept a colon in the UTC offset
+    s, n = re.subn(r'([+-]\d\d):(\d\d)$', r'\1\2', s)
+    tz = '%z' if n else ''
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(s, fmt + tz)
+        except ValueError:
+            pass
+    raise ValueError(f'Invalid datetime: {s!r}')
+
+
+def _encode(obj):
+    if isinstance(obj, dict):
+        if not all(isinstance(key, str) for key in obj):
+            raise TypeError('Header keys must be strings')
+        return {key: _encode(value) for key, value in obj.items()}
+    elif isinstance(obj, tuple):
+        return {'__tuple__': [_encode(value) for value in obj]}
+    elif isinstance(obj, list):
+        return [_encode(value) for value in obj]
+    elif isinstance(obj, np.ndarray):
+        return {'__ndarray__': obj.tolist(), 'dtype': obj.dtype.str}
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, datetime):
+        return {'__datetime__': obj.isoformat()}
+    elif isinstance(obj, date):
+        return {'__date__': obj.isoformat()}
+    elif obj is None or isinstance(obj, (str, bool, int, float)):
+        return obj
+    else:
+        raise TypeError(f'Cannot encode object of type {type(obj).__name__}')
+
+
+def _decode(obj):
+    if isinstance(obj, dict):
+        if '__tuple__' in obj:
+            return tuple(_decode(value) for value in obj['__tuple__'])
+        elif '__ndarray__' in obj:
+            return np.array(obj['__ndarray__'], dtype=obj['dtype'])
+        elif '__datetime__' in obj:
+            return _parse_datetime(obj['__datetime__'])
+        elif '__date__' in obj:
+            return datetime.strptime(obj['__date__'], '%Y-%m-%d').date()
+        return {key: _decode(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_decode(value) for value in obj]
+    return obj
+
+
+def encode_header(header: dict) -> bytes:
+    """Encode the header as compact JSON.
+
+    Raises TypeError if the header contains objects that cannot be
+    encoded.
+    """
+    return json.dumps({'version': VERSION, 'header': _encode(header)}, separators=(',', ':'), allow_nan=True).encode()
+
+
+def decode_header(data: bytes) -> dict:
+    """Decode a header written by `encode_header`.
+
+    Returns None if the data are not recognized or from a newer
+    version.
+    """
+    try:
+        meta = json.loads(data)
+    except ValueError:
+        return None
+
+    if not isinstance(meta, dict) or meta.get('version') != VERSION:
+        return None
+
+    return _decode(meta['header'])
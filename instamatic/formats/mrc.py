@@ -706,6 +706,229 @@ def write_image(filename, img, index=None, header=None, inplace=False):
         util.close(filename, f)
 
 
+class MRCStack:
+    """Stack of 2D images in a single MRC file, memory-mapped for random
+    access.
+
+    Use `MRCStack.open` to read (or modify) an existing file, and
+    `MRCStack.create` to write a new stack frame by frame. The file is
+    preallocated for `capacity` frames and grows as needed; the header
+    is updated and the file is truncated to the number of frames
+    written when the stack is closed.
+
+    Example::
+
+        with MRCStack.create('stack.mrc', shape=(516, 516), dtype=numpy.uint16) as stack:
+            for img in images:
+                stack.append(img)
+
+        stack = MRCStack.open('stack.mrc')
+        img = stack[10]
+        imgs = stack[10:20]
+    """
+
+    def __init__(self, filename, h, count, capacity, mode='r'):
+        super().__init__()
+        self.filename = filename
+        self.mode = mode
+        self._h = h
+        self._header = None
+        self.count = count
+        self.capacity = capacity
+
+        self.frame_shape = (int(h['ny'][0]), int(h['nx'][0]))
+        self.dtype = numpy.dtype(mrc2numpy[int(h['mode'][0])]).newbyteorder(h.dtype['nx'].byteorder)
+        self.offset = 1024 + int(h['nsymbt'][0])
+        self.frame_nbytes = self.frame_shape[0] * self.frame_shape[1] * self.dtype.itemsize
+
+        self._map()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({str(self.filename)!r}, shape={self.shape}, dtype={self.dtype})'
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    @classmethod
+    def open(cls, filename, mode='r', no_strict_mrc=False):
+        """Memory-map an existing MRC file.
+
+        :Parameters:
+
+        filename : str
+                   Name of the MRC file
+        mode : str
+               'r' for read-only, 'r+' to modify the frames in place
+        """
+        if mode not in ('r', 'r+'):
+            raise ValueError("Invalid mode: %r, must be 'r' or 'r+'" % mode)
+        h = read_mrc_header(filename, no_strict_mrc=no_strict_mrc)
+        count = int(h['nz'][0])
+
+        dtype = numpy.dtype(mrc2numpy[int(h['mode'][0])])
+        total = os.path.getsize(filename)
+        expected = 1024 + int(h['nsymbt'][0]) + int(h['nx'][0]) * int(h['ny'][0]) * count * dtype.itemsize
+        if total < expected:
+            raise util.InvalidHeaderException('file size < header: %d < %d' % (total, expected))
+
+        return cls(filename, h, count=count, capacity=count, mode=mode)
+
+    @classmethod
+    def create(cls, filename, shape, dtype, capacity=100, pixelsize=1.0):
+        """Create a new MRC stack for frames of `shape` (ny, nx) and `dtype`.
+
+        :Parameters:
+
+        filename : str
+                   Name of the output file
+        shape : tuple
+                Shape of a single frame
+        dtype : numpy.dtype
+                Data type of the frames, converted as in `write_image`
+        capacity : int
+                   Number of frames to preallocate
+        pixelsize : float
+                    Pixel size (apix) stored in the header
+        """
+        try:
+            dtype = numpy.dtype(mrc2numpy[numpy2mrc[numpy.dtype(dtype).type]])
+        except KeyError:
+            raise TypeError('Unsupported type for MRC writing: %s' % str(dtype))
+
+        ny, nx = shape
+        h = numpy.zeros(1, header_image_dtype)
+        util.update_header(h, mrc_defaults, ara2mrc)
+        h['nx'] = nx
+        h['ny'] = ny
+        h['nz'] = 0
+        h['mode'] = numpy2mrc[dtype.type]
+        h['mx'] = nx
+        h['my'] = ny
+        h['xlen'] = nx * pixelsize
+        h['ylen'] = ny * pixelsize
+        h['mapc'] = 1
+        h['mapr'] = 2
+        h['maps'] = 3
+        h['map'] = 'MAP'
+        h['byteorder'] = byteorderint2[sys.byteorder]
+        h['nlabels'] = 1
+        h['label0'] = 'Created by Instamatic'
+
+        capacity = max(int(capacity), 1)
+        with open(filename, 'wb') as f:
+            h.tofile(f)
+            f.truncate(1024 + capacity * nx * ny * dtype.itemsize)
+
+        stack = cls(filename, h, count=0, capacity=capacity, mode='w')
+        stack._pixelsize = pixelsize
+        stack._stats = [numpy.inf, -numpy.inf, 0.0]  # min, max, sum of means
+        return stack
+
+    def _map(self):
+        mode = 'r' if self.mode == 'r' else 'r+'
+        if self.capacity == 0:
+            self._mmap = numpy.empty((0, *self.frame_shape), dtype=self.dtype)
+        else:
+            self._mmap = numpy.memmap(self.filename, dtype=self.dtype, mode=mode, offset=self.offset,
+                                      shape=(self.capacity, *self.frame_shape))
+
+    @property
+    def data(self):
+        """Memory-mapped array with all frames (nframes, ny, nx)."""
+        return self._mmap[:self.count]
+
+    @property
+    def shape(self):
+        return (self.count, *self.frame_shape)
+
+    @property
+    def header(self):
+        """Header as a dict (see `read_header`), parsed on first access."""
+        if self._header is None:
+            self._header = read_header(self._h)
+            self._header['count'] = self.count
+        return self._header
+
+    def append(self, img):
+        """Add a frame to the end of the stack.
+
+        :Returns:
+
+        index : int
+                Index of the frame in the stack
+        """
+        if self.mode != 'w':
+            raise OSError('Stack is not opened for writing')
+        if img.shape != self.frame_shape:
+            raise ValueError('Frame shape %s does not match the stack %s' % (img.shape, self.frame_shape))
+
+        if self.count == self.capacity:
+            self._resize(self.capacity * 2)
+
+        index = self.count
+        self._mmap[index] = img
+        self.count += 1
+
+        stats = self._stats
+        stats[0] = min(stats[0], numpy.min(img))
+        stats[1] = max(stats[1], numpy.max(img))
+        stats[2] += numpy.mean(img)
+
+        return index
+
+    def _resize(self, capacity):
+        self._mmap.flush()
+        del self._mmap
+        with open(self.filename, 'rb+') as f:
+            f.truncate(self.offset + capacity * self.frame_nbytes)
+        self.capacity = capacity
+        self._map()
+
+    def flush(self):
+        """Write the data and the updated header to disk."""
+        if isinstance(self._mmap, numpy.memmap):
+            self._mmap.flush()
+        if self.mode != 'w':
+            return
+
+        h = self._h
+        h['nz'] = self.count
+        h['mz'] = self.count
+        h['zlen'] = self.count * self._pixelsize
+        if self.count:
+            h['amin'] = self._stats[0]
+            h['amax'] = self._stats[1]
+            h['amean'] = self._stats[2] / self.count
+        self._header = None
+
+        with open(self.filename, 'rb+') as f:
+            h.tofile(f)
+
+    def close(self):
+        """Flush and close the stack, the file is truncated to the frames
+        that have been written."""
+        if self._mmap is None:
+            return
+        self.flush()
+        del self._mmap
+        self._mmap = None
+        if self.mode == 'w':
+            with open(self.filename, 'rb+') as f:
+                f.truncate(self.offset + self.count * self.frame_nbytes)
+
+
 if __name__ == '__main__':
     import numpy as np
 
@@ -17,53 +17,132 @@ DATA_TYPES = {'signed 8-bit integer': 'int8',
 STARTER = b'\x0c\x1a\x04\xd5'
 
 
+# Byte offset escapes: (largest delta, escape prefix, dtype of the delta)
+# Deltas that do not fit in 1 byte are written as 0x80 followed by an
+# int16, -32768 (0x8000) escapes to an int32, and -2**31 to an int64.
+ESCAPES = (
+    (127, b'', '<i1'),
+    (32767, b'\x80', '<i2'),
+    (2147483647, b'\x80\x00\x80', '<i4'),
+    (None, b'\x80\x00\x80\x00\x00\x00\x80', '<i8'),
+)
+
+
 def compByteOffset(data):
     """Compress a dataset into a string using the byte_offet algorithm.
 
     :param data: ndarray
     :return: string/bytes with compressed data
 
+    The output is built in a single preallocated buffer: every delta is
+    classified by the number of bytes it needs, the offsets of all
+    elements follow from the cumulative sum of their sizes, and the
+    escape bytes and values of each class are scattered in one go.
+
     test = np.array([0,1,2,127,0,1,2,128,0,1,2,32767,0,1,2,32768,0,1,2,2147483647,0,1,2,2147483648,0,1,2,128,129,130,32767,32768,128,129,130,32768,2147483647,2147483648])
     """
     flat = np.ascontiguousarray(data.ravel(), np.int64)
-    delta = np.zeros_like(flat)
-    delta[0] = flat[0]
-    delta[1:] = flat[1:] - flat[:-1]
-    mask = abs(delta) > 127
-    exceptions = np.nonzero(mask)[0]
-    if np.little_endian:
-        byteswap = False
-    else:
-        byteswap = True
-    start = 0
-    binary_blob = b''
-    for stop in exceptions:
-        if stop - start > 0:
-            binary_blob += delta[start:stop].astype(np.int8).tostring()
-        exc = delta[stop]
-        absexc = abs(exc)
-        if absexc > 2147483647:  # 2**31-1
-            binary_blob += b'\x80\x00\x80\x00\x00\x00\x80'
-            if byteswap:
-                binary_blob += delta[stop:stop + 1].byteswap().tostring()
-            else:
-                binary_blob += delta[stop:stop + 1].tostring()
-        elif absexc > 32767:  # 2**15-1
-            binary_blob += b'\x80\x00\x80'
-            if byteswap:
-                binary_blob += delta[stop:stop + 1].astype(np.int32).byteswap().tostring()
-            else:
-                binary_blob += delta[stop:stop + 1].astype(np.int32).tostring()
-        else:  # >127
-            binary_blob += b'\x80'
-            if byteswap:
-                binary_blob += delta[stop:stop + 1].astype(np.int16).byteswap().tostring()
-            else:
-                binary_blob += delta[stop:stop + 1].astype(np.int16).tostring()
-        start = stop + 1
-    if start < delta.size:
-        binary_blob += delta[start:].astype(np.int8).tostring()
-    return binary_blob
+    delta = np.empty_like(flat)
+    delta[:1] = flat[:1]
+    np.subtract(flat[1:], flat[:-1], out=delta[1:])
+
+    absdelta = np.abs(delta)
+    classes = np.zeros(delta.size, dtype=np.uint8)
+    for limit, _, _ in ESCAPES[:-1]:
+        classes += absdelta > limit
+
+    sizes = np.array([len(prefix) + np.dtype(dtype).itemsize for _, prefix, dtype in ESCAPES])
+    lengths = sizes[classes]
+    offsets = np.cumsum(lengths) - lengths
+
+    out = np.empty(int(lengths.sum()), dtype=np.uint8)
+
+    # the common case, a 1-byte delta, does not need fancy indexing
+    small = classes == 0
+    out[offsets[small]] = delta[small].astype(np.int8).view(np.uint8)
+
+    for cls, (_, prefix, dtype) in enumerate(ESCAPES[1:], start=1):
+        sel = classes == cls
+        if not sel.any():
+            continue
+        values = delta[sel].astype(dtype).view(np.uint8).reshape(-1, np.dtype(dtype).itemsize)
+        block = np.hstack((np.broadcast_to(np.frombuffer(prefix, dtype=np.uint8), (len(values), len(prefix))), values))
+        out[offsets[sel, np.newaxis] + np.arange(block.shape[1])] = block
+
+    return out.tobytes()
+
+
+def decByteOffset(stream, size: int, dtype='int64'):
+    """Decompress a byte_offset compressed string.
+
+    :param stream: bytes with the compressed data
+    :param size: number of elements
+    :param dtype: data type of the output array
+    :return: 1D ndarray
+
+    Every 0x80 byte in the stream could start an escaped delta, but
+    some of them are part of the value of a preceding escaped delta.
+    The length of the delta starting at each 0x80 byte gives the next
+    escape that starts a delta, and the chain of escapes from the first
+    one is followed by pointer jumping. The bytes that are not covered
+    by the escaped deltas are the 1-byte deltas.
+    """
+    raw = np.frombuffer(stream, dtype=np.uint8)
+    nbytes = len(raw)
+
+    # pad, so that the widest delta can be read at every escape
+    padded = np.zeros(nbytes + 15, dtype=np.uint8)
+    padded[:nbytes] = raw
+
+    def read_at(offsets, dtype_):
+        itemsize = np.dtype(dtype_).itemsize
+        return padded[offsets[:, np.newaxis] + np.arange(itemsize)].view(dtype_).ravel()
+
+    escapes = np.flatnonzero(raw == 0x80)
+    nesc = len(escapes)
+
+    # length and value of the delta, if an escaped delta starts at the escape
+    lengths = np.full(nesc, 15, dtype=np.int64)
+    values = read_at(escapes + 7, '<i8')
+    for _, prefix, dtype_ in ESCAPES[2:0:-1]:
+        value = read_at(escapes + len(prefix), dtype_)
+        sel = value != np.iinfo(dtype_).min
+        lengths[sel] = len(prefix) + np.dtype(dtype_).itemsize
+        values[sel] = value[sel]
+
+    # the first escape starts a delta, and every escape starts the next one
+    # that is not covered by the delta before it; `nesc` marks the end
+    jump = np.append(np.searchsorted(escapes, escapes + lengths), nesc)
+    jumps = [jump]
+    while 2**len(jumps) < nesc:
+        jump = jump[jump]
+        jumps.append(jump)
+
+    starts = np.zeros(min(nesc, 1), dtype=np.int64)
+    for jump in reversed(jumps):
+        nxt = jump[starts]
+        starts = np.concatenate((starts, nxt[nxt < nesc]))
+    starts.sort()
+
+    # bytes that are part of an escaped delta, except for the first one
+    covered = np.zeros(nbytes + 16, dtype=np.int64)
+    covered[escapes[starts] + 1] += 1
+    covered[escapes[starts] + lengths[starts]] -= 1
+    positions = np.flatnonzero(np.cumsum(covered[:nbytes]) == 0)
+
+    if len(positions) < size:
+        raise ValueError(f'Compressed stream ended after {len(positions)} of {size} elements')
+
+    delta = raw[positions[:size]].view(np.int8).astype(np.int64)
+
+    escaped = np.searchsorted(positions[:size], escapes[starts])
+    sel = escaped < size
+    escaped, starts = escaped[sel], starts[sel]
+    if len(starts) and escapes[starts[-1]] + lengths[starts[-1]] > nbytes:
+        raise ValueError(f'Compressed stream ended after {size - 1} of {size} elements')
+    delta[escaped] = values[starts]
+
+    return np.cumsum(delta).astype(dtype)
 
 
 def write(fname, data, header={}):
@@ -95,13 +174,13 @@ def write(fname, data, header={}):
                     b'Content-Type: application/octet-stream;',
                     b'     conversions="x-CBF_BYTE_OFFSET"',
                     b'Content-Transfer-Encoding: BINARY',
-                    np.string_('X-Binary-Size: %d' % (len(binary_blob))),
+                    b'X-Binary-Size: %d' % (len(binary_blob)),
                     b'X-Binary-ID: 1',
-                    np.string_('X-Binary-Element-Type: "%s"' % (dtype)),
+                    b'X-Binary-Element-Type: "%s"' % (dtype.encode()),
                     b'X-Binary-Element-Byte-Order: LITTLE_ENDIAN',
-                    np.string_('X-Binary-Number-of-Elements: %d' % (dim1 * dim2)),
-                    np.string_('X-Binary-Size-Fastest-Dimension: %d' % dim1),
-                    np.string_('X-Binary-Size-Second-Dimension: %d' % dim2),
+                    b'X-Binary-Number-of-Elements: %d' % (dim1 * dim2),
+                    b'X-Binary-Size-Fastest-Dimension: %d' % dim1,
+                    b'X-Binary-Size-Second-Dimension: %d' % dim2,
                     b'X-Binary-Size-Padding: 1',
                     b'',
                     STARTER + binary_blob,
@@ -113,6 +192,54 @@ def write(fname, data, header={}):
         out_file.write(cbf)
 
 
+def read(fname):
+    """Read a byte_offset compressed CBF file.
+
+    :param str fname: name of the file
+    :return: image as ndarray, dict with the binary section headers
+        (`X-Binary-*`, `Content-*`) and the `_array_data.header_contents`
+    """
+    with open(fname, 'rb') as f:
+        cbf = f.read()
+
+    start = cbf.find(STARTER)
+    if start < 0:
+        raise OSError(f'Cannot read `{fname}`, no binary section found')
+
+    if b'x-CBF_BYTE_OFFSET' not in cbf[:start]:
+        raise OSError(f'Cannot read `{fname}`, only byte_offset compression is supported')
+
+    text = cbf[:start].decode(errors='replace')
+
+    header = {}
+    contents = []
+    delimiters = 0  # the header contents are enclosed by lines starting with `;`
+    for line in text.splitlines():
+        if line.startswith('_array_data.header_contents'):
+            delimiters = 1
+        elif 0 < delimiters < 3:
+            if line.startswith(';'):
+                delimiters += 1
+            elif delimiters == 2:
+                contents.append(line)
+        elif ':' in line and not line.startswith('#'):
+            key, value = line.split(':', 1)
+            header[key.strip()] = value.strip().strip('"')
+
+    header['header_contents'] = '\n'.join(contents)
+
+    dtype = DATA_TYPES.get(header.get('X-Binary-Element-Type'), 'int32')
+    size = int(header['X-Binary-Number-of-Elements'])
+    dim1 = int(header['X-Binary-Size-Fastest-Dimension'])
+    dim2 = int(header.get('X-Binary-Size-Second-Dimension', size // dim1))
+
+    start += len(STARTER)
+    nbytes = int(header.get('X-Binary-Size', len(cbf) - start))
+    data = decByteOffset(cbf[start:start + nbytes], size, dtype=dtype)
+
+    return data.reshape(dim2, dim1), header
+
+
 if __name__ == '__main__':
     arr = np.arange(128 * 128).reshape(128, 128)
     write('a.cbf', arr)
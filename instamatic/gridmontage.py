@@ -101,11 +101,17 @@ class GridMontage:
         print(f'  Spot size: {self.spotsize}')
         print(f'  Binning: {self.binning}')
 
-    def start(self):
-        """Start the experiment."""
+    def start(self, plan_path: bool = False):
+        """Start the experiment.
+
+        plan_path : bool
+            Visit the grid positions in the order that minimizes the stage
+            travel instead of the order of the grid. The images are stored
+            in the order of the grid.
+        """
         ctrl = self.ctrl
 
-        buffer = []
+        buffer = {}
 
         def eliminate_backlash(ctrl):
             print('Attempting to eliminate backlash...')
@@ -113,7 +119,7 @@ class GridMontage:
 
         def acquire_image(ctrl):
             img, h = ctrl.get_image()
-            buffer.append((img, h))
+            buffer[ctrl.current_i] = (img, h)
 
         def post_acquire(ctrl):
             pass
@@ -121,9 +127,10 @@ class GridMontage:
         ctrl.acquire_at_items(self.stagecoords,
                               acquire=acquire_image,
                               pre_acquire=eliminate_backlash,
-                              post_acquire=None)
+                              post_acquire=None,
+                              plan_path=plan_path)
 
-        self.buffer = buffer
+        self.buffer = [buffer[i] for i in sorted(buffer)]
 
         self.save()
 
@@ -6,8 +6,8 @@ Should be generally applicable.
 import time
 from datetime import datetime
 
-from instamatic.formats import read_tiff
 from instamatic.formats import write_tiff
+from instamatic.processing.flatfield import get_flatfield_corrector
 
 
 def microscope_control(controller, **kwargs):
@@ -40,12 +40,15 @@ def save_image(controller, **kwargs):
     timestamp = datetime.now().strftime('%H-%M-%S.%f')[:-3]  # cut last 3 digits for ms resolution
     outfile = drc / f'frame_{timestamp}.tiff'
 
-    try:
-        flatfield, h = read_tiff(module_io.get_flatfield())
-        frame = apply_flatfield_correction(frame, flatfield)
-    except BaseException:
-        frame = frame
-        h = {}
+    h = {}
+    flatfield = module_io.get_flatfield()
+    if flatfield:
+        try:
+            frame = get_flatfield_corrector(flatfield)(frame)
+        except OSError as e:
+            print(f'Flatfield not applied: {e}')
+        else:
+            h['FlatfieldCorrection'] = True
 
     write_tiff(outfile, frame, header=h)
     print('Wrote file:', outfile)
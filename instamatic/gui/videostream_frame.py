@@ -12,7 +12,6 @@ from PIL import ImageTk
 from .base_module import BaseModule
 from instamatic.formats import read_tiff
 from instamatic.formats import write_tiff
-from instamatic.processing.flatfield import apply_flatfield_correction
 from instamatic.utils.spinbox import Spinbox
 
 
@@ -2,23 +2,43 @@ import pickle
 from pathlib import Path
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 with open(Path(__file__).parent / 'weights-py3.p', 'rb') as p_file:
-    weights = pickle.load(p_file)
+    weights = [np.asarray(weight, dtype=np.float32) for weight in pickle.load(p_file)]
 
+# number of images that are processed at once, limits the memory used by
+# the im2col matrices (~12 MB per image for the second layer)
+BATCH_SIZE = 8
 
+
+def _as_batch(func):
+    """Allow layers that work on a batch of images (N, H, W, C) to be called
+    with a single image (H, W, C)."""
+    def wrapper(in_layer, *args):
+        if in_layer.ndim == 3:
+            return func(in_layer[np.newaxis], *args)[0]
+        return func(in_layer, *args)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+@_as_batch
 def conv_layer(in_layer, weight, offset):
-    first_layer = np.ones([(in_layer.shape[0] - 2) * (in_layer.shape[1] - 2), in_layer.shape[2], 3, 3])
-    q = 0
-    for n in range(in_layer.shape[0] - 2):
-        for p in range(in_layer.shape[1] - 2):
-            first_layer[q] = np.transpose(in_layer[n:n + 3, p:p + 3], [2, 0, 1])
-            q += 1
-    convoluted = np.tensordot(first_layer, weight, axes=(((2, 3, 1), (0, 1, 2))))
-    convoluted_reshaped = convoluted.reshape([in_layer.shape[0] - 2, in_layer.shape[1] - 2, 64])
-    convoluted_reshaped += offset
+    """3x3 convolution (valid) of `in_layer` (N, H, W, C).
 
-    return convoluted_reshaped
+    The 3x3 windows are taken as a strided view of the input (im2col),
+    which is contracted with the weights (3, 3, C, K) in a single
+    matrix product.
+    """
+    n, h, w, c = in_layer.shape
+    sn, sh, sw, sc = in_layer.strides
+    windows = as_strided(in_layer, shape=(n, h - 2, w - 2, 3, 3, c), strides=(sn, sh, sw, sh, sw, sc), writeable=False)
+    convoluted = np.tensordot(windows, weight, axes=((3, 4, 5), (0, 1, 2)))
+    convoluted += offset
+
+    return convoluted
 
 
 def relu(convoluted):
@@ -26,30 +46,47 @@ def relu(convoluted):
     return convoluted
 
 
+@_as_batch
 def max_pooling(convoluted):
-    pooled = np.ones((convoluted.shape[0] // 2, convoluted.shape[1] // 2, convoluted.shape[2]))
-    for n in range(convoluted.shape[0] // 2):
-        for p in range(convoluted.shape[1] // 2):
-            pooled[n, p] = np.amax(convoluted[n * 2:n * 2 + 2, p * 2:p * 2 + 2], axis=(0, 1))
-    return pooled
+    """2x2 max pooling of `convoluted` (N, H, W, C), an odd last row/column
+    is dropped."""
+    n, h, w, c = convoluted.shape
+    h, w = h // 2, w // 2
+    return convoluted[:, :h * 2, :w * 2].reshape(n, h, 2, w, 2, c).max(axis=(2, 4))
 
 
 def logistic(x):
     return 1 / (1 + np.exp(-x))
 
 
-def predict(image, weights=weights):
-    convoluted1 = relu(conv_layer(image, weights[0], weights[1]))
-    pooled1 = max_pooling(convoluted1)
-    convoluted2 = relu(conv_layer(pooled1, weights[2], weights[3]))
-    pooled2 = max_pooling(convoluted2)
-    convoluted3 = relu(conv_layer(pooled2, weights[4], weights[5]))
-    pooled3 = max_pooling(convoluted3)
-    convoluted4 = relu(conv_layer(pooled3, weights[6], weights[7]))
-    pooled4 = max_pooling(convoluted4)
-    convoluted5 = relu(conv_layer(pooled4, weights[8], weights[9]))
-    flattened = convoluted5.reshape((1, 1600))
+def _predict_batch(images, weights):
+    layer = images
+    for i in range(0, 8, 2):
+        layer = max_pooling(relu(conv_layer(layer, weights[i], weights[i + 1])))
+    convoluted5 = relu(conv_layer(layer, weights[8], weights[9]))
+    flattened = convoluted5.reshape((len(images), 1600))
     dense1 = relu(np.tensordot(flattened, weights[10], axes=(1, 0)) + weights[11])
     dense2 = relu(np.tensordot(dense1, weights[12], axes=(1, 0)) + weights[13])
     dense3 = np.tensordot(dense2, weights[14], axes=(1, 0)) + weights[15]
-    return logistic(dense3)[0][0]
+    return logistic(dense3)[:, 0]
+
+
+def predict(image, weights=weights, batch_size: int = BATCH_SIZE):
+    """Predict the crystal quality (0-1) from a preprocessed diffraction
+    pattern (150, 150, 1), see `preprocess`.
+
+    `image` can also be a stack of images (N, 150, 150, 1), in that case
+    an array with N predictions is returned. The images are processed in
+    batches of `batch_size`.
+    """
+    images = np.asarray(image, dtype=np.float32)
+    single = images.ndim == 3
+    if single:
+        images = images[np.newaxis]
+
+    predictions = np.concatenate([_predict_batch(images[i:i + batch_size], weights)
+                                  for i in range(0, len(images), batch_size)] or [np.empty(0, dtype=np.float32)])
+
+    if single:
+        return float(predictions[0])
+    return predictions
@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import logging
 import time
 from datetime import datetime
@@ -7,19 +8,30 @@ from math import cos
 import numpy as np
 
 from instamatic import config
+from instamatic.formats import HDF5StackReader
+from instamatic.formats import HDF5StackWriter
 from instamatic.formats import read_tiff
 from instamatic.formats import write_adsc
 from instamatic.formats import write_mrc
 from instamatic.formats import write_tiff
-from instamatic.processing.flatfield import apply_flatfield_correction
-from instamatic.processing.stretch_correction import affine_transform_ellipse_to_circle
-from instamatic.tools import find_beam_center
-from instamatic.tools import find_beam_center_with_beamstop
+from instamatic.formats.mrc import MRCStack
+from instamatic.processing.flatfield import FlatfieldCorrector
+from instamatic.processing.stretch_correction import get_displacement_maps
+from instamatic.tools import find_beam_centers
+from instamatic.tools import find_beam_centers_with_beamstop
 from instamatic.tools import find_subranges
 from instamatic.tools import to_xds_untrusted_area
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
 logger = logging.getLogger(__name__)
 
+# Shared memory block with the image stack, attached once per worker process
+_shared_frames = {}
+
 
 def rotation_axis_to_xyz(rotation_axis, invert=False, setting='xds'):
     """Convert rotation axis angle to XYZ vector compatible with 'xds', or
@@ -101,6 +113,56 @@ def get_calibrated_rotation_speed(val):
     return calibrated_value
 
 
+def _write_tiff_frame(fn, img, header: dict) -> None:
+    # PETS reads only 16bit unsignt integer TIFF
+    img = np.round(img, 0).astype(np.uint16)
+    write_tiff(fn, img, header=header)
+
+
+def _write_smv_frame(fn, img, header: dict) -> None:
+    img = np.ushort(img)
+    write_adsc(fn, img, header=header)
+
+
+def _to_red(img):
+    # for RED these need to be as integers
+    img = np.round(img, 0).astype(np.uint16)
+
+    # flip up/down because RED reads images from the bottom left corner
+    return np.flipud(img)
+
+
+def _write_mrc_frame(fn, img, header: dict = None) -> None:
+    write_mrc(fn, _to_red(img))
+
+
+FRAME_WRITERS = {
+    'tiff': _write_tiff_frame,
+    'smv': _write_smv_frame,
+    'mrc': _write_mrc_frame,
+}
+
+
+def _attach_shared_frames(name: str, shape: tuple, dtype: str) -> None:
+    """Initializer for the worker processes of `threadpoolwriter`, attaches
+    to the shared memory block with the image stack."""
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_frames['shm'] = shm
+    _shared_frames['stack'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _write_shared_frame(index: int, jobs: list) -> list:
+    """Write frame `index` of the shared image stack, `jobs` is a list of
+    tuples (format, filename, header).
+
+    Returns the list of written files.
+    """
+    img = _shared_frames['stack'][index]
+    for fmt, fn, header in jobs:
+        FRAME_WRITERS[fmt](fn, img, header)
+    return [fn for fmt, fn, header in jobs]
+
+
 class ImgConversion:
     """This class is for post RED/cRED data collection image conversion. Files
     can be generated for REDp, DIALS, XDS, and PETS.
@@ -123,6 +185,7 @@ class ImgConversion:
         if flatfield is not None:
             flatfield, h = read_tiff(flatfield)
         self.flatfield = flatfield
+        self.flatfield_corrector = FlatfieldCorrector(flatfield) if flatfield is not None else None
 
         self.headers = {}
         self.data = {}
@@ -135,7 +198,7 @@ class ImgConversion:
             self.headers[i] = h
 
             if self.flatfield is not None:
-                self.data[i] = apply_flatfield_correction(img, self.flatfield)
+                self.data[i] = self.flatfield_corrector(img)
             else:
                 self.data[i] = img
 
@@ -179,6 +242,18 @@ class ImgConversion:
         self.mean_beam_center, self.beam_center_std = self.get_beam_centers()
         logger.debug(f'Primary beam at: {self.mean_beam_center}')
 
+    @classmethod
+    def from_hdf5_stack(cls, fname: str, **kwargs) -> 'ImgConversion':
+        """Set up the conversion from the frames in the HDF5 stack `fname`,
+        so that the per-frame formats can be produced on demand, i.e.
+        `ImgConversion.from_hdf5_stack('data.h5', ...).threadpoolwriter(smv_path=...)`.
+
+        The remaining keyword arguments are passed to the class.
+        """
+        with HDF5StackReader(fname) as f:
+            buffer = f.to_buffer()
+        return cls(buffer=buffer, **kwargs)
+
     def check_settings(self) -> None:
         """Check for the presence of all required attributes.
 
@@ -232,20 +307,19 @@ class ImgConversion:
         """Obtain beam centers from the diffraction data Returns a tuple with
         the median beam center and its standard deviation."""
         shape_x, shape_y = self.data_shape
-        centers = []
-        for i, h in self.headers.items():
-            if self.use_beamstop:
-                cx, cy = find_beam_center_with_beamstop(self.data[i], z=99)
-            else:
-                cx, cy = find_beam_center(self.data[i], sigma=10)
+        imgs = [self.data[i] for i in self.headers]
+        if self.use_beamstop:
+            centers = find_beam_centers_with_beamstop(imgs, z=99)
+        else:
+            centers = find_beam_centers(imgs, sigma=10)
 
-            if invert_x:
-                cx = shape_x - cx
-            if invert_y:
-                cy = shape_y - cy
+        if invert_x:
+            centers[:, 0] = shape_x - centers[:, 0]
+        if invert_y:
+            centers[:, 1] = shape_y - centers[:, 1]
 
+        for (cx, cy), h in zip(centers, self.headers.values()):
             h['beam_center'] = (cx, cy)
-            centers.append((cx, cy))
 
         self._beam_centers = beam_centers = np.array(centers)
 
@@ -268,24 +342,11 @@ class ImgConversion:
         """
         from instamatic.formats import write_cbf
 
-        center = np.array(self.mean_beam_center)
-
-        amplitude_pc = self.stretch_amplitude / (2 * 100)
-
         # To create the correct corrections the azimuth is mirrored
-        azimuth_rad = np.radians(180 - self.stretch_azimuth)
-
-        shape = self.data_shape
-
-        xi, yi = np.mgrid[0:shape[0], 0:shape[1]]
-        coords = np.stack([xi.flatten(), yi.flatten()], axis=1) - center
-
-        s = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
-
-        new = np.dot(coords, s)
-
-        xcorr = (new[:, 0].reshape(shape) + center[0]) - xi
-        ycorr = (new[:, 1].reshape(shape) + center[1]) - yi
+        xcorr, ycorr = get_displacement_maps(self.data_shape,
+                                             center=self.mean_beam_center,
+                                             azimuth=180 - self.stretch_azimuth,
+                                             amplitude=self.stretch_amplitude)
 
         # reverse XY coordinates for XDS
         xcorr, ycorr = ycorr, xcorr
@@ -329,12 +390,21 @@ class ImgConversion:
 
         logger.debug(f'MRC files created in folder: {path}')
 
-    def threadpoolwriter(self, tiff_path: str = None, smv_path: str = None, mrc_path: str = None, workers: int = 8) -> None:
+    def threadpoolwriter(self, tiff_path: str = None, smv_path: str = None, mrc_path: str = None, workers: int = 8,
+                         executor: str = 'thread', hdf5_stack: str = None, mrc_stack: str = None) -> None:
         """Efficiently write all data to the specified formats using a
         threadpool.
 
         If a path is given, write data in the corresponding format, i.e.
         if `tiff_path` is specified TIFF files are written to that path.
+        `hdf5_stack` and `mrc_stack` give the file names to write all
+        data to a single HDF5 or MRC stack file.
+
+        `executor` selects the backend, 'thread' or 'process'. Most of
+        the work of converting and writing the images holds the GIL,
+        so the 'process' backend scales better with the number of
+        `workers`. The images are passed to the worker processes via
+        shared memory.
         """
         write_tiff = tiff_path is not None
         write_smv = smv_path is not None
@@ -353,20 +423,90 @@ class ImgConversion:
             mrc_path.mkdir(exist_ok=True, parents=True)
             logger.debug(f'MRC files saved in folder: {mrc_path}')
 
-        import concurrent.futures
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            futures = []
-            for i in self.observed_range:
+        if executor == 'process' and shared_memory is None:
+            logger.warning('Shared memory is not available (python < 3.8), using threads to write data')
+            executor = 'thread'
+
+        if executor == 'thread':
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = []
+                for i in self.observed_range:
+
+                    if write_tiff:
+                        futures.append(executor.submit(self.write_tiff, tiff_path, i))
+                    if write_mrc:
+                        futures.append(executor.submit(self.write_mrc, mrc_path, i))
+                    if write_smv:
+                        futures.append(executor.submit(self.write_smv, smv_path, i))
+
+                for future in futures:
+                    ret = future.result()
+        elif executor == 'process':
+            self._processpoolwriter(tiff_path=tiff_path if write_tiff else None,
+                                    smv_path=smv_path if write_smv else None,
+                                    mrc_path=mrc_path if write_mrc else None,
+                                    workers=workers)
+        else:
+            raise ValueError(f"Unknown executor: {executor!r}, must be one of {{'thread', 'process'}}")
+
+        if hdf5_stack is not None:
+            self.write_hdf5_stack(hdf5_stack)
+            logger.debug(f'HDF5 stack saved to: {hdf5_stack}')
 
-                if write_tiff:
-                    futures.append(executor.submit(self.write_tiff, tiff_path, i))
-                if write_mrc:
-                    futures.append(executor.submit(self.write_mrc, mrc_path, i))
-                if write_smv:
-                    futures.append(executor.submit(self.write_smv, smv_path, i))
+        if mrc_stack is not None:
+            self.write_mrc_stack(mrc_stack)
+            logger.debug(f'MRC stack saved to: {mrc_stack}')
 
-            for future in futures:
-                ret = future.result()
+    def _processpoolwriter(self, tiff_path: str = None, smv_path: str = None, mrc_path: str = None, workers: int = 8) -> None:
+        """Write all data using a pool of worker processes.
+
+        The images are copied once to a shared memory block, so that
+        only the file names and headers are sent to the workers.
+        """
+        indices = sorted(self.observed_range)
+        dtype = np.result_type(*(self.data[i] for i in indices))
+        shape = (len(indices), *self.data_shape)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        try:
+            stack = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            for n, i in enumerate(indices):
+                stack[n] = self.data[i]
+            del stack
+
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                        initializer=_attach_shared_frames,
+                                                        initargs=(shm.name, shape, dtype.str)) as executor:
+                futures = []
+                for n, i in enumerate(indices):
+                    jobs = []
+                    if tiff_path:
+                        jobs.append(('tiff', tiff_path / f'{i:05d}.tiff', self.headers[i]))
+                    if mrc_path:
+                        jobs.append(('mrc', mrc_path / f'{i:05d}.mrc', None))
+                    if smv_path:
+                        jobs.append(('smv', smv_path / f'{i:05d}.img', self.get_smv_header(i, self.data_shape)))
+                    futures.append(executor.submit(_write_shared_frame, n, jobs))
+
+                for future in futures:
+                    ret = future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def write_mrc_stack(self, fname: str) -> None:
+        """Write all data to a single MRC stack `fname`, with the same
+        conversion as `write_mrc`, in order of the sequence number."""
+        with MRCStack.create(fname, shape=self.data_shape, dtype=np.uint16, capacity=len(self.observed_range)) as stack:
+            for i in sorted(self.observed_range):
+                stack.append(_to_red(self.data[i]))
+
+    def write_hdf5_stack(self, fname: str, compression: str = 'gzip') -> None:
+        """Write all data to a single HDF5 file `fname`, see
+        `instamatic.formats.hdf5stack`."""
+        with HDF5StackWriter(fname, compression=compression) as f:
+            for i in sorted(self.observed_range):
+                f.append(self.data[i], self.headers[i], index=i)
 
     def to_dials(self, smv_path: str) -> None:
         """Convert the buffer to output compatible with DIALS.
@@ -384,7 +524,7 @@ class ImgConversion:
         path = smv_path / self.smv_subdrc
 
         i = min(observed_range)
-        empty = np.zeros_like(self.data[i])
+        empty = np.zeros(self.data_shape, dtype=np.uint16)
         # copy header from first frame
         h = self.headers[i].copy()
         h['ImageGetTime'] = time.time()
@@ -408,14 +548,8 @@ class ImgConversion:
 
         Returns the path to the written image.
         """
-        img = self.data[i]
-        h = self.headers[i]
-
-        # PETS reads only 16bit unsignt integer TIFF
-        img = np.round(img, 0).astype(np.uint16)
-
         fn = path / f'{i:05d}.tiff'
-        write_tiff(fn, img, header=h)
+        _write_tiff_frame(fn, self.data[i], self.headers[i])
         return fn
 
     def write_smv(self, path: str, i: int) -> str:
@@ -425,10 +559,19 @@ class ImgConversion:
         Returns the path to the written image.
         """
         img = self.data[i]
+
+        header = self.get_smv_header(i, img.shape)
+
+        fn = path / f'{i:05d}.img'
+        _write_smv_frame(fn, img, header)
+        return fn
+
+    def get_smv_header(self, i: int, shape: tuple) -> dict:
+        """Return the SMV header for the image with sequence number `i` and
+        shape `shape`."""
         h = self.headers[i]
 
-        img = np.ushort(img)
-        shape_x, shape_y = img.shape
+        shape_x, shape_y = shape
 
         phi = self.start_angle + self.osc_angle * (i - 1)
 
@@ -468,9 +611,8 @@ class ImgConversion:
         header['BEAM_CENTER_Y'] = f'{mean_beam_center[0]:.4f}'
         header['DENZO_X_BEAM'] = f'{mean_beam_center[0]*self.physical_pixelsize:.4f}'
         header['DENZO_Y_BEAM'] = f'{mean_beam_center[1]*self.physical_pixelsize:.4f}'
-        fn = path / f'{i:05d}.img'
-        write_adsc(fn, img, header=header)
-        return fn
+
+        return header
 
     def write_mrc(self, path: str, i: int) -> str:
         """Write the image+header with sequence number `i` to the directory
@@ -478,25 +620,8 @@ class ImgConversion:
 
         Returns the path to the written image.
         """
-        img = self.data[i]
-
         fn = path / f'{i:05d}.mrc'
-
-        # for RED these need to be as integers
-        dtype = np.uint16
-        if False:
-            # Use maximum range available in data type for extra precision when converting from FLOAT to INT
-            dynamic_range = 11900  # a little bit higher just in case
-            maxval = np.iinfo(dtype).max
-            img = (img / dynamic_range) * maxval
-
-        img = np.round(img, 0).astype(dtype)
-
-        # flip up/down because RED reads images from the bottom left corner
-        img = np.flipud(img)
-
-        write_mrc(fn, img)
-
+        _write_mrc_frame(fn, self.data[i])
         return fn
 
     def write_ed3d(self, path: str) -> None:
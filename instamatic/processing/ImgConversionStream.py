@@ -0,0 +1,206 @@
+import concurrent.futures
+import threading
+from pathlib import Path
+
+from .ImgConversionTPX import *
+from instamatic.formats import HDF5StackWriter
+from instamatic.formats.adscimage import update_adsc_header
+
+
+class ImgConversionStream(ImgConversionTPX):
+    """Incremental version of `ImgConversionTPX` that converts and writes
+    the data while they are being collected.
+
+    Frames are added one at a time with `add_frame` (or `append`, so
+    that the instance can be used in place of the buffer list). The
+    flatfield correction, beam center search, and writing of the
+    TIFF/SMV/MRC files are done in the background, after which the
+    image data are released. Because the oscillation angle and the
+    mean beam center are not known until the end of the data
+    collection, the SMV files are written with a provisional header,
+    which is updated in `finalize`. The input files for XDS/DIALS/REDp/
+    PETS can be written after calling `finalize`.
+
+    Usage:
+        img_conv = ImgConversionStream(start_angle=..., rotation_axis=..., smv_path=...)
+        for i, img, h in frames:
+            img_conv.add_frame(i, img, h)
+        img_conv.finalize(osc_angle=..., end_angle=..., acquisition_time=..., pixelsize=...)
+        img_conv.write_xds_inp(smv_path)
+
+    If the data collection is aborted, `discard` removes the files that
+    have been written so far.
+    """
+
+    def __init__(self,
+                 start_angle: float,                # degrees, start angle of the rotation
+                 rotation_axis: float,              # radians, specifies the position of the rotation axis
+                 flatfield: str = 'flatfield.tiff',
+                 physical_pixelsize: float = None,  # mm, physical size of the pixels
+                 wavelength: float = None,          # Angstrom, relativistic wavelength of the electron beam
+                 stretch_amplitude=0.0,             # Stretch correction amplitude, %
+                 stretch_azimuth=0.0,               # Stretch correction azimuth, degrees
+                 tiff_path: str = None,
+                 smv_path: str = None,
+                 mrc_path: str = None,
+                 hdf5_path: str = None,
+                 workers: int = 4,
+                 ):
+        self.setup_camera(flatfield=flatfield,
+                          physical_pixelsize=physical_pixelsize,
+                          wavelength=wavelength,
+                          stretch_amplitude=stretch_amplitude,
+                          stretch_azimuth=stretch_azimuth)
+
+        self.observed_range = set()
+        self.complete_range = set()
+        self.missing_range = set()
+
+        self.data_shape = None
+        self.pixelsize = None
+
+        self._beam_centers = {}
+        self.mean_beam_center = None
+        self.beam_center_std = None
+
+        # provisional values, until `finalize` is called
+        self.distance = 0.0
+        self.osc_angle = 0.0
+        self.start_angle = start_angle
+        self.end_angle = start_angle
+        self.rotation_axis = rotation_axis
+        self.acquisition_time = 0.0
+
+        self.tiff_path = tiff_path
+        self.mrc_path = mrc_path
+        self.smv_path = smv_path / self.smv_subdrc if smv_path else None
+
+        for path in (self.tiff_path, self.mrc_path, self.smv_path):
+            if path:
+                path.mkdir(exist_ok=True, parents=True)
+
+        self.hdf5_path = hdf5_path
+        self.hdf5 = HDF5StackWriter(hdf5_path) if hdf5_path else None
+        self.files = []  # written files, see `discard`
+        self.hdf5_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.futures = []
+
+    def __len__(self):
+        return len(self.headers)
+
+    def append(self, item: tuple) -> None:
+        """Add a frame as a tuple (index, image data, header), so that the
+        instance can be used in place of a buffer list."""
+        self.add_frame(*item)
+
+    def add_frame(self, i: int, img, h: dict) -> concurrent.futures.Future:
+        """Add the frame with sequence number `i` (starting at 1), image
+        data `img`, and header `h`.
+
+        Returns immediately, the frame is processed and written in the
+        background.
+        """
+        with self.lock:
+            self.headers[i] = h
+            self.observed_range.add(i)
+            if self.data_shape is None:
+                self.data_shape = img.shape
+
+        future = self.executor.submit(self.process_frame, i, img)
+        self.futures.append(future)
+        return future
+
+    def process_frame(self, i: int, img) -> None:
+        """Correct the image, find the beam center and write the image in
+        all formats."""
+        if self.flatfield is not None:
+            img = self.flatfield_corrector(img)
+
+        if self.use_beamstop:
+            (cx, cy), = find_beam_centers_with_beamstop([img], z=99, workers=1)
+        else:
+            (cx, cy), = find_beam_centers([img], sigma=10)
+
+        with self.lock:
+            self.headers[i]['beam_center'] = (cx, cy)
+            self._beam_centers[i] = (cx, cy)
+            self.mean_beam_center = np.median(list(self._beam_centers.values()), axis=0)
+
+        self.data[i] = img
+
+        try:
+            if self.tiff_path:
+                self.files.append(self.write_tiff(self.tiff_path, i))
+            if self.mrc_path:
+                self.files.append(self.write_mrc(self.mrc_path, i))
+            if self.smv_path:
+                self.files.append(self.write_smv(self.smv_path, i))
+            if self.hdf5 is not None:
+                with self.hdf5_lock:
+                    self.hdf5.append(img, self.headers[i], index=i)
+        finally:
+            del self.data[i]
+
+    def wait(self) -> None:
+        """Block until all frames have been written."""
+        for future in self.futures:
+            future.result()
+        self.futures = []
+
+    def discard(self) -> None:
+        """Wait for the pending frames, and remove all files written so
+        far (i.e. if too few frames were collected). The SMV files would
+        otherwise keep their provisional headers."""
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+            if self.hdf5 is not None:
+                self.hdf5.close()
+                Path(self.hdf5_path).unlink()
+            for fn in self.files:
+                Path(fn).unlink()
+            self.files = []
+
+    def finalize(self,
+                 osc_angle: float,          # degrees, oscillation angle of the rotation
+                 end_angle: float,          # degrees, end angle of the rotation
+                 acquisition_time: float,   # seconds, acquisition time (exposure time + overhead)
+                 pixelsize: float,          # p/Angstrom, size of the pixels
+                 ) -> None:
+        """Wait for all frames to be written, and set the parameters that
+        are only known at the end of the data collection.
+
+        The headers of the SMV files are updated with the final
+        oscillation angle, distance, and mean beam center.
+        """
+        self.wait()
+        self.executor.shutdown()
+
+        if self.hdf5 is not None:
+            self.hdf5.close()
+
+        self.complete_range = set(range(min(self.observed_range), max(self.observed_range) + 1))
+        self.missing_range = self.observed_range ^ self.complete_range
+
+        beam_centers = np.array([self._beam_centers[i] for i in sorted(self._beam_centers)])
+        self.mean_beam_center = np.median(beam_centers, axis=0)
+        self.beam_center_std = np.std(beam_centers, axis=0)
+
+        self.pixelsize = pixelsize
+        self.distance = (1 / self.wavelength) * (self.physical_pixelsize / self.pixelsize)
+        self.osc_angle = osc_angle
+        self.end_angle = end_angle
+        self.acquisition_time = acquisition_time
+
+        logger.debug(f'Primary beam at: {self.mean_beam_center}')
+
+        self.check_settings()
+
+        if self.smv_path:
+            for i in self.observed_range:
+                header = self.get_smv_header(i, self.data_shape)
+                update_adsc_header(self.smv_path / f'{i:05d}.img', header)
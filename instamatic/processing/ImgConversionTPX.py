@@ -24,17 +24,11 @@ class ImgConversionTPX(ImgConversion):
                  stretch_amplitude=0.0,             # Stretch correction amplitude, %
                  stretch_azimuth=0.0,               # Stretch correction azimuth, degrees
                  ):
-        if flatfield is not None:
-            flatfield, h = read_tiff(flatfield)
-        self.flatfield = flatfield
-
-        self.headers = {}
-        self.data = {}
-
-        self.smv_subdrc = 'data'
-
-        self.untrusted_areas = [('rectangle', ((0, 255), (517, 262))),
-                                ('rectangle', ((255, 0), (262, 517)))]
+        self.setup_camera(flatfield=flatfield,
+                          physical_pixelsize=physical_pixelsize,
+                          wavelength=wavelength,
+                          stretch_amplitude=stretch_amplitude,
+                          stretch_azimuth=stretch_azimuth)
 
         while len(buffer) != 0:
             i, img, h = buffer.pop(0)
@@ -42,7 +36,7 @@ class ImgConversionTPX(ImgConversion):
             self.headers[i] = h
 
             if self.flatfield is not None:
-                self.data[i] = apply_flatfield_correction(img, self.flatfield)
+                self.data[i] = self.flatfield_corrector(img)
             else:
                 self.data[i] = img
 
@@ -53,17 +47,9 @@ class ImgConversionTPX(ImgConversion):
         self.data_shape = img.shape
 
         self.pixelsize = pixelsize
-        self.physical_pixelsize = physical_pixelsize
-        self.wavelength = wavelength
 
-        self.use_beamstop = False
         self.mean_beam_center, self.beam_center_std = self.get_beam_centers()
 
-        # Stretch correction parameters
-        self.stretch_azimuth = config.camera.stretch_azimuth
-        self.stretch_amplitude = config.camera.stretch_amplitude
-        self.do_stretch_correction = self.stretch_amplitude != 0
-
         self.distance = (1 / self.wavelength) * (self.physical_pixelsize / self.pixelsize)
         self.osc_angle = osc_angle
         self.start_angle = start_angle
@@ -75,9 +61,41 @@ class ImgConversionTPX(ImgConversion):
 
         logger.debug(f'Primary beam at: {self.mean_beam_center}')
 
+        self.check_settings()
+
+    def setup_camera(self,
+                     flatfield: str = 'flatfield.tiff',
+                     physical_pixelsize: float = None,
+                     wavelength: float = None,
+                     stretch_amplitude=0.0,
+                     stretch_azimuth=0.0,
+                     ) -> None:
+        """Set the parameters of the camera (TimePix) that do not depend
+        on the data, see `__init__`."""
+        if flatfield is not None:
+            flatfield, h = read_tiff(flatfield)
+        self.flatfield = flatfield
+        self.flatfield_corrector = FlatfieldCorrector(flatfield) if flatfield is not None else None
+
+        self.headers = {}
+        self.data = {}
+
+        self.smv_subdrc = 'data'
+
+        self.untrusted_areas = [('rectangle', ((0, 255), (517, 262))),
+                                ('rectangle', ((255, 0), (262, 517)))]
+
+        self.physical_pixelsize = physical_pixelsize
+        self.wavelength = wavelength
+
+        self.use_beamstop = False
+
+        # Stretch correction parameters
+        self.stretch_azimuth = stretch_azimuth
+        self.stretch_amplitude = stretch_amplitude
+        self.do_stretch_correction = self.stretch_amplitude != 0
+
         self.name = 'TimePix_SU'
 
         from .XDS_templateTPX import XDS_template
         self.XDS_template = XDS_template
-
-        self.check_settings()
@@ -25,6 +25,7 @@ class ImgConversionTVIPS(ImgConversion):
         if flatfield is not None:
             flatfield, h = read_tiff(flatfield)
         self.flatfield = flatfield
+        self.flatfield_corrector = FlatfieldCorrector(flatfield) if flatfield is not None else None
 
         self.headers = {}
         self.data = {}
@@ -37,7 +38,7 @@ class ImgConversionTVIPS(ImgConversion):
             self.headers[i] = h
 
             if self.flatfield is not None:
-                self.data[i] = apply_flatfield_correction(img, self.flatfield)
+                self.data[i] = self.flatfield_corrector(img)
             else:
                 self.data[i] = img
 
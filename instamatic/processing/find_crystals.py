@@ -1,3 +1,5 @@
+import concurrent.futures
+import functools
 import sys
 from collections import namedtuple
 
@@ -17,6 +19,9 @@ from instamatic.image_utils import autoscale
 
 CrystalPosition = namedtuple('CrystalPosition', ['x', 'y', 'isolated', 'n_clusters', 'area_micrometer', 'area_pixel'])
 
+# structuring elements are reused between calls
+disk = functools.lru_cache(maxsize=16)(morphology.disk)
+
 
 def isedge(prop):
     """Simple edge detection routine.
@@ -49,7 +54,7 @@ def whiten(obs, check_finite=False):
     return obs / std_dev, std_dev
 
 
-def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=True):
+def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=True, mode='random_walker'):
     """
     r: `int`
        blocksize to calculate local threshold value
@@ -58,7 +63,14 @@ def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=Tru
     offset: `int`
     Constant subtracted from weighted mean of neighborhood to calculate
         the local threshold value
+    mode: `str`
+       'random_walker' to grow the features from the markers with
+       `segmentation.random_walker`, or 'watershed' to use a much
+       faster marker-based watershed on the image gradient
     """
+    if mode not in ('random_walker', 'watershed'):
+        raise ValueError(f"Unknown mode: {mode!r}, must be 'random_walker' or 'watershed'")
+
     # workaround, because segmentation.random_walker no longer accepts floats from 0-255.0
     offset = offset / 255.0
 
@@ -68,30 +80,33 @@ def segment_crystals(img, r=101, offset=5, footprint=5, remove_carbon_lacing=Tru
     # adaptive thresholding, because contrast is not equal over image
     arr = img > filters.threshold_local(img, r, method='mean', offset=offset)
     arr = np.invert(arr)
-    # arr = morphology.binary_opening(arr, morphology.disk(3))
+    # arr = morphology.binary_opening(arr, disk(3))
 
     arr = morphology.remove_small_objects(arr, min_size=4 * 4, connectivity=0)  # remove noise
 
     # magic
-    arr = morphology.binary_closing(arr, morphology.disk(footprint))  # dilation + erosion
-    arr = morphology.binary_erosion(arr, morphology.disk(footprint))  # erosion
+    arr = morphology.binary_closing(arr, disk(footprint))  # dilation + erosion
+    arr = morphology.binary_erosion(arr, disk(footprint))  # erosion
 
     # remove carbon lines
     if remove_carbon_lacing:
         arr = morphology.remove_small_objects(arr, min_size=8 * 8, connectivity=0)
         arr = morphology.remove_small_holes(arr, min_size=32 * 32, connectivity=0)
-    arr = morphology.binary_dilation(arr, morphology.disk(footprint))  # dilation
+    arr = morphology.binary_dilation(arr, disk(footprint))  # dilation
 
     # get background pixels
-    bkg = np.invert(morphology.binary_dilation(arr, morphology.disk(footprint * 2)) | arr)
+    bkg = np.invert(morphology.binary_dilation(arr, disk(footprint * 2)) | arr)
 
     # 2: features
     # 1: background
     # 0: unlabeled
     markers = arr * 2 + bkg
 
-    # segment using random_walker
-    segmented = segmentation.random_walker(img, markers, beta=50, spacing=(5, 5), mode='bf')
+    if mode == 'watershed':
+        segmented = segmentation.watershed(filters.sobel(img), markers)
+    else:
+        # segment using random_walker
+        segmented = segmentation.random_walker(img, markers, beta=50, spacing=(5, 5), mode='bf')
     segmented = segmented.astype(int) - 1
 
     return arr, segmented
@@ -114,10 +129,12 @@ def find_crystals_timepix(img, magnification, spread=0.6, plot=False, **kwargs):
                          footprint=footprint,
                          offset=offset,
                          r=r,
-                         remove_carbon_lacing=False)
+                         remove_carbon_lacing=False,
+                         maxdim=kwargs.get('maxdim', 256),
+                         mode=kwargs.get('mode', 'random_walker'))
 
 
-def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
+def find_crystals(img, magnification, spread=2.0, plot=False, maxdim=256, **kwargs):
     """Function for finding crystals in a low contrast images. Used adaptive
     thresholds to find local features. Edges are detected, and rejected, on the
     basis of a histogram. Kmeans clustering is used to spread points over the
@@ -131,10 +148,12 @@ def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
         Value in micrometer to roughly indicate the desired spread of centroids over individual regions
     plot: bool
         Whether to plot the results or not
+    maxdim: int
+        The image is scaled down to this size before segmentation
     **kwargs:
     keywords to pass to segment_crystals
     """
-    img, scale = autoscale(img, maxdim=256)  # scale down for faster
+    img, scale = autoscale(img, maxdim=maxdim)  # scale down for faster
 
     # segment the image, and find objects
     arr, seg = segment_crystals(img, **kwargs)
@@ -192,6 +211,84 @@ def find_crystals(img, magnification, spread=2.0, plot=False, **kwargs):
     return crystals
 
 
+class CrystalFinder:
+    """Find crystals in images with fixed settings, optionally in the
+    background while the next image is being collected.
+
+    magnification: float
+        Magnification of the images, see `find_crystals`
+    spread: float
+        Spread of the centroids over large regions in micrometer
+    maxdim: int
+        The images are scaled down to this size before segmentation
+    mode: str
+        Segmentation mode, 'random_walker' or 'watershed' (faster), see
+        `segment_crystals`
+    workers: int
+        Number of background threads for `submit`
+    **kwargs:
+        keywords to pass to `segment_crystals` (r, offset, footprint,
+        remove_carbon_lacing)
+
+    Usage:
+        finder = CrystalFinder.timepix(magnification=2500)
+        future = finder.submit(img)  # returns immediately
+        ...  # move the stage, collect the next image
+        crystals = future.result()
+    """
+
+    def __init__(self, magnification, spread=2.0, maxdim=256, mode='random_walker', workers=1, **kwargs):
+        super().__init__()
+        if mode not in ('random_walker', 'watershed'):
+            raise ValueError(f"Unknown mode: {mode!r}, must be 'random_walker' or 'watershed'")
+
+        self.magnification = magnification
+        self.spread = spread
+        self.maxdim = maxdim
+        self.mode = mode
+        self.kwargs = kwargs
+        self.workers = workers
+        self._executor = None
+
+    @classmethod
+    def timepix(cls, magnification, spread=0.6, **kwargs):
+        """Return a `CrystalFinder` with the defaults for the timepix camera
+        (see `find_crystals_timepix`)."""
+        defaults = {'r': 75, 'offset': 15, 'footprint': 3, 'remove_carbon_lacing': False}
+        return cls(magnification, spread=spread, **{**defaults, **kwargs})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.close()
+
+    def find(self, img, plot=False) -> list:
+        """Find the crystals in `img`, returns a list of
+        `CrystalPosition`."""
+        return find_crystals(img, self.magnification, spread=self.spread, plot=plot, maxdim=self.maxdim, mode=self.mode, **self.kwargs)
+
+    def submit(self, img) -> concurrent.futures.Future:
+        """Find the crystals in `img` in a background thread, returns a
+        future for the list of `CrystalPosition`."""
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='CrystalFinder')
+        return self._executor.submit(self.find, img)
+
+    def map(self, imgs):
+        """Find the crystals in all images in `imgs` in the background,
+        yields the lists of `CrystalPosition` in order."""
+        futures = [self.submit(img) for img in imgs]
+        for future in futures:
+            yield future.result()
+
+    def close(self) -> None:
+        """Wait for the pending images and stop the background threads."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
 def main_entry():
     import argparse
     description = """Find crystals in images."""
@@ -1,3 +1,4 @@
+import functools
 import glob
 import os
 import time
@@ -5,6 +6,7 @@ import warnings
 from pathlib import Path
 
 import numpy as np
+from scipy import sparse
 from tqdm.auto import tqdm
 
 from instamatic import config
@@ -24,13 +26,45 @@ def apply_corrections(img, deadpixels=None):
 def remove_deadpixels(img, deadpixels, d=1):
     """Remove dead pixels from the images by replacing them with the average of
     neighbouring pixels."""
-    d = 1
-    for (i, j) in deadpixels:
-        neighbours = img[i - d:i + d + 1, j - d:j + d + 1].flatten()
-        img[i, j] = np.mean(neighbours)
+    deadpixels = np.asarray(deadpixels).reshape(-1, 2)
+    kernel, counts = get_deadpixel_kernel(deadpixels, img.shape[-2:], d=d)
+    _replace_deadpixels(img, deadpixels, kernel, counts)
     return img
 
 
+def get_deadpixel_kernel(deadpixels, shape, d=1):
+    """Return a sparse matrix (ndeadpixels x npixels) that sums the
+    (2d+1) x (2d+1) neighbourhood of every dead pixel, clipped to the image
+    edges, and the number of pixels in each neighbourhood.
+
+    The dead pixel values are then given by `kernel @ img.ravel() / counts`.
+    """
+    deadpixels = np.asarray(deadpixels, dtype=int).reshape(-1, 2)
+    ny, nx = shape
+    offsets = np.arange(-d, d + 1)
+    di, dj = (arr.ravel() for arr in np.meshgrid(offsets, offsets, indexing='ij'))
+
+    i = deadpixels[:, 0, np.newaxis] + di
+    j = deadpixels[:, 1, np.newaxis] + dj
+    valid = (i >= 0) & (i < ny) & (j >= 0) & (j < nx)
+
+    rows = np.broadcast_to(np.arange(len(deadpixels))[:, np.newaxis], i.shape)[valid]
+    cols = (i * nx + j)[valid]
+
+    kernel = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(deadpixels), ny * nx))
+    counts = valid.sum(axis=1)
+    return kernel, counts
+
+
+def _replace_deadpixels(img, deadpixels, kernel, counts):
+    """Replace the dead pixels in a frame or stack of frames in place, all
+    values are computed from the uncorrected image."""
+    flat = img.reshape(-1, kernel.shape[1])
+    values = (kernel @ flat.T).T / counts
+    i, j = deadpixels.T
+    img[..., i, j] = values.reshape(*img.shape[:-2], -1)
+
+
 def get_deadpixels(img):
     """Get coordinates of dead pixels in the image."""
     return np.argwhere(img == 0)
@@ -59,21 +93,111 @@ def apply_flatfield_correction(img, flatfield, darkfield=None):
     """Apply flatfield correction to image.
 
     https://en.wikipedia.org/wiki/Flat-field_correction
+
+    Computes the gain map on every call, use `FlatfieldCorrector` to
+    correct many images with the same flatfield.
+    """
+    return FlatfieldCorrector(flatfield, darkfield=darkfield).apply(img)
+
+
+class FlatfieldCorrector:
+    """Flatfield/darkfield and dead pixel correction with precomputed gain
+    map and dead pixel kernel.
+
+    flatfield:
+        Flatfield image (2D numpy array)
+    darkfield:
+        Darkfield image (optional)
+    deadpixels:
+        Coordinates (N x 2) of the dead pixels (optional), they are
+        replaced by the average of their 3x3 neighbourhood before the
+        flatfield correction is applied
+
+    The corrector is applied to a single frame (H, W) or a stack of
+    frames (N, H, W):
+
+        corrector = FlatfieldCorrector.from_file('flatfield.tiff')
+        img = corrector(img)
     """
 
-    if flatfield.shape != img.shape:
-        msg = f'Flatfield not applied: image {img.shape} and flatfield {flatfield.shape} do not match shapes.'
-        warnings.warn(msg)
+    def __init__(self, flatfield, darkfield=None, deadpixels=None):
+        super().__init__()
+        self.shape = flatfield.shape
+
+        if darkfield is None:
+            self.gain = np.mean(flatfield) / flatfield
+            self.darkfield = None
+        else:
+            diff = flatfield - darkfield
+            self.gain = np.mean(diff) / diff
+            self.darkfield = darkfield
+
+        if deadpixels is not None and len(deadpixels):
+            self.deadpixels = np.asarray(deadpixels, dtype=int).reshape(-1, 2)
+            self.kernel, self.counts = get_deadpixel_kernel(self.deadpixels, self.shape)
+        else:
+            self.deadpixels = None
+            self.kernel = self.counts = None
+
+    def __repr__(self):
+        ndead = 0 if self.deadpixels is None else len(self.deadpixels)
+        return f'{self.__class__.__name__}(shape={self.shape}, darkfield={self.darkfield is not None}, deadpixels={ndead})'
+
+    def __call__(self, img, inplace: bool = False):
+        return self.apply(img, inplace=inplace)
+
+    @classmethod
+    def from_file(cls, flatfield: str, darkfield: str = None, deadpixels: bool = False):
+        """Load the flatfield (and darkfield) from tiff files. If
+        `deadpixels` is True, the dead pixels are read from the flatfield
+        header."""
+        flatfield, h = read_tiff(flatfield)
+        if darkfield is not None:
+            darkfield, _ = read_tiff(darkfield)
+        deadpixels = h.get('deadpixels') if deadpixels else None
+        return cls(flatfield, darkfield=darkfield, deadpixels=deadpixels)
+
+    def remove_deadpixels(self, img):
+        """Replace the dead pixels in `img` (in place) by the average of
+        their neighbourhood."""
+        if self.kernel is not None:
+            _replace_deadpixels(img, self.deadpixels, self.kernel, self.counts)
         return img
 
-    if darkfield is None:
-        ret = img * np.mean(flatfield) / flatfield
-    else:
-        gain = np.mean(flatfield - darkfield) / (flatfield - darkfield)
-        ret = (img - darkfield) * gain
+    def apply(self, img, inplace: bool = False):
+        """Apply the dead pixel and flatfield corrections to a frame (H, W)
+        or stack of frames (N, H, W).
+
+        If `inplace` is True and `img` is a floating point array, the
+        data in `img` are overwritten. Otherwise (and for integer data)
+        a new floating point array is returned.
+        """
+        if img.shape[-2:] != self.shape:
+            msg = f'Flatfield not applied: image {img.shape} and flatfield {self.shape} do not match shapes.'
+            warnings.warn(msg)
+            return img
+
+        if not (inplace and np.issubdtype(img.dtype, np.floating)):
+            img = img.astype(np.result_type(img.dtype, self.gain.dtype))
+
+        self.remove_deadpixels(img)
+
+        if self.darkfield is not None:
+            img -= self.darkfield
+        img *= self.gain
+
+        return img
+
+
+@functools.lru_cache(maxsize=4)
+def _load_flatfield_corrector(fname: str, mtime: float) -> FlatfieldCorrector:
+    return FlatfieldCorrector.from_file(fname)
+
 
-    # print(f"flatfield {img.dtype} / {ret.dtype} => {flatfield.dtype}")
-    return ret
+def get_flatfield_corrector(fname: str) -> FlatfieldCorrector:
+    """Return a `FlatfieldCorrector` for the flatfield file `fname`, the
+    corrector is cached until the file is modified."""
+    return _load_flatfield_corrector(str(fname), os.path.getmtime(fname))
 
 
 def collect_flatfield(ctrl=None, frames=100, save_images=False, collect_darkfield=True, drc='.', **kwargs):
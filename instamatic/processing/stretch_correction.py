@@ -1,8 +1,12 @@
+import functools
+import logging
 import math
 import sys
+from pathlib import Path
 
 import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse
 from matplotlib.widgets import Slider
 from scipy.ndimage import interpolation
 from scipy.ndimage import morphology
@@ -13,6 +17,8 @@ from skimage.measure import regionprops
 from instamatic.formats import read_tiff
 from instamatic.image_utils import autoscale
 
+logger = logging.getLogger(__name__)
+
 
 def apply_transform_to_image(img, transform, center=None):
     """Applies transformation matrix to image and recenters it
@@ -80,14 +86,153 @@ def apply_stretch_correction(z, center=None, azimuth: float = 0, amplitude: floa
     amplitude: float
         The difference in percent between the long and short axes
 
+    `z` can be a single image or a stack of images (N, H, W). The
+    interpolation weights are cached (see `get_stretch_corrector`).
+
     returns:
         (N,N) ndarray
     """
-    azimuth_rad = np.radians(azimuth)    # go to radians
-    amplitude_pc = amplitude / (2 * 100)   # as percentage
-    tr_mat = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
-    z = apply_transform_to_image(z, tr_mat, center=center)
-    return z
+    corrector = get_stretch_corrector(z.shape[-2:], center=center, azimuth=azimuth, amplitude=amplitude)
+    return corrector(z)
+
+
+class StretchCorrector:
+    """Apply the stretch correction to images of size `shape`, see
+    `apply_stretch_correction` for the parameters.
+
+    The bilinear interpolation (equivalent to `apply_transform_to_image`)
+    is precomputed as a sparse matrix with 4 float32 weights per pixel,
+    so that correcting an image is a single sparse matrix product. Stacks
+    of images (N, H, W) are corrected in one go.
+    """
+
+    def __init__(self, shape: tuple, center=None, azimuth: float = 0, amplitude: float = 0):
+        super().__init__()
+        self.shape = shape = tuple(int(n) for n in shape)
+        nx, ny = shape
+
+        if center is None:
+            center = (np.array(shape)[::-1] - 1) / 2.0
+        self.center = center = np.array(center, dtype=float)
+
+        azimuth_rad = np.radians(azimuth)
+        amplitude_pc = amplitude / (2 * 100)
+        self.transform = tr_mat = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
+
+        # input coordinates for every output pixel, as in `ndimage.affine_transform`
+        coords = np.indices(shape).reshape(2, -1) - center[:, None]
+        x, y = tr_mat.dot(coords) + center[:, None]
+
+        # pixels that map outside the image are set to 0
+        valid = (x >= 0) & (x <= nx - 1) & (y >= 0) & (y <= ny - 1)
+        out = np.flatnonzero(valid)
+        x, y = x[valid], y[valid]
+
+        x0 = np.minimum(np.floor(x).astype(int), nx - 2)
+        y0 = np.minimum(np.floor(y).astype(int), ny - 2)
+        fx = x - x0
+        fy = y - y0
+
+        rows = np.tile(out, 4)
+        cols = np.concatenate([(x0 + dx) * ny + (y0 + dy) for dx in (0, 1) for dy in (0, 1)])
+        weights = np.concatenate([(1 - fx) * (1 - fy), (1 - fx) * fy, fx * (1 - fy), fx * fy])
+
+        self.matrix = scipy.sparse.csr_matrix((weights.astype(np.float32), (rows, cols)), shape=(nx * ny, nx * ny))
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        return self.apply(img)
+
+    def apply(self, img: np.ndarray) -> np.ndarray:
+        """Apply the correction to image `img` (H, W) or a stack of images
+        (N, H, W).
+
+        Integer images are rounded, as in `ndimage.affine_transform`.
+        """
+        img = np.asarray(img)
+        if img.shape[-2:] != self.shape:
+            raise ValueError(f'Image shape {img.shape} does not match the corrector shape {self.shape}')
+
+        flat = img.reshape(-1, self.matrix.shape[1])
+        corrected = (self.matrix @ flat.T).T.reshape(img.shape)
+
+        if np.issubdtype(img.dtype, np.integer):
+            corrected = np.rint(corrected)
+        return corrected.astype(img.dtype, copy=False)
+
+
+@functools.lru_cache(maxsize=4)
+def _get_stretch_corrector(shape: tuple, center: tuple, azimuth: float, amplitude: float) -> StretchCorrector:
+    return StretchCorrector(shape, center=center, azimuth=azimuth, amplitude=amplitude)
+
+
+def get_stretch_corrector(shape: tuple, center=None, azimuth: float = 0, amplitude: float = 0) -> StretchCorrector:
+    """Return a cached `StretchCorrector` for the given image shape, center
+    and stretch parameters."""
+    shape = tuple(int(n) for n in shape)
+    if center is not None:
+        center = tuple(float(c) for c in center)
+    return _get_stretch_corrector(shape, center, float(azimuth), float(amplitude))
+
+
+def _get_cache_drc() -> Path:
+    from instamatic import config
+    return config.locations['config'] / 'cache'
+
+
+@functools.lru_cache(maxsize=4)
+def _get_base_maps(shape: tuple, azimuth: float, amplitude: float, cache_drc: str = None) -> np.ndarray:
+    """Return the displacement maps (2, H, W) for a center at (0, 0).
+
+    The maps are stored as float32 in `cache_drc`, and read from there
+    if they exist.
+    """
+    fn = None
+    if cache_drc:
+        fn = Path(cache_drc) / f'stretch_{shape[0]}x{shape[1]}_{azimuth:.6g}_{amplitude:.6g}.npy'
+        try:
+            return np.load(fn, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+    azimuth_rad = np.radians(azimuth)
+    amplitude_pc = amplitude / (2 * 100)
+    s = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
+
+    coords = np.indices(shape).reshape(2, -1)
+    maps = (s - np.eye(2)).T.dot(coords).reshape(2, *shape).astype(np.float32)
+
+    if fn:
+        try:
+            fn.parent.mkdir(exist_ok=True, parents=True)
+            np.save(fn, maps)
+        except OSError as e:
+            logger.warning('Cannot write correction maps %s: %s', fn, e)
+
+    return maps
+
+
+def get_displacement_maps(shape: tuple, center, azimuth: float = 0, amplitude: float = 0, cache_drc: str = None) -> (np.ndarray, np.ndarray):
+    """Return the displacement maps (float32) for the X and Y pixel
+    coordinates in an image of size `shape` to correct the stretching,
+    see `apply_stretch_correction` for the parameters.
+
+    The stretched coordinates of the pixel at (x, y) are (x + xcorr[x,
+    y], y + ycorr[x, y]). The center only adds a constant to the maps,
+    so the maps are cached for the shape, azimuth and amplitude only,
+    both in memory and in `cache_drc` (default: the `cache` directory
+    in the config directory, `False` to disable).
+    """
+    if cache_drc is None:
+        cache_drc = _get_cache_drc()
+    shape = tuple(int(n) for n in shape)
+    maps = _get_base_maps(shape, float(azimuth), float(amplitude), str(cache_drc) if cache_drc else None)
+
+    azimuth_rad = np.radians(azimuth)
+    amplitude_pc = amplitude / (2 * 100)
+    s = affine_transform_ellipse_to_circle(azimuth_rad, amplitude_pc)
+    offset = np.dot(np.array(center, dtype=float), s - np.eye(2)).astype(np.float32)
+
+    return maps[0] - offset[0], maps[1] - offset[1]
 
 
 def make_title(prop):
@@ -0,0 +1,125 @@
+"""asyncio transport for the TEM and CAM servers.
+
+This is an alternative to the thread-per-connection loop in
+`tem_server.main`/`cam_server.main`. A single event loop accepts and
+serves all client connections, which makes it cheap to have many GUI,
+scripting, and monitoring clients connected at the same time. The
+commands are still executed by the `TemServer`/`CamServer` thread, so
+the command vocabulary and the wire protocol are identical.
+
+Start the servers with `instamatic.temserver --asyncio` or
+`instamatic.camserver --asyncio`.
+"""
+import asyncio
+import logging
+from concurrent.futures import Future
+from functools import partial
+
+from .dispatcher import is_stream_request
+from .protocol import configure_socket
+from .protocol import read_frame
+from .protocol import write_frame
+from .serializer import dumper as default_dumper
+from .serializer import loader as default_loader
+
+logger = logging.getLogger(__name__)
+
+
+async def send_reply(writer: asyncio.StreamWriter, request_id: int, reply: Future, dumper):
+    """Wait for the server to resolve `reply`, and send the response back to
+    the client."""
+    response = await asyncio.wrap_future(reply)
+    if writer.transport.is_closing():
+        return
+
+    write_frame(writer, request_id, dumper(response))
+    try:
+        await writer.drain()
+    except ConnectionError:
+        pass
+
+
+async def push(writer: asyncio.StreamWriter, request_id: int, payload):
+    if writer.transport.is_closing():
+        raise ConnectionError('Connection has been closed by the client')
+
+    write_frame(writer, request_id, payload)
+    await writer.drain()
+
+
+def make_push(writer: asyncio.StreamWriter, request_id: int, dumper):
+    """Make a function to send responses from another thread (i.e. for
+    streams), which blocks until the data have been sent."""
+    loop = asyncio.get_event_loop()
+
+    def threadsafe_push(response):
+        payload = dumper(response)
+        asyncio.run_coroutine_threadsafe(push(writer, request_id, payload), loop).result()
+
+    return threadsafe_push
+
+
+async def handle(reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 q,
+                 loader=default_loader,
+                 dumper=default_dumper,
+                 ):
+    """Handle incoming connection, put command on the Queue `q`, which is then
+    handled by TemServer/CamServer.
+
+    The responses are sent back (possibly out of order) as soon as they
+    become available.
+    """
+    configure_socket(writer.get_extra_info('socket'))
+
+    addr = writer.get_extra_info('peername')
+    logger.info('Connected by %s', addr)
+    print('Connected by', addr)
+
+    try:
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+
+            request_id, data = frame
+            data = loader(data)
+
+            if data == 'exit':
+                break
+
+            if data == 'kill':
+                break
+
+            if is_stream_request(data):
+                data['push'] = make_push(writer, request_id, dumper)
+
+            reply = Future()
+            q.put((data, reply))
+            asyncio.ensure_future(send_reply(writer, request_id, reply, dumper))
+    except ConnectionError as e:
+        logger.info('Connection to %s lost: %s', addr, e)
+    finally:
+        writer.close()
+
+
+async def serve(q, host: str, port: int, loader=default_loader, dumper=default_dumper):
+    """Accept connections on `host`:`port` and put the commands on `q`.
+    Returns the server, the connections are handled while the event loop
+    is running."""
+    return await asyncio.start_server(partial(handle, q=q, loader=loader, dumper=dumper), host, port)
+
+
+def run(q, host: str, port: int, loader=default_loader, dumper=default_dumper):
+    """Run the asyncio server (blocking)."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    server = loop.run_until_complete(serve(q, host, port, loader=loader, dumper=dumper))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
@@ -1,3 +1,4 @@
+import atexit
 import datetime
 import logging
 import pickle
@@ -5,9 +6,18 @@ import queue
 import socket
 import threading
 import traceback
+from functools import partial
 
 import numpy as np
 
+from .dispatcher import is_stream_request
+from .dispatcher import make_reply
+from .dispatcher import push
+from .dispatcher import RequestDispatcher
+from .frame_stream import FrameStream
+from .protocol import configure_socket
+from .protocol import recv_frame
+from .serializer import array_dumper
 from .serializer import dumper
 from .serializer import loader
 from instamatic import config
@@ -16,18 +26,18 @@ from instamatic.utils import high_precision_timers
 high_precision_timers.enable()
 
 if config.settings.cam_use_shared_memory:
-    from multiprocessing import shared_memory
-
-condition = threading.Condition()
-box = []
+    from .frame_ring import FrameRing
 
 HOST = config.settings.cam_server_host
 PORT = config.settings.cam_server_port
-BUFSIZE = 4096
+MAX_WORKERS = config.settings.cam_server_max_workers
 
 
 is_local_connection = HOST in ('127.0.0.1', 'localhost')
 
+# images that are not passed via shared memory are sent as raw buffers
+reply_dumper = partial(array_dumper, dumper=dumper)
+
 
 class CamServer(threading.Thread):
     """Camera communcation server.
@@ -37,9 +47,19 @@ class CamServer(threading.Thread):
     camera. Start the server using `CamServer.run` which will wait for
     items to appear on `q` and execute them on the specified camera
     instance.
+
+    Items on `q` are tuples of the command and a future that receives
+    the response. Attribute lookups and read-only calls (e.g.
+    `getImageDimensions`) are executed concurrently using `max_workers`
+    threads, image acquisition and all other calls are serialized (see
+    `RequestDispatcher`).
+
+    `start_stream` starts a `FrameStream` that acquires frames
+    back-to-back and pushes them to the client, until `n` frames have
+    been acquired or `stop_stream` is called.
     """
 
-    def __init__(self, log=None, q=None, name=None):
+    def __init__(self, log=None, q=None, name=None, max_workers: int = MAX_WORKERS):
         super().__init__()
 
         self.log = log
@@ -48,33 +68,64 @@ class CamServer(threading.Thread):
         # self.name is a reserved parameter for threads
         self._name = name
 
-        self._bufsize = BUFSIZE
-
         self.verbose = False
 
         self.buffers = {}
 
         self.use_shared_memory = config.settings.cam_use_shared_memory
+        self.nslots = config.settings.cam_shared_memory_slots
         print('Use shared memory:', self.use_shared_memory)
 
+        self.dispatcher = RequestDispatcher(max_workers=max_workers)
+
+        self.streams = {}
+        self.acquire_lock = threading.Lock()
+        self.buffer_lock = threading.Lock()
+
     def setup_shared_buffer(self, arr):
-        """Set up shared memory buffer.
+        """Set up shared memory ring buffer.
 
-        Make a buffer for each binsize, and store the buffers to a dict.
+        Make a ring buffer for each image shape/dtype (i.e. binsize), and
+        store the buffers to a dict.
         """
-        self.shmem = shared_memory.SharedMemory(create=True, size=arr.nbytes)
-        buffer = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self.shmem.buf)
-        self.buffers[arr.shape] = buffer
+        ring = FrameRing.create(arr.shape, arr.dtype, nslots=self.nslots)
+        self.buffers[arr.shape, arr.dtype.str] = ring
+        atexit.register(ring.close)
         if self.verbose:
-            print(f'Created new buffer: `{self.shmem.name}` | {arr.shape} ({arr.dtype})')
+            print(f'Created new buffer: `{ring.name}` | {arr.shape} ({arr.dtype}) x {self.nslots}')
 
     def copy_data_to_shared_buffer(self, arr):
-        """Copy numpy image array to shared memory."""
-        if arr.shape not in self.buffers:
-            self.setup_shared_buffer(arr)
+        """Copy numpy image array to the next free slot in shared memory.
+
+        Returns a dict describing the slot, which the client uses to
+        access the data. If all slots are still held by the client, the
+        array itself is returned so that it is sent over the socket
+        instead.
+        """
+        key = arr.shape, arr.dtype.str
 
-        buffer = self.buffers[arr.shape]
-        buffer[:] = arr[:]  # copy data to buffer
+        with self.buffer_lock:
+            if key not in self.buffers:
+                self.setup_shared_buffer(arr)
+
+            ring = self.buffers[key]
+            ret = ring.write(arr)
+
+        if ret is None:
+            if self.log:
+                self.log.warning('All %d slots of shared buffer `%s` are leased, sending data over socket', ring.nslots, ring.name)
+            return arr
+
+        slot, seq = ret
+
+        return {
+            'shape': arr.shape,
+            'dtype': str(arr.dtype),
+            'name': ring.name,
+            'nslots': ring.nslots,
+            'slot': slot,
+            'seq': seq,
+        }
 
     def run(self):
         """Start server thread."""
@@ -84,38 +135,61 @@ class CamServer(threading.Thread):
         print(f'Initialized camera: {self.cam.interface}')
 
         while True:
-            now = datetime.datetime.now().strftime('%H:%M:%S.%f')
-
-            cmd = self.q.get()
-
-            with condition:
-                attr_name = cmd['attr_name']
-                args = cmd.get('args', ())
-                kwargs = cmd.get('kwargs', {})
-
-                try:
-                    ret = self.evaluate(attr_name, args, kwargs)
-                    status = 200
-                except Exception as e:
-                    traceback.print_exc()
-                    if self.log:
-                        self.log.exception(e)
-                    ret = (e.__class__.__name__, e.args)
-                    status = 500
-                else:
-                    if self.use_shared_memory:
-                        if attr_name == 'getImage':
-                            self.copy_data_to_shared_buffer(ret)
-                            ret = {
-                                'shape': ret.shape,
-                                'dtype': str(ret.dtype),
-                                'name': self.shmem.name,
-                            }
-
-                box.append((status, ret))
-                condition.notify()
-                if self.verbose:
-                    print(f'{now} | {status} {attr_name}: {ret}')
+            cmd, reply = self.q.get()
+
+            read_only = self.is_read_only(cmd['attr_name'])
+
+            self.dispatcher.dispatch(partial(self.execute, cmd), reply=reply, read_only=read_only)
+
+    def execute(self, cmd: dict) -> tuple:
+        """Execute the command `cmd` and return a tuple of the status code
+        and return value."""
+        now = datetime.datetime.now().strftime('%H:%M:%S.%f')
+
+        attr_name = cmd['attr_name']
+        args = cmd.get('args', ())
+        kwargs = cmd.get('kwargs', {})
+
+        try:
+            if attr_name == 'start_stream':
+                ret = self.start_stream(cmd['push'], *args, **kwargs)
+            elif attr_name == 'stop_stream':
+                ret = self.stop_stream(*args, **kwargs)
+            else:
+                ret = self.evaluate(attr_name, args, kwargs)
+            status = 200
+        except Exception as e:
+            traceback.print_exc()
+            if self.log:
+                self.log.exception(e)
+            ret = (e.__class__.__name__, e.args)
+            status = 500
+        else:
+            if self.use_shared_memory:
+                if attr_name == 'getImage':
+                    ret = self.copy_data_to_shared_buffer(ret)
+
+        if self.verbose:
+            print(f'{now} | {status} {attr_name}: {ret}')
+
+        return status, ret
+
+    def is_read_only(self, attr_name: str) -> bool:
+        """Check whether `attr_name` only reads the state of the camera, so
+        that it can be run concurrently with other reads.
+
+        Image acquisition (`getImage*`) is never read-only.
+        """
+        if attr_name.startswith('getImage'):
+            return attr_name == 'getImageDimensions'
+
+        if attr_name in ('start_stream', 'stop_stream'):
+            return False
+
+        if attr_name.startswith(('get', 'is')):
+            return True
+
+        return not callable(getattr(self.cam, attr_name, None))
 
     def evaluate(self, attr_name: str, args: list, kwargs: dict):
         """Evaluate the function or attribute `attr_name` on `self.cam`, if
@@ -123,11 +197,58 @@ class CamServer(threading.Thread):
         # print(attr_name, args, kwargs)
         f = getattr(self.cam, attr_name)
         if callable(f):
-            ret = f(*args, **kwargs)
+            if attr_name == 'getImage':
+                # do not interfere with a running stream
+                with self.acquire_lock:
+                    ret = f(*args, **kwargs)
+            else:
+                ret = f(*args, **kwargs)
         else:
             ret = f
         return ret
 
+    def start_stream(self, push, stream_id: str, exposure: float = None, binsize: int = None, n: int = None, maxsize: int = 8) -> None:
+        """Start acquiring frames back-to-back, and send them to the client
+        using `push`.
+
+        stream_id:
+            Identifier chosen by the client, used to stop the stream
+        exposure, binsize:
+            Passed to `getImage`
+        n:
+            Number of frames to acquire, acquire until `stop_stream` if None
+        maxsize:
+            Maximum number of frames waiting to be sent, frames acquired
+            while the queue is full are dropped
+        """
+        self.streams = {key: stream for key, stream in self.streams.items() if stream.is_running}
+        if stream_id in self.streams:
+            raise ValueError(f'Stream `{stream_id}` is already running')
+
+        def acquire():
+            with self.acquire_lock:
+                return self.cam.getImage(exposure=exposure, binsize=binsize)
+
+        def push_frame(response):
+            status, data = response
+            image = data.get('image')
+            if self.use_shared_memory and image is not None:
+                data = dict(data, image=self.copy_data_to_shared_buffer(image))
+            push((status, data))
+
+        stream = FrameStream(acquire, push_frame, n=n, maxsize=maxsize, log=self.log)
+        self.streams[stream_id] = stream
+        stream.start()
+
+        if self.log:
+            self.log.info('Started stream `%s` (exposure=%s, binsize=%s, n=%s)', stream_id, exposure, binsize, n)
+
+    def stop_stream(self, stream_id: str) -> None:
+        """Stop the acquisition of stream `stream_id`."""
+        stream = self.streams.pop(stream_id, None)
+        if stream is not None:
+            stream.stop()
+
     def get_attrs(self):
         """Get attributes from cam object to update __dict__ on client side."""
         attrs = {}
@@ -143,13 +264,21 @@ class CamServer(threading.Thread):
 
 def handle(conn, q):
     """Handle incoming connection, put command on the Queue `q`, which is then
-    handled by TEMServer."""
+    handled by CamServer.
+
+    Requests are put on the queue as soon as they are received, the
+    responses are sent back (possibly out of order) when they become
+    available.
+    """
+    lock = threading.Lock()
+
     with conn:
         while True:
-            data = conn.recv(BUFSIZE)
-            if not data:
+            frame = recv_frame(conn)
+            if frame is None:
                 break
 
+            request_id, data = frame
             data = loader(data)
 
             if data == 'exit':
@@ -158,11 +287,11 @@ def handle(conn, q):
             if data == 'kill':
                 break
 
-            with condition:
-                q.put(data)
-                condition.wait()
-                response = box.pop()
-                conn.sendall(dumper(response))
+            if is_stream_request(data):
+                data['push'] = partial(push, conn, lock, request_id, reply_dumper)
+
+            reply = make_reply(conn, lock, request_id, reply_dumper)
+            q.put((data, reply))
 
 
 def main():
@@ -175,13 +304,17 @@ This program initializes a connection to the camera as defined in the config. Th
 
 The host and port are defined in `config/settings.yaml`.
 
+Each message sent over the socket is framed by a header containing the request id (uint32) and the length of the payload (uint64). The server echoes the request id with the reply, so that a client can pipeline several requests on the same connection.
+
 The data sent over the socket is a pickled dictionary with the following elements:
 
 - `attr_name`: Name of the function to call or attribute to return (str)
 - `args`: (Optional) List of arguments for the function (list)
 - `kwargs`: (Optiona) Dictionary of keyword arguments for the function (dict)
 
-The response is returned as a pickle object.
+The server can also push a stream of frames: after `start_stream`, every frame is sent to the client with the request id of the `start_stream` request (see `instamatic.server.frame_stream`).
+
+The response is returned as a pickle object. Images are sent as raw data following a small header with their dtype and shape (see `instamatic.server.serializer.array_dumper`), unless they are passed via shared memory.
 """
 
     parser = argparse.ArgumentParser(
@@ -191,7 +324,10 @@ The response is returned as a pickle object.
     parser.add_argument('-c', '--camera', action='store', dest='camera',
                         help="""Override camera to use.""")
 
-    parser.set_defaults(camera=None)
+    parser.add_argument('-a', '--asyncio', action='store_true', dest='use_asyncio',
+                        help="""Serve the client connections from a single asyncio event loop instead of one thread per connection.""")
+
+    parser.set_defaults(camera=None, use_asyncio=False)
     options = parser.parse_args()
     camera = options.camera
 
@@ -203,11 +339,22 @@ The response is returned as a pickle object.
     logging.captureWarnings(True)
     log = logging.getLogger(__name__)
 
-    q = queue.Queue(maxsize=100)
+    if options.use_asyncio:
+        # do not block the event loop on a full queue
+        q = queue.Queue()
+    else:
+        q = queue.Queue(maxsize=100)
 
     cam_reader = CamServer(name=camera, log=log, q=q)
     cam_reader.start()
 
+    if options.use_asyncio:
+        from . import async_server
+        log.info(f'Server listening on {HOST}:{PORT} (asyncio)')
+        print(f'Server listening on {HOST}:{PORT} (asyncio)')
+        async_server.run(q, HOST, PORT, dumper=reply_dumper)
+        return
+
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind((HOST, PORT))
     s.listen(5)
@@ -218,6 +365,7 @@ The response is returned as a pickle object.
     with s:
         while True:
             conn, addr = s.accept()
+            configure_socket(conn)
             log.info('Connected by %s', addr)
             print('Connected by', addr)
             threading.Thread(target=handle, args=(conn, q)).start()
@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
+
+from .protocol import send_frame
+
+
+class RequestDispatcher:
+    """Dispatch requests from the server queue to the microscope/camera.
+
+    Read-only requests (i.e. `getStagePosition`) are executed
+    concurrently in a thread pool, so that requests from different
+    clients do not block each other. Requests that change the state are
+    serialized: they wait until all reads in flight have finished and
+    are executed in the order they were received. Reads received after
+    a write are only started once the write has completed.
+
+    The result of every request is passed back via the `reply` future
+    that comes with the request.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._reads = set()
+
+    def dispatch(self, func, reply: Future, read_only: bool = False):
+        """Call `func` and set its return value as the result of `reply`."""
+        if read_only:
+            future = self._executor.submit(self._execute, func, reply)
+            self._reads.add(future)
+            future.add_done_callback(self._reads.discard)
+        else:
+            self.wait_for_reads()
+            self._execute(func, reply)
+
+    def wait_for_reads(self):
+        """Block until all read-only requests in flight have completed."""
+        wait(set(self._reads))
+
+    def _execute(self, func, reply: Future):
+        try:
+            reply.set_result(func())
+        except Exception as e:
+            reply.set_exception(e)
+
+
+def send_reply(conn, lock: threading.Lock, request_id: int, dumper, reply: Future):
+    """Send the result of the `reply` future over connection `conn`."""
+    response = reply.result()
+    try:
+        push(conn, lock, request_id, dumper, response)
+    except OSError:
+        # connection has been closed by the client
+        pass
+
+
+def push(conn, lock: threading.Lock, request_id: int, dumper, response):
+    """Send `response` over connection `conn`, blocks until sent."""
+    payload = dumper(response)
+    with lock:
+        send_frame(conn, request_id, payload)
+
+
+def make_reply(conn, lock: threading.Lock, request_id: int, dumper) -> Future:
+    """Create a future that sends the response to the client once the
+    result is available."""
+    reply = Future()
+    reply.add_done_callback(partial(send_reply, conn, lock, request_id, dumper))
+    return reply
+
+
+def is_stream_request(data) -> bool:
+    """Check if the request `data` starts a stream, that is, the server
+    pushes several responses for a single request."""
+    return isinstance(data, dict) and data.get('attr_name') == 'start_stream'
@@ -0,0 +1,145 @@
+"""Shared-memory ring buffer for passing camera frames between processes.
+
+The ring consists of `nslots` frame buffers of the same shape and dtype
+in a single shared memory block. The block starts with a small header
+that stores, for every slot, the sequence number of the frame in the
+slot and whether the slot is leased:
+
+    | seq/leased (nslots x 2 x int64) | slot 0 | slot 1 | ... |
+
+The server (`CamServer`) writes each new frame to a slot that is not
+leased, and marks it as leased before handing the slot to the client.
+The client (`CamClient`) gets a zero-copy view of the slot, and the
+lease is released once the view (and all arrays derived from it) has
+been garbage collected, or when `release` is called explicitly. The
+server never touches a leased slot, so a client can hold on to several
+frames without copying while new ones are written.
+
+Only the server sets the lease flag (0 -> 1) and only the client that
+holds the frame clears it (1 -> 0), so no lock is needed between the
+processes.
+"""
+import weakref
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+SEQ = 0
+LEASED = 1
+ALIGNMENT = 64
+
+
+class FrameRing:
+    """N-slot ring buffer of frames in shared memory.
+
+    Use `FrameRing.create` on the server side and `FrameRing.attach` on
+    the client side.
+    """
+
+    def __init__(self, shm, shape: tuple, dtype, nslots: int, owner: bool = False):
+        super().__init__()
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.nslots = nslots
+        self.owner = owner
+
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.offset = self.header_nbytes(nslots)
+
+        self.header = np.ndarray((nslots, 2), dtype=np.int64, buffer=shm.buf)
+        self.slots = np.ndarray((nslots, *self.shape), dtype=self.dtype, buffer=shm.buf, offset=self.offset)
+
+        self._seq = 0
+        self._next = 0
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(name={self.name!r}, shape={self.shape}, dtype={self.dtype}, nslots={self.nslots})'
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @staticmethod
+    def header_nbytes(nslots: int) -> int:
+        nbytes = nslots * 2 * np.dtype(np.int64).itemsize
+        return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+    @classmethod
+    def create(cls, shape: tuple, dtype, nslots: int = 8) -> 'FrameRing':
+        """Create a new ring buffer in shared memory (server side)."""
+        frame_nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        size = cls.header_nbytes(nslots) + nslots * frame_nbytes
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ring = cls(shm, shape, dtype, nslots, owner=True)
+        ring.header[:] = 0
+        ring.header[:, SEQ] = -1
+        return ring
+
+    @classmethod
+    def attach(cls, name: str, shape: tuple, dtype, nslots: int) -> 'FrameRing':
+        """Attach to an existing ring buffer by name (client side)."""
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, dtype, nslots)
+
+    def free_slots(self) -> int:
+        """Return the number of slots that are not leased."""
+        return int(np.sum(self.header[:, LEASED] == 0))
+
+    def write(self, arr: np.ndarray) -> Optional[Tuple[int, int]]:
+        """Copy `arr` to the next free slot and lease it (server side).
+
+        Returns a tuple `(slot, seq)`, or None if all slots are leased.
+        """
+        for i in range(self.nslots):
+            slot = (self._next + i) % self.nslots
+            if not self.header[slot, LEASED]:
+                break
+        else:
+            return None
+
+        self.slots[slot] = arr
+        self._seq += 1
+        self.header[slot, SEQ] = self._seq
+        self.header[slot, LEASED] = 1
+
+        self._next = (slot + 1) % self.nslots
+
+        return slot, self._seq
+
+    def view(self, slot: int, seq: int) -> np.ndarray:
+        """Return a zero-copy view of the frame in `slot` (client side).
+
+        The lease on the slot is released when the view, and all arrays
+        derived from it, are garbage collected.
+        """
+        if self.header[slot, SEQ] != seq:
+            raise RuntimeError(f'Frame {seq} in slot {slot} of `{self.name}` has been overwritten')
+
+        arr = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf,
+                         offset=self.offset + slot * self.frame_nbytes)
+        weakref.finalize(arr, self.release, slot, seq)
+        return arr
+
+    def release(self, slot: int, seq: int) -> None:
+        """Release the lease on `slot`, so that the server can reuse it."""
+        try:
+            if self.header[slot, SEQ] == seq:
+                self.header[slot, LEASED] = 0
+        except AttributeError:
+            # shared memory has already been closed
+            pass
+
+    def close(self) -> None:
+        """Close the shared memory, and remove it if this is the server."""
+        del self.header
+        del self.slots
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,132 @@
+"""Server-push frame streams for the CAM server.
+
+A stream is started by the client with `start_stream`. The server then
+acquires frames back-to-back in a dedicated thread, and pushes them to
+the client as they come in, all tagged with the request id of the
+`start_stream` request:
+
+    (200, {'index': 1, 'timestamp': ..., 'image': arr, 'dropped': 0})
+    (200, {'index': 2, ...})
+    ...
+    (200, {'index': None, 'acquired': n, 'dropped': k, 'error': None})  # end of stream
+
+If the acquisition fails, the stream is ended and the exception is
+passed as `error` (a tuple of the exception name and args).
+
+Acquisition and sending are decoupled by a bounded queue. If the client
+(or the network) cannot keep up, the queue fills up and new frames are
+dropped and counted, rather than slowing down the acquisition.
+"""
+import queue
+import threading
+import time
+from collections import namedtuple
+
+Frame = namedtuple('Frame', 'index timestamp image')
+Frame.__doc__ = """Single frame from a stream, `index` counts from 1 and
+`timestamp` is the time (`time.time()`) at which the frame was read
+out."""
+
+
+class FrameStream:
+    """Acquire frames back-to-back, and push them to the client.
+
+    acquire:
+        Function that acquires a single frame (numpy array)
+    push:
+        Function that sends a response (status, data) to the client,
+        blocks while the client is not reading
+    n:
+        Number of frames to acquire, acquire until `stop` if None
+    maxsize:
+        Maximum number of frames waiting to be sent
+    log:
+        Instance of `logging.Logger`
+    """
+
+    def __init__(self, acquire, push, n: int = None, maxsize: int = 8, log=None):
+        super().__init__()
+        self.acquire = acquire
+        self.push = push
+        self.n = n
+        self.log = log
+
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.stop_event = threading.Event()
+
+        self.acquired = 0
+        self.dropped = 0
+        self.error = None
+
+        self._acquire_thread = threading.Thread(target=self._acquire_loop, daemon=True)
+        self._send_thread = threading.Thread(target=self._send_loop, daemon=True)
+
+    def start(self):
+        self._send_thread.start()
+        self._acquire_thread.start()
+
+    def stop(self):
+        """Stop acquiring, the frames already acquired are still sent."""
+        self.stop_event.set()
+
+    def join(self, timeout: float = None):
+        self._acquire_thread.join(timeout)
+        self._send_thread.join(timeout)
+
+    @property
+    def is_running(self) -> bool:
+        return self._send_thread.is_alive()
+
+    def stats(self) -> dict:
+        return {'index': None, 'acquired': self.acquired, 'dropped': self.dropped, 'error': self.error}
+
+    def _acquire_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                if self.n is not None and self.acquired >= self.n:
+                    break
+
+                image = self.acquire()
+                self.acquired += 1
+
+                item = {
+                    'index': self.acquired,
+                    'timestamp': time.time(),
+                    'image': image,
+                    'dropped': self.dropped,
+                }
+
+                try:
+                    self.queue.put_nowait((200, item))
+                except queue.Full:
+                    self.dropped += 1
+        except Exception as e:
+            if self.log:
+                self.log.exception(e)
+            self.error = (e.__class__.__name__, e.args)
+        finally:
+            self.queue.put((200, self.stats()))
+
+    def _send_loop(self):
+        connected = True
+
+        while True:
+            response = self.queue.get()
+            _, data = response
+
+            if connected:
+                try:
+                    self.push(response)
+                except OSError as e:
+                    # connection has been closed by the client, keep
+                    # emptying the queue until the acquisition has stopped
+                    if self.log:
+                        self.log.info('Stream closed by client: %s', e)
+                    connected = False
+                    self.stop()
+
+            if data['index'] is None:
+                break
+
+        if self.log:
+            self.log.info('Stream finished: %d frames acquired, %d dropped', self.acquired, self.dropped)
@@ -0,0 +1,347 @@
+"""Framing for the TEM/CAM socket protocol.
+
+Every message on the socket is prefixed by a fixed-size header that
+holds the request id and the length of the serialized payload:
+
+    | request_id (uint32) | length (uint64) | payload (`length` bytes) |
+
+The length prefix makes it possible to send replies of any size (e.g.
+full frames over a non-shared-memory `getImage`), and the request id
+allows a client to have several requests outstanding on the same
+connection (pipelining). The server echoes the request id, so that
+replies can be matched to their requests even if they arrive out of
+order.
+"""
+import asyncio
+import collections
+import itertools
+import socket
+import struct
+import threading
+from typing import Optional
+from typing import Tuple
+
+HEADER = struct.Struct('!IQ')
+MAX_REQUEST_ID = 2**32
+
+
+def configure_socket(sock: socket.socket) -> None:
+    """Disable Nagle's algorithm, so that small requests/replies are sent
+    immediately."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def payload_nbytes(payload) -> int:
+    """Return the length of `payload` (bytes or a list of buffers) in
+    bytes."""
+    if isinstance(payload, list):
+        return sum(memoryview(buf).nbytes for buf in payload)
+    return len(payload)
+
+
+def sendmsg_all(sock: socket.socket, buffers: list) -> None:
+    """Send all `buffers` back-to-back without joining them.
+
+    Uses scatter/gather I/O (`sendmsg`) where available, so that large
+    buffers (i.e. images) are not copied.
+    """
+    if not hasattr(sock, 'sendmsg'):
+        # Windows
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+
+    buffers = [memoryview(buf).cast('B') for buf in buffers]
+    while buffers:
+        n = sock.sendmsg(buffers)
+        while buffers and n >= buffers[0].nbytes:
+            n -= buffers.pop(0).nbytes
+        if n:
+            buffers[0] = buffers[0][n:]
+
+
+def send_frame(sock: socket.socket, request_id: int, payload) -> None:
+    """Send `payload` as a single frame tagged with `request_id`.
+
+    `payload` is a bytes-like object, or a list of buffers that are
+    sent as one frame (see `serializer.array_dumper`).
+    """
+    header = HEADER.pack(request_id, payload_nbytes(payload))
+    if isinstance(payload, list):
+        sendmsg_all(sock, [header, *payload])
+    elif len(payload) < 65536:
+        sock.sendall(header + payload)
+    else:
+        # avoid copying large payloads (i.e. images)
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def recv_exactly(sock: socket.socket, nbytes: int) -> Optional[bytearray]:
+    """Receive exactly `nbytes` from the socket into a preallocated buffer.
+
+    Returns None if the connection is closed before any data are
+    received. Raises `ConnectionError` if the connection is closed
+    halfway.
+    """
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    pos = 0
+    while pos < nbytes:
+        n = sock.recv_into(view[pos:], nbytes - pos)
+        if not n:
+            if pos == 0:
+                return None
+            raise ConnectionError(f'Connection closed after {pos}/{nbytes} bytes')
+        pos += n
+    return buf
+
+
+def recv_frame(sock: socket.socket) -> Optional[Tuple[int, bytearray]]:
+    """Receive a single frame from the socket.
+
+    Returns a tuple `(request_id, payload)`, or None if the connection
+    was closed by the other side.
+    """
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    request_id, length = HEADER.unpack(header)
+
+    payload = recv_exactly(sock, length) if length else bytearray()
+    if payload is None:
+        raise ConnectionError('Connection closed before payload was received')
+
+    return request_id, payload
+
+
+class Connection:
+    """Client side of a framed connection.
+
+    Can be shared between threads: each request gets a unique request
+    id, and every thread waits for the reply matching its own request.
+    Whichever thread is reading from the socket stores the replies for
+    the other threads, so that several requests can be in flight at the
+    same time.
+
+    A stream (`open_stream`) is a request for which the server sends
+    any number of replies, which are received in order with
+    `receive_stream`.
+    """
+
+    def __init__(self, sock: socket.socket):
+        super().__init__()
+        self.sock = sock
+
+        self._request_ids = itertools.count(1)
+        self._replies = {}
+        self._streams = {}
+        self._send_lock = threading.Lock()
+        self._recv_condition = threading.Condition()
+        self._receiving = False
+
+    def send(self, payload: bytes) -> int:
+        """Send `payload` to the server, returns the request id."""
+        with self._send_lock:
+            request_id = next(self._request_ids) % MAX_REQUEST_ID
+            send_frame(self.sock, request_id, payload)
+        return request_id
+
+    def receive(self, request_id: int) -> bytearray:
+        """Block until the reply for `request_id` has been received."""
+        with self._recv_condition:
+            self._wait_for(lambda: request_id in self._replies)
+            return self._replies.pop(request_id)
+
+    def request(self, payload: bytes) -> bytearray:
+        """Send `payload` and wait for the reply."""
+        request_id = self.send(payload)
+        return self.receive(request_id)
+
+    def open_stream(self, payload: bytes) -> int:
+        """Send `payload` to the server, and collect all replies to it until
+        `close_stream` is called. Returns the request id."""
+        with self._send_lock:
+            request_id = next(self._request_ids) % MAX_REQUEST_ID
+            with self._recv_condition:
+                self._streams[request_id] = collections.deque()
+            send_frame(self.sock, request_id, payload)
+        return request_id
+
+    def receive_stream(self, request_id: int) -> bytearray:
+        """Block until the next reply for stream `request_id` has been
+        received."""
+        with self._recv_condition:
+            replies = self._streams[request_id]
+            self._wait_for(lambda: replies)
+            return replies.popleft()
+
+    def close_stream(self, request_id: int) -> None:
+        """Stop collecting the replies for stream `request_id`."""
+        with self._recv_condition:
+            self._streams.pop(request_id, None)
+
+    def _wait_for(self, predicate) -> None:
+        """Receive replies until `predicate()` is true, must be called with
+        the receive condition acquired."""
+        while not predicate():
+            if self._receiving:
+                # another thread is reading from the socket
+                self._recv_condition.wait()
+                continue
+
+            self._receiving = True
+            self._recv_condition.release()
+            try:
+                frame = recv_frame(self.sock)
+            finally:
+                self._recv_condition.acquire()
+                self._receiving = False
+                self._recv_condition.notify_all()
+
+            if frame is None:
+                raise ConnectionError('Connection was closed by the server')
+
+            reply_id, payload = frame
+            if reply_id in self._streams:
+                self._streams[reply_id].append(payload)
+            else:
+                self._replies[reply_id] = payload
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[Tuple[int, bytes]]:
+    """Read a single frame from an asyncio stream.
+
+    Returns a tuple `(request_id, payload)`, or None if the connection
+    was closed by the other side.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError('Connection closed before header was received') from e
+
+    request_id, length = HEADER.unpack(header)
+
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError('Connection closed before payload was received') from e
+
+    return request_id, payload
+
+
+def write_frame(writer: asyncio.StreamWriter, request_id: int, payload) -> None:
+    """Write `payload` (bytes or a list of buffers) as a single frame tagged
+    with `request_id` to an asyncio stream (call `await writer.drain()`
+    afterwards)."""
+    writer.write(HEADER.pack(request_id, payload_nbytes(payload)))
+    if isinstance(payload, list):
+        writer.writelines(payload)
+    else:
+        writer.write(payload)
+
+
+class AsyncConnection:
+    """Client side of a framed connection for use with asyncio.
+
+    A background task reads the replies from the stream and resolves
+    the future of the matching request, so that any number of requests
+    can be awaited concurrently.
+
+    Usage:
+        conn = await AsyncConnection.open(host, port)
+        reply = await conn.request(payload)
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        super().__init__()
+        self.reader = reader
+        self.writer = writer
+
+        self._request_ids = itertools.count(1)
+        self._replies = {}
+        self._streams = {}
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> 'AsyncConnection':
+        """Open a connection to the server at `host`:`port`."""
+        reader, writer = await asyncio.open_connection(host, port)
+        configure_socket(writer.get_extra_info('socket'))
+        return cls(reader, writer)
+
+    def send(self, payload: bytes) -> int:
+        """Queue `payload` to be sent to the server, returns the request
+        id."""
+        request_id = next(self._request_ids) % MAX_REQUEST_ID
+        self._replies[request_id] = asyncio.get_event_loop().create_future()
+        write_frame(self.writer, request_id, payload)
+        return request_id
+
+    async def receive(self, request_id: int) -> bytes:
+        """Wait for the reply for `request_id`."""
+        await self.writer.drain()
+        try:
+            return await self._replies[request_id]
+        finally:
+            del self._replies[request_id]
+
+    async def request(self, payload: bytes) -> bytes:
+        """Send `payload` and wait for the reply."""
+        request_id = self.send(payload)
+        return await self.receive(request_id)
+
+    def open_stream(self, payload: bytes) -> int:
+        """Queue `payload` to be sent to the server, and collect all replies
+        to it until `close_stream` is called. Returns the request id."""
+        request_id = next(self._request_ids) % MAX_REQUEST_ID
+        self._streams[request_id] = asyncio.Queue()
+        write_frame(self.writer, request_id, payload)
+        return request_id
+
+    async def receive_stream(self, request_id: int) -> bytes:
+        """Wait for the next reply for stream `request_id`."""
+        await self.writer.drain()
+        payload = await self._streams[request_id].get()
+        if isinstance(payload, Exception):
+            raise payload
+        return payload
+
+    def close_stream(self, request_id: int) -> None:
+        """Stop collecting the replies for stream `request_id`."""
+        self._streams.pop(request_id, None)
+
+    async def close(self):
+        """Close the connection."""
+        self.writer.close()
+        await self._reader_task
+
+    async def _read_replies(self):
+        """Resolve the futures of the outstanding requests as the replies
+        come in."""
+        error = ConnectionError('Connection was closed by the server')
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame is None:
+                    break
+
+                request_id, payload = frame
+                if request_id in self._streams:
+                    self._streams[request_id].put_nowait(payload)
+                    continue
+
+                future = self._replies.get(request_id)
+                if future is not None and not future.done():
+                    future.set_result(payload)
+        except (ConnectionError, OSError) as e:
+            error = e
+        finally:
+            for future in self._replies.values():
+                if not future.done():
+                    future.set_exception(error)
+            for stream in self._streams.values():
+                stream.put_nowait(error)
@@ -1,6 +1,8 @@
 import json
 import pickle
+import struct
 
+import numpy as np
 import yaml
 
 from instamatic.config import settings
@@ -12,6 +14,14 @@ PROTOCOL = settings.tem_communication_protocol
 # - msgpack: 512 µs ± 27.2 µs per loop (mean ± std. dev. of 7 runs, 1000 loops each)
 # - yaml:   4.43 ms ± 13.7 µs per loop (mean ± std. dev. of 7 runs, 1000 loops each)
 
+# Reply to `getImage` (`(200, arr)`, 2048x2048 uint16, 8 MB), see
+# `scripts/benchmark_serializer.py` (dumps / loads / round trip over a local socket):
+# - pickle:        7.13 ms / 869 µs / 19.9 ms
+# - array+pickle:  6.2 µs  / 11.8 µs / 2.34 ms
+# - array+json:    8.5 µs  / 12.4 µs / 2.51 ms
+# - array+msgpack: 5.9 µs  / 10.9 µs / 2.75 ms
+# Remote `getImage` over TCP is then limited by the network bandwidth.
+
 
 def json_loader(data):
     return json.loads(data.decode())
@@ -50,6 +60,102 @@ else:
         return msgpack.dumps(data)
 
 
+ARRAY_MAGIC = b'\x00NDA'
+ARRAY_HEADER = struct.Struct('!4sQ')  # magic, length of the metadata
+ARRAY_KEY = '__ndarray__'
+ALIGNMENT = 64
+
+
+def _extract_arrays(obj, arrays: list):
+    """Replace all numpy arrays in (nested) tuples/lists/dicts in `obj` by a
+    placeholder, and append the arrays to `arrays`."""
+    if isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        arrays.append(np.ascontiguousarray(obj))
+        return {ARRAY_KEY: len(arrays) - 1}
+    elif isinstance(obj, tuple):
+        return tuple(_extract_arrays(item, arrays) for item in obj)
+    elif isinstance(obj, list):
+        return [_extract_arrays(item, arrays) for item in obj]
+    elif isinstance(obj, dict):
+        return {key: _extract_arrays(value, arrays) for key, value in obj.items()}
+    else:
+        return obj
+
+
+def _insert_arrays(obj, arrays: list):
+    """Inverse of `_extract_arrays`."""
+    if isinstance(obj, dict):
+        if ARRAY_KEY in obj:
+            return arrays[obj[ARRAY_KEY]]
+        return {key: _insert_arrays(value, arrays) for key, value in obj.items()}
+    elif isinstance(obj, tuple):
+        return tuple(_insert_arrays(item, arrays) for item in obj)
+    elif isinstance(obj, list):
+        return [_insert_arrays(item, arrays) for item in obj]
+    else:
+        return obj
+
+
+def array_dumper(data, dumper=pickle_dumper):
+    """Serialize `data` so that numpy arrays are sent as raw buffers.
+
+    Returns a list of buffers to be sent back-to-back (see
+    `protocol.send_frame`): a header, the metadata serialized with
+    `dumper` (the arrays replaced by their dtype/shape), and the data of
+    every array, which are not copied:
+
+        | magic | len(meta) | meta | padding | array 0 | array 1 | ... |
+
+    If `data` does not contain any arrays, `dumper(data)` is returned.
+    """
+    arrays = []
+    obj = _extract_arrays(data, arrays)
+    if not arrays:
+        return dumper(data)
+
+    descr = [(arr.dtype.str, list(arr.shape)) for arr in arrays]
+    meta = dumper({'data': obj, 'arrays': descr})
+
+    # align the array data in the payload
+    padding = -(ARRAY_HEADER.size + len(meta)) % ALIGNMENT
+    header = ARRAY_HEADER.pack(ARRAY_MAGIC, len(meta))
+
+    buffers = [header + meta + bytes(padding)]
+    buffers.extend(memoryview(arr.reshape(-1).view(np.uint8)) for arr in arrays)
+
+    return buffers
+
+
+def array_loader(data, loader=pickle_loader):
+    """Deserialize data encoded with `array_dumper`.
+
+    The arrays are views on `data` (zero-copy), so they are writable if
+    `data` is writable (e.g. a `bytearray` from `protocol.recv_frame`).
+    Falls back to `loader(data)` for data without arrays.
+    """
+    if not data[:len(ARRAY_MAGIC)] == ARRAY_MAGIC:
+        return loader(data)
+
+    _, meta_len = ARRAY_HEADER.unpack_from(data)
+    offset = ARRAY_HEADER.size + meta_len
+    meta = loader(bytes(data[ARRAY_HEADER.size:offset]))
+    offset += -offset % ALIGNMENT
+
+    readonly = memoryview(data).readonly
+
+    arrays = []
+    for dtype, shape in meta['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=offset).reshape(shape)
+        if readonly:
+            arr = arr.copy()
+        arrays.append(arr)
+        offset += count * dtype.itemsize
+
+    return _insert_arrays(meta['data'], arrays)
+
+
 if PROTOCOL == 'json':
     loader = json_loader
     dumper = json_dumper
@@ -6,18 +6,20 @@ import queue
 import socket
 import threading
 import traceback
+from functools import partial
 
+from .dispatcher import make_reply
+from .dispatcher import RequestDispatcher
+from .protocol import configure_socket
+from .protocol import recv_frame
 from .serializer import dumper
 from .serializer import loader
 from instamatic import config
 from instamatic.TEMController import Microscope
 
-condition = threading.Condition()
-box = []
-
 HOST = config.settings.tem_server_host
 PORT = config.settings.tem_server_port
-BUFSIZE = 1024
+MAX_WORKERS = config.settings.tem_server_max_workers
 
 
 class TemServer(threading.Thread):
@@ -28,9 +30,14 @@ class TemServer(threading.Thread):
     microscope. Start the server using `TemServer.run` which will wait
     for items to appear on `q` and execute them on the specified
     microscope instance.
+
+    Items on `q` are tuples of the command and a future that receives
+    the response. Read-only calls (`get*`/`is*`) are executed
+    concurrently using `max_workers` threads, all other calls are
+    serialized (see `RequestDispatcher`).
     """
 
-    def __init__(self, log=None, q=None, name=None):
+    def __init__(self, log=None, q=None, name=None, max_workers: int = MAX_WORKERS):
         super().__init__()
 
         self.log = log
@@ -41,54 +48,104 @@ class TemServer(threading.Thread):
 
         self.verbose = False
 
+        self.dispatcher = RequestDispatcher(max_workers=max_workers)
+
     def run(self):
         """Start the server thread."""
         self.tem = Microscope(name=self._name, use_server=False)
         print(f'Initialized connection to microscope: {self.tem.name}')
 
         while True:
-            now = datetime.datetime.now().strftime('%H:%M:%S.%f')
-
-            cmd = self.q.get()
-
-            with condition:
-                func_name = cmd['func_name']
-                args = cmd.get('args', ())
-                kwargs = cmd.get('kwargs', {})
-
-                try:
-                    ret = self.evaluate(func_name, args, kwargs)
-                    status = 200
-                except Exception as e:
-                    traceback.print_exc()
-                    if self.log:
-                        self.log.exception(e)
-                    ret = (e.__class__.__name__, e.args)
-                    status = 500
-
-                box.append((status, ret))
-                condition.notify()
-                if self.verbose:
-                    print(f'{now} | {status} {func_name}: {ret}')
+            cmd, reply = self.q.get()
+
+            read_only = self.is_read_only(cmd['func_name'], cmd.get('args', ()))
+
+            self.dispatcher.dispatch(partial(self.execute, cmd), reply=reply, read_only=read_only)
+
+    def execute(self, cmd: dict) -> tuple:
+        """Execute the command `cmd` and return a tuple of the status code
+        and return value."""
+        now = datetime.datetime.now().strftime('%H:%M:%S.%f')
+
+        func_name = cmd['func_name']
+        args = cmd.get('args', ())
+        kwargs = cmd.get('kwargs', {})
+
+        try:
+            ret = self.evaluate(func_name, args, kwargs)
+            status = 200
+        except Exception as e:
+            traceback.print_exc()
+            if self.log:
+                self.log.exception(e)
+            ret = (e.__class__.__name__, e.args)
+            status = 500
+
+        if self.verbose:
+            print(f'{now} | {status} {func_name}: {ret}')
+
+        return status, ret
+
+    def is_read_only(self, func_name: str, args: list = ()) -> bool:
+        """Check whether the function `func_name` only reads the state of the
+        microscope, so that it can be run concurrently with other reads."""
+        if func_name == 'batch':
+            calls = args[0] if args else ()
+            return all(self.is_read_only(call[0]) for call in calls)
+
+        return func_name.startswith(('get', 'is'))
 
     def evaluate(self, func_name: str, args: list, kwargs: dict):
         """Evaluate the function `func_name` on `self.tem` and call it with
         `args` and `kwargs`."""
         # print(func_name, args, kwargs)
+        if func_name == 'batch':
+            return self.batch(*args, **kwargs)
+
         f = getattr(self.tem, func_name)
         ret = f(*args, **kwargs)
         return ret
 
+    def batch(self, calls: list) -> list:
+        """Evaluate a list of calls in a single request, so that the client
+        pays the round trip only once.
+
+        `calls` is a list of `(func_name, args, kwargs)` tuples. Returns
+        a list of `(status, ret)` tuples, one for each call. An error in
+        one of the calls does not stop the evaluation of the others.
+        """
+        rets = []
+        for func_name, args, kwargs in calls:
+            try:
+                ret = self.evaluate(func_name, args, kwargs)
+                status = 200
+            except Exception as e:
+                if self.log:
+                    self.log.exception(e)
+                ret = (e.__class__.__name__, e.args)
+                status = 500
+            rets.append((status, ret))
+
+        return rets
+
 
 def handle(conn, q):
     """Handle incoming connection, put command on the Queue `q`, which is then
-    handled by TEMServer."""
+    handled by TEMServer.
+
+    Requests are put on the queue as soon as they are received, the
+    responses are sent back (possibly out of order) when they become
+    available.
+    """
+    lock = threading.Lock()
+
     with conn:
         while True:
-            data = conn.recv(BUFSIZE)
-            if not data:
+            frame = recv_frame(conn)
+            if frame is None:
                 break
 
+            request_id, data = frame
             data = loader(data)
 
             if data == 'exit':
@@ -97,11 +154,8 @@ def handle(conn, q):
             if data == 'kill':
                 break
 
-            with condition:
-                q.put(data)
-                condition.wait()
-                response = box.pop()
-                conn.send(dumper(response))
+            reply = make_reply(conn, lock, request_id, dumper)
+            q.put((data, reply))
 
 
 def main():
@@ -120,6 +174,8 @@ This program initializes a connection to the TEM as defined in the config. On so
 
 The host and port are defined in `config/settings.yaml`.
 
+Each message sent over the socket is framed by a header containing the request id (uint32) and the length of the payload (uint64). The server echoes the request id with the reply, so that a client can pipeline several requests on the same connection.
+
 The data sent over the socket is a serialized dictionary with the following elements:
 
 - `func_name`: Name of the function to call (str)
@@ -127,6 +183,8 @@ The data sent over the socket is a serialized dictionary with the following elem
 - `kwargs`: (Optiona) Dictionary of keyword arguments for the function (dict)
 
 The response is returned as a serialized object.
+
+Several calls can be combined in a single request using `func_name='batch'`, with `args` containing a list of `(func_name, args, kwargs)` tuples. The response is a list of `(status, response)` tuples.
 """
 
     parser = argparse.ArgumentParser(
@@ -136,7 +194,10 @@ The response is returned as a serialized object.
     parser.add_argument('-t', '--microscope', action='store', dest='microscope',
                         help="""Override microscope to use.""")
 
-    parser.set_defaults(microscope=None)
+    parser.add_argument('-a', '--asyncio', action='store_true', dest='use_asyncio',
+                        help="""Serve the client connections from a single asyncio event loop instead of one thread per connection.""")
+
+    parser.set_defaults(microscope=None, use_asyncio=False)
     options = parser.parse_args()
     microscope = options.microscope
 
@@ -148,11 +209,22 @@ The response is returned as a serialized object.
     logging.captureWarnings(True)
     log = logging.getLogger(__name__)
 
-    q = queue.Queue(maxsize=100)
+    if options.use_asyncio:
+        # do not block the event loop on a full queue
+        q = queue.Queue()
+    else:
+        q = queue.Queue(maxsize=100)
 
     tem_reader = TemServer(name=microscope, log=log, q=q)
     tem_reader.start()
 
+    if options.use_asyncio:
+        from . import async_server
+        log.info(f'Server listening on {HOST}:{PORT} (asyncio)')
+        print(f'Server listening on {HOST}:{PORT} (asyncio)')
+        async_server.run(q, HOST, PORT)
+        return
+
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind((HOST, PORT))
     s.listen(5)
@@ -163,6 +235,7 @@ The response is returned as a serialized object.
     with s:
         while True:
             conn, addr = s.accept()
+            configure_socket(conn)
             log.info('Connected by %s', addr)
             print('Connected by', addr)
             threading.Thread(target=handle, args=(conn, q)).start()
@@ -0,0 +1,213 @@
+"""Plan the order in which a list of stage positions is visited.
+
+The stage moves x and y at the same time, so the time a move takes is
+set by the longest of the two displacements (Chebyshev distance). With
+backlash correction, every position is approached from the same
+(negative) side: the stage first moves to `(x - step, y - step)` and
+then to `(x, y)`. A position that already lies in the approach direction
+of the previous one (`dx >= 0` and `dy >= 0`) can be reached directly.
+This makes the cost of a move asymmetric, which is taken into account
+when the path is optimized.
+"""
+import numpy as np
+
+# improvements smaller than this (nm) are ignored
+TOLERANCE = 1.0
+
+
+def needs_backlash_correction(start, target) -> bool:
+    """Return True if the stage cannot move directly from `start` to
+    `target` while keeping the common approach direction."""
+    return not np.all(np.asarray(target) >= np.asarray(start))
+
+
+def get_moves(start, target, step: float = 10000) -> list:
+    """Return the list of (x, y) positions the stage moves through to get
+    from `start` to `target` approaching from the common direction. If
+    `start` is None (i.e. unknown backlash state), backlash is always
+    corrected. `step=0` disables backlash correction."""
+    x, y = target
+    if step and (start is None or needs_backlash_correction(start, target)):
+        return [(x - step, y - step), (x, y)]
+    else:
+        return [(x, y)]
+
+
+def cost_matrix(coords, step: float = 10000) -> 'np.array':
+    """Return the matrix with the stage travel (nm) to move from position
+    `i` to `j` (`cost[i, j]`), including the backlash correction."""
+    coords = np.asarray(coords, dtype=float)[:, :2]
+    delta = coords[np.newaxis, :, :] - coords[:, np.newaxis, :]
+    cost = np.abs(delta).max(axis=-1)
+    if step:
+        corrected = np.abs(delta - step).max(axis=-1) + step
+        direct = np.all(delta >= 0, axis=-1)
+        cost = np.where(direct, cost, corrected)
+    return cost
+
+
+def path_length(coords, start=None, step: float = 10000) -> float:
+    """Return the total stage travel (nm) to visit `coords` in the given
+    order starting from `start`."""
+    coords = np.asarray(coords, dtype=float)[:, :2]
+    total = 0.0
+    current = start
+    for target in coords:
+        for move in get_moves(current, target, step=step):
+            if current is not None:
+                total += np.abs(np.subtract(move, current)).max()
+            current = move
+    return total
+
+
+def _path_cost(cost, path) -> float:
+    return cost[path[:-1], path[1:]].sum()
+
+
+def _nearest_neighbour(cost) -> 'np.array':
+    """Greedy path starting from node 0."""
+    n = len(cost)
+    path = [0]
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, cost[path[-1]])
+        nxt = int(np.argmin(row))
+        path.append(nxt)
+        visited[nxt] = True
+    return np.array(path)
+
+
+def _two_opt(cost, path, max_passes: int = 100) -> 'np.array':
+    """Improve an open path that starts at node 0 by reversing segments.
+
+    Because the costs are asymmetric, reversing `path[i:j+1]` also
+    changes the cost of the edges inside the segment. These are obtained
+    from the cumulative costs in the forward and backward direction, so
+    that every candidate move is evaluated in constant time.
+    """
+    path = path.copy()
+    n = len(path)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, n - 1):
+            forward = np.concatenate([[0], np.cumsum(cost[path[:-1], path[1:]])])
+            backward = np.concatenate([[0], np.cumsum(cost[path[1:], path[:-1]])])
+
+            j = np.arange(i + 1, n)
+            a, b = path[i - 1], path[i]
+            nxt = path[np.minimum(j + 1, n - 1)]
+            is_last = j == n - 1
+
+            old = cost[a, b] + forward[j] - forward[i] + np.where(is_last, 0, cost[path[j], nxt])
+            new = cost[a, path[j]] + backward[j] - backward[i] + np.where(is_last, 0, cost[b, nxt])
+            delta = new - old
+
+            k = np.argmin(delta)
+            if delta[k] < -TOLERANCE:
+                path[i:j[k] + 1] = path[i:j[k] + 1][::-1]
+                improved = True
+
+        if not improved:
+            break
+
+    return path
+
+
+def _or_opt(cost, path, max_passes: int = 100, segments: tuple = (1, 2, 3)) -> 'np.array':
+    """Improve an open path that starts at node 0 by moving short segments
+    (keeping their direction) to the best position elsewhere in the
+    path."""
+    path = path.copy()
+    n = len(path)
+
+    for _ in range(max_passes):
+        improved = False
+        for length in segments:
+            i = 1
+            while i + length <= n:
+                segment = path[i:i + length]
+                rest = np.concatenate([path[:i], path[i + length:]])
+                first, last = segment[0], segment[-1]
+
+                a = path[i - 1]
+                if i + length < n:
+                    b = path[i + length]
+                    removed = cost[a, b] - cost[a, first] - cost[last, b]
+                else:
+                    removed = -cost[a, first]
+
+                # insert after rest[k]
+                inserted = cost[rest, first]
+                inserted[:-1] += cost[last, rest[1:]] - cost[rest[:-1], rest[1:]]
+                delta = removed + inserted
+                delta[i - 1] = 0  # original position
+
+                k = np.argmin(delta)
+                if delta[k] < -TOLERANCE:
+                    path = np.concatenate([rest[:k + 1], segment, rest[k + 1:]])
+                    improved = True
+                i += 1
+
+        if not improved:
+            break
+
+    return path
+
+
+def _optimize(cost, path, max_passes: int = 100) -> 'np.array':
+    """Alternate 2-opt and or-opt until neither improves the path."""
+    best = _path_cost(cost, path)
+    for _ in range(max_passes):
+        path = _or_opt(cost, _two_opt(cost, path, max_passes=max_passes), max_passes=max_passes)
+        current = _path_cost(cost, path)
+        if current > best - TOLERANCE:
+            break
+        best = current
+    return path
+
+
+def plan_stage_path(coords, start=None, step: float = 10000, max_passes: int = 100) -> 'np.array':
+    """Find a short path to visit all stage positions in `coords`.
+
+    The path is built from a nearest-neighbour tour and from the given
+    order, and both are improved by 2-opt and or-opt moves. The shortest
+    one is returned, so the result is never longer than the given order.
+
+    Parameters
+    ----------
+    coords : array
+        List of (x, y) or (x, y, z) stage positions (nm). Only x and y are
+        used for planning.
+    start : tuple
+        Current (x, y) position of the stage. If None, the path may begin
+        at any position.
+    step : float
+        Step size (nm) for the backlash correction, see `get_moves`. Set to
+        0 to plan without backlash correction.
+    max_passes : int
+        Maximum number of optimization passes over the path.
+
+    Returns
+    -------
+    order : np.array
+        Indices into `coords` in the order they should be visited.
+    """
+    coords = np.asarray(coords, dtype=float)[:, :2]
+    n = len(coords)
+    if n < 2:
+        return np.arange(n)
+
+    # Node 0 is the starting point of the stage
+    cost = np.zeros((n + 1, n + 1))
+    cost[1:, 1:] = cost_matrix(coords, step=step)
+    if start is not None:
+        delta = coords - np.asarray(start, dtype=float)[:2]
+        cost[0, 1:] = np.abs(delta - step).max(axis=-1) + step  # backlash state is unknown
+
+    candidates = [np.arange(n + 1), _nearest_neighbour(cost)]
+    paths = [_optimize(cost, path, max_passes=max_passes) for path in candidates]
+    path = min(paths, key=lambda path: _path_cost(cost, path))
+
+    return path[1:] - 1
@@ -1,3 +1,4 @@
+import concurrent.futures
 import glob
 import os
 import sys
@@ -101,11 +102,11 @@ def find_peak_max(arr: np.ndarray, sigma: int, m: int = 50, w: int = 10, kind: i
         f = interpolate.interp1d(r1, y1[c1 - w: c1 + w + 1], kind=kind)
         r2 = np.linspace(c1 - w, c1 + w, win_len * m)  # extrapolate for subpixel accuracy
         y2 = f(r2)
-        c2 = np.argmax(y2) / m  # find beam center with `m` precision
+        c2 = r2[np.argmax(y2)]  # find beam center with `m` precision
     except ValueError:  # if c1 is too close to the edges, return initial guess
         return c1
 
-    return c2 + c1 - w
+    return c2
 
 
 def find_beam_center(img: np.ndarray, sigma: int = 30, m: int = 100, kind: int = 3) -> (float, float):
@@ -185,6 +186,95 @@ def find_beam_center_with_beamstop(img, z: int = None, method='thresh', plot=Fal
     return np.array((dx, dy))
 
 
+def find_peak_max_subpixel(arr: np.ndarray, sigma: int, axis: int = -1) -> np.ndarray:
+    """Find the position of the peak maximum along `axis` for a batch of
+    1D patterns `arr` (i.e. shape (N, L) for `axis=-1`).
+
+    The patterns are smoothed with a gaussian filter with standard
+    deviation `sigma`, and the subpixel position is obtained
+    analytically by fitting a parabola through the maximum and its two
+    neighbours (falls back to the pixel position at the edges).
+    """
+    arr = np.moveaxis(np.asarray(arr, dtype=float), axis, -1)
+    y = ndimage.gaussian_filter1d(arr, sigma, axis=-1)
+    length = y.shape[-1]
+
+    c = np.argmax(y, axis=-1)
+    i = np.clip(c, 1, length - 2)
+    # values left, at, and right of the maximum
+    ys = np.stack([np.take_along_axis(y, (i + d)[..., None], axis=-1)[..., 0] for d in (-1, 0, 1)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denom = ys[0] - 2 * ys[1] + ys[2]
+        offset = 0.5 * (ys[0] - ys[2]) / denom
+
+    valid = (c == i) & (denom < 0) & (np.abs(offset) <= 1)
+    return np.where(valid, i + offset, c).astype(float)
+
+
+def find_beam_centers(imgs, sigma: int = 30) -> np.ndarray:
+    """Find the center of the primary beam in a stack of images `imgs`
+    (N, H, W) or a sequence of images, using the same approach as
+    `find_beam_center`.
+
+    The projections along X/Y are computed for the whole stack at once,
+    and the peak positions are determined with subpixel precision using
+    `find_peak_max_subpixel` instead of interpolation.
+
+    Returns an array with the beam centers (N, 2).
+    """
+    if isinstance(imgs, np.ndarray) and imgs.ndim == 3:
+        xx = imgs.sum(axis=2)
+        yy = imgs.sum(axis=1)
+    else:
+        xx = np.array([np.sum(img, axis=1) for img in imgs])
+        yy = np.array([np.sum(img, axis=0) for img in imgs])
+
+    if len(xx) == 0:
+        return np.empty((0, 2))
+
+    cx = find_peak_max_subpixel(xx, sigma)
+    cy = find_peak_max_subpixel(yy, sigma)
+
+    return np.stack((cx, cy), axis=1)
+
+
+def _find_beam_center_thresh(img: np.ndarray, z: int = 99) -> np.ndarray:
+    """Same as `find_beam_center_with_beamstop(img, z, method='thresh')`,
+    but finds the largest blob with `np.bincount` and
+    `ndimage.find_objects` instead of `regionprops`."""
+    seg = img > np.percentile(img, z)
+    labeled, nlabels = ndimage.label(seg)
+
+    areas = np.bincount(labeled.ravel(), minlength=nlabels + 1)
+    areas[0] = 0
+    label = np.argmax(areas)
+
+    sx, sy = ndimage.find_objects(labeled, max_label=label)[label - 1]
+
+    return np.array(((sx.start + sx.stop) / 2, (sy.start + sy.stop) / 2))
+
+
+def find_beam_centers_with_beamstop(imgs, z: int = 99, workers: int = None) -> np.ndarray:
+    """Find the beam centers in a stack of images `imgs` (N, H, W) or a
+    sequence of images when a beam stop is present, using the threshold
+    method of `find_beam_center_with_beamstop`.
+
+    The frames are segmented independently, in parallel using `workers`
+    threads (most of the time is spent in numpy/scipy, which release
+    the GIL). Set `workers=1` to process the frames sequentially.
+
+    Returns an array with the beam centers (N, 2).
+    """
+    if workers == 1:
+        centers = [_find_beam_center_thresh(img, z) for img in imgs]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            centers = list(executor.map(lambda img: _find_beam_center_thresh(img, z), imgs))
+
+    return np.array(centers).reshape(-1, 2)
+
+
 def printer(data) -> None:
     """Print things to stdout on one line dynamically."""
     sys.stdout.write('\r\x1b[K' + data.__str__())
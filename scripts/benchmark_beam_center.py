@@ -0,0 +1,76 @@
+"""Benchmark the batched beam center finders against the per-frame
+functions used before by `ImgConversion.get_beam_centers`.
+
+Generates a synthetic stack (500 frames of 516x516 by default) with a
+primary beam at a random position in every frame, and reports the wall
+time of each method and the largest deviation from the per-frame result.
+
+Usage:
+    python scripts/benchmark_beam_center.py [--frames 500] [--shape 516 516] [--workers 8]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from instamatic.tools import find_beam_center
+from instamatic.tools import find_beam_center_with_beamstop
+from instamatic.tools import find_beam_centers
+from instamatic.tools import find_beam_centers_with_beamstop
+
+
+def make_stack(nframes: int, shape: tuple) -> (np.array, np.array):
+    rng = np.random.RandomState(0)
+    centers = rng.uniform(0.4, 0.6, (nframes, 2)) * shape
+    stack = rng.poisson(5, (nframes, *shape)).astype(np.float32)
+    size = 15
+    yy, xx = np.mgrid[-size:size + 1, -size:size + 1]
+    for img, (cx, cy) in zip(stack, centers):
+        x0, y0 = int(cx), int(cy)
+        fx, fy = cx - x0, cy - y0
+        img[x0 - size:x0 + size + 1, y0 - size:y0 + size + 1] += 5000 * np.exp(-((yy - fx)**2 + (xx - fy)**2) / 18)
+    return stack, centers
+
+
+def timeit(func):
+    t0 = time.perf_counter()
+    result = np.asarray(func())
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--shape', type=int, nargs=2, default=(516, 516))
+    parser.add_argument('--workers', type=int, default=8)
+    options = parser.parse_args()
+
+    print(f'Dataset: {options.frames} frames of {options.shape[0]}x{options.shape[1]}, {options.workers} workers\n')
+
+    stack, centers = make_stack(options.frames, tuple(options.shape))
+
+    t_ref, ref = timeit(lambda: [find_beam_center(img, sigma=10) for img in stack])
+    t_new, new = timeit(lambda: find_beam_centers(stack, sigma=10))
+
+    t_ref_bs, ref_bs = timeit(lambda: [find_beam_center_with_beamstop(img, z=99) for img in stack])
+    t_seq_bs, seq_bs = timeit(lambda: find_beam_centers_with_beamstop(stack, z=99, workers=1))
+    t_new_bs, new_bs = timeit(lambda: find_beam_centers_with_beamstop(stack, z=99, workers=options.workers))
+
+    print(f'{"method":40s} {"time":>10s} {"frames/s":>10s} {"max diff":>10s}')
+    for name, t, result, reference in (
+        ('find_beam_center (per frame)', t_ref, ref, ref),
+        ('find_beam_centers (stack)', t_new, new, ref),
+        ('find_beam_center_with_beamstop', t_ref_bs, ref_bs, ref_bs),
+        ('find_beam_centers_with_beamstop (1)', t_seq_bs, seq_bs, ref_bs),
+        (f'find_beam_centers_with_beamstop ({options.workers})', t_new_bs, new_bs, ref_bs),
+    ):
+        diff = np.abs(result - reference).max()
+        print(f'{name:40s} {t:9.3f}s {options.frames / t:10.1f} {diff:10.4f}')
+
+    print(f'\nDeviation from the true centers: per frame {np.abs(ref - centers).max():.4f}, '
+          f'stack {np.abs(new - centers).max():.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark the thread and process backends of
+`ImgConversion.threadpoolwriter`.
+
+Writes a synthetic dataset (500 frames of 516x516 by default) to TIFF,
+SMV, and MRC in a temporary directory with both backends, and reports
+the wall time and throughput.
+
+Usage:
+    python scripts/benchmark_imgconversion.py [--frames 500] [--shape 516 516] [--workers 8]
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from instamatic.processing.ImgConversionTPX import ImgConversionTPX
+
+
+def make_buffer(nframes: int, shape: tuple) -> list:
+    rng = np.random.RandomState(0)
+    base = rng.poisson(5, shape).astype(float)
+    buffer = []
+    for i in range(1, nframes + 1):
+        img = np.roll(base, i, axis=0)
+        img[shape[0] // 2 - 2:shape[0] // 2 + 2, shape[1] // 2 - 2:shape[1] // 2 + 2] += 1000
+        h = {'ImageGetTime': time.time(), 'ImageExposureTime': 0.1}
+        buffer.append((i, img, h))
+    return buffer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--shape', type=int, nargs=2, default=(516, 516))
+    parser.add_argument('--workers', type=int, default=8)
+    options = parser.parse_args()
+
+    print(f'Dataset: {options.frames} frames of {options.shape[0]}x{options.shape[1]}, {options.workers} workers\n')
+
+    buffer = make_buffer(options.frames, tuple(options.shape))
+    img_conv = ImgConversionTPX(buffer=buffer,
+                                osc_angle=0.5,
+                                start_angle=0.0,
+                                end_angle=0.5 * options.frames,
+                                rotation_axis=0.1,
+                                acquisition_time=0.1,
+                                flatfield=None,
+                                pixelsize=0.01,
+                                physical_pixelsize=0.055,
+                                wavelength=0.025)
+
+    print(f'{"executor":10s} {"time":>10s} {"frames/s":>10s}')
+    for executor in ('thread', 'process'):
+        with tempfile.TemporaryDirectory() as drc:
+            drc = Path(drc)
+            t0 = time.perf_counter()
+            img_conv.threadpoolwriter(tiff_path=drc / 'tiff',
+                                      smv_path=drc / 'SMV',
+                                      mrc_path=drc / 'RED',
+                                      workers=options.workers,
+                                      executor=executor)
+            dt = time.perf_counter() - t0
+
+        print(f'{executor:10s} {dt:8.2f} s {options.frames / dt:10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark the image registration used by the stage/beam calibrations.
+
+Compares the full size `phase_cross_correlation` with the
+coarse-to-fine registration, and the time per calibration point when
+the registration runs in lockstep with the (simulated) stage movement
+or in the background.
+
+Usage:
+    python scripts/benchmark_registration.py [--shape 2048 2048] [--binsize 4] [--move 0.5] [--points 8]
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy import ndimage
+from skimage.registration import phase_cross_correlation
+
+from instamatic.calibrate.registration import ImageRegistration
+
+
+def make_pair(shape, shift, rng):
+    pad = int(np.abs(shift).max()) + 8
+    big = ndimage.gaussian_filter(rng.rand(shape[0] + 2 * pad, shape[1] + 2 * pad), 1) * 1000
+    reference = big[pad:pad + shape[0], pad:pad + shape[1]] + rng.rand(*shape) * 5
+    moving = ndimage.shift(big, shift, order=1)[pad:pad + shape[0], pad:pad + shape[1]] + rng.rand(*shape) * 5
+    return reference, moving
+
+
+def calibration(pairs, registration, move: float, background: bool) -> float:
+    """Simulate a calibration: move (sleep), take an image, register."""
+    t0 = time.perf_counter()
+    results = []
+    for pair in pairs:
+        time.sleep(move)
+        if background:
+            results.append(registration.submit(*pair))
+        else:
+            results.append(registration.register(*pair))
+    results = [result.result() if background else result for result in results]
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument('--binsize', type=int, default=4)
+    parser.add_argument('--move', type=float, default=0.5, help='Time to move the stage and take an image (s)')
+    parser.add_argument('--points', type=int, default=8)
+    options = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    shift = np.array(options.shape) * (0.2, -0.1) + (0.3, 0.6)
+    reference, moving = make_pair(options.shape, shift, rng)
+
+    print(f'Images: {options.shape[0]} x {options.shape[1]}; true shift: {-shift}\n')
+
+    print(f'{"registration":24s} {"time (s)":>10s} {"shift":>20s}')
+    t0 = time.perf_counter()
+    result, _, _ = phase_cross_correlation(reference, moving, upsample_factor=10)
+    t_full = time.perf_counter() - t0
+    print(f'{"full size":24s} {t_full:10.3f} {str(result):>20s}')
+
+    registration = ImageRegistration(coarse_binsize=options.binsize)
+    t0 = time.perf_counter()
+    result, _, _ = registration.register(reference, moving)
+    t_coarse = time.perf_counter() - t0
+    print(f'{f"coarse-to-fine (bin {options.binsize})":24s} {t_coarse:10.3f} {str(result):>20s}')
+
+    pairs = [(reference, moving)] * options.points
+    print(f'\n{options.points} points, {options.move} s per move\n')
+    print(f'{"":24s} {"lockstep":>10s} {"background":>10s}  (s/point)')
+    for name, coarse_binsize in (('full size', None), ('coarse-to-fine', options.binsize)):
+        with ImageRegistration(coarse_binsize=coarse_binsize, workers=1) as registration:
+            t_lockstep = calibration(pairs, registration, options.move, background=False)
+            t_background = calibration(pairs, registration, options.move, background=True)
+        print(f'{name:24s} {t_lockstep / options.points:10.3f} {t_background / options.points:10.3f}')
+
+
+if __name__ == '__main__':
+    main()
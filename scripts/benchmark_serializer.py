@@ -0,0 +1,90 @@
+"""Benchmark the serialization of `getImage` replies for the CAM server.
+
+Compares the plain serializers in `instamatic.server.serializer` with
+the array codec (`array_dumper`/`array_loader`), both for encoding/
+decoding only and for a full round trip over a local socket.
+
+Usage:
+    python scripts/benchmark_serializer.py [--shape 2048 2048] [--number 20]
+"""
+import argparse
+import socket
+import threading
+import timeit
+from functools import partial
+
+import numpy as np
+
+from instamatic.server import serializer
+from instamatic.server.protocol import recv_frame
+from instamatic.server.protocol import send_frame
+
+
+def get_codecs():
+    codecs = {'pickle': (serializer.pickle_dumper, serializer.pickle_loader)}
+    for name in ('pickle', 'json', 'msgpack'):
+        try:
+            dumper = getattr(serializer, f'{name}_dumper')
+            loader = getattr(serializer, f'{name}_loader')
+        except AttributeError:
+            continue
+        codecs[f'array+{name}'] = (partial(serializer.array_dumper, dumper=dumper),
+                                   partial(serializer.array_loader, loader=loader))
+    return codecs
+
+
+def time_it(func, number: int) -> float:
+    """Return the best time per call in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number
+
+
+def round_trip(sock_a, sock_b, dumper, loader, reply):
+    t = threading.Thread(target=send_frame, args=(sock_a, 1, dumper(reply)))
+    t.start()
+    _, payload = recv_frame(sock_b)
+    t.join()
+    return loader(payload)
+
+
+def fmt(t: float) -> str:
+    if t < 1e-3:
+        return f'{t * 1e6:7.1f} µs'
+    return f'{t * 1e3:7.2f} ms'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=2, default=(2048, 2048))
+    parser.add_argument('--number', type=int, default=20)
+    options = parser.parse_args()
+
+    arr = np.random.randint(0, 2**16, size=options.shape, dtype=np.uint16)
+    reply = (200, arr)
+    print(f'Reply: (200, arr) with arr {arr.shape} {arr.dtype} ({arr.nbytes / 1024**2:.1f} MB)\n')
+
+    sock_a, sock_b = socket.socketpair()
+
+    print(f'{"codec":15s} {"dumps":>10s} {"loads":>10s} {"socket":>10s}')
+    for name, (dumper, loader) in get_codecs().items():
+        payload = dumper(reply)
+        if isinstance(payload, list):
+            data = bytearray(b''.join(payload))
+        else:
+            data = bytearray(payload)
+
+        status, ret = loader(data)
+        assert np.array_equal(ret, arr)
+
+        t_dumps = time_it(lambda: dumper(reply), options.number)
+        t_loads = time_it(lambda: loader(data), options.number)
+        t_sock = time_it(lambda: round_trip(sock_a, sock_b, dumper, loader, reply), options.number)
+
+        print(f'{name:15s} {fmt(t_dumps):>10s} {fmt(t_loads):>10s} {fmt(t_sock):>10s}')
+
+    sock_a.close()
+    sock_b.close()
+
+
+if __name__ == '__main__':
+    main()
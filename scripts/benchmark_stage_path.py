@@ -0,0 +1,109 @@
+"""Benchmark the stage path planning and overlapped moves of
+`AcquireAtItems` on the simulated microscope.
+
+Items are placed at random stage positions. At every item, an image is
+collected, followed by a processing step (i.e. writing the data) of
+`--process` seconds. The stage travel is calculated from the moves
+including the backlash correction, the wall time is measured with the
+speed model of `SimuMicroscope`.
+
+Usage:
+    python scripts/benchmark_stage_path.py [--items 30] [--size 200] [--exposure 0.05] [--process 0.1]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+
+from instamatic.acquire_at_items import AcquireAtItems
+from instamatic.stage_path import get_moves
+from instamatic.stage_path import path_length
+from instamatic.stage_path import plan_stage_path
+
+
+class LegacyAcquireAtItems(AcquireAtItems):
+    """Always moves with `Stage.set_xy_with_backlash_correction`."""
+
+    def move_to_item(self, item):
+        x, y, z = self.get_coords(item)
+        self.ctrl.stage.set_xy_with_backlash_correction(x=x, y=y, step=self.step, settle_delay=self.settle_delay)
+
+
+def legacy_path_length(coords, start) -> float:
+    moves = [start] + [move for target in coords for move in get_moves(None, target)]
+    return np.abs(np.diff(moves, axis=0)).max(axis=1).sum()
+
+
+def count_moves(coords) -> int:
+    previous = [None] + list(coords[:-1])
+    return sum(len(get_moves(start, target)) for start, target in zip(previous, coords))
+
+
+def run(ctrl, cls, coords, start, **kwargs) -> float:
+    ctrl.stage.set(*start)
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        aai = cls(ctrl, coords, **kwargs)
+        t0 = time.perf_counter()
+        aai.start()
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=30)
+    parser.add_argument('--size', type=float, default=200, help='Size of the area with items (um)')
+    parser.add_argument('--exposure', type=float, default=0.05)
+    parser.add_argument('--process', type=float, default=0.1, help='Processing time per item (s)')
+    options = parser.parse_args()
+
+    from instamatic.TEMController import initialize
+    ctrl = initialize()
+
+    rng = np.random.RandomState(0)
+    coords = rng.uniform(-0.5, 0.5, (options.items, 2)) * options.size * 1000  # nm
+    start = (-options.size * 1000, -options.size * 1000)
+
+    def acquire(ctrl):
+        ctrl.get_image(exposure=options.exposure)
+
+    def process(ctrl):
+        time.sleep(options.process)
+
+    order = plan_stage_path(coords, start=start)
+    travel = {
+        'legacy': legacy_path_length(coords, start),
+        'given order': path_length(coords, start=start),
+        'planned': path_length(coords[order], start=start),
+    }
+    travel['planned+overlap'] = travel['planned']
+
+    moves = {
+        'legacy': 2 * options.items,
+        'given order': count_moves(coords),
+        'planned': count_moves(coords[order]),
+    }
+    moves['planned+overlap'] = moves['planned']
+
+    configs = {
+        'legacy': (LegacyAcquireAtItems, {}),
+        'given order': (AcquireAtItems, {}),
+        'planned': (AcquireAtItems, {'plan_path': True}),
+        'planned+overlap': (AcquireAtItems, {'plan_path': True, 'overlap': True}),
+    }
+
+    print(f'Items: {options.items} in {options.size:.0f} x {options.size:.0f} um')
+    print(f'Exposure: {options.exposure} s; processing: {options.process} s\n')
+
+    print(f'{"":16s} {"travel (um)":>12s} {"moves":>6s} {"time (s)":>10s} {"s/item":>8s}')
+    for name, (cls, kwargs) in configs.items():
+        dt = run(ctrl, cls, coords, start, acquire=[acquire, process], **kwargs)
+        print(f'{name:16s} {travel[name] / 1000:12.0f} {moves[name]:6d} {dt:10.2f} {dt / options.items:8.3f}')
+
+    ctrl.close()
+
+
+if __name__ == '__main__':
+    main()
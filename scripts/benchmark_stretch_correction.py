@@ -0,0 +1,88 @@
+"""Benchmark the cached stretch correction against the per-image affine
+transform, and the cached geometric correction maps against computing
+them from scratch as `ImgConversion.write_geometric_correction_files`
+did before.
+
+Usage:
+    python scripts/benchmark_stretch_correction.py [--frames 100] [--shape 516 516]
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from instamatic.processing.stretch_correction import affine_transform_ellipse_to_circle
+from instamatic.processing.stretch_correction import apply_transform_to_image
+from instamatic.processing.stretch_correction import get_displacement_maps
+from instamatic.processing.stretch_correction import StretchCorrector
+
+AZIMUTH = 37.0
+AMPLITUDE = 2.5
+
+
+def maps_from_scratch(shape: tuple, center: np.array) -> (np.array, np.array):
+    xi, yi = np.mgrid[0:shape[0], 0:shape[1]]
+    coords = np.stack([xi.flatten(), yi.flatten()], axis=1) - center
+    s = affine_transform_ellipse_to_circle(np.radians(AZIMUTH), AMPLITUDE / 200)
+    new = np.dot(coords, s)
+    xcorr = (new[:, 0].reshape(shape) + center[0]) - xi
+    ycorr = (new[:, 1].reshape(shape) + center[1]) - yi
+    return xcorr, ycorr
+
+
+def timeit(func, repeat: int = 1) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - t0) / repeat, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--shape', type=int, nargs=2, default=(516, 516))
+    options = parser.parse_args()
+
+    shape = tuple(options.shape)
+    center = np.array(shape) / 2 + 0.3
+
+    print(f'Dataset: {options.frames} frames of {shape[0]}x{shape[1]}\n')
+
+    stack = np.random.RandomState(0).poisson(50, (options.frames, *shape)).astype(np.float32)
+    transform = affine_transform_ellipse_to_circle(np.radians(AZIMUTH), AMPLITUDE / 200)
+
+    t_ref, ref = timeit(lambda: np.array([apply_transform_to_image(img, transform, center=center) for img in stack]))
+    t_init, corrector = timeit(lambda: StretchCorrector(shape, center=center, azimuth=AZIMUTH, amplitude=AMPLITUDE))
+    t_frames, new = timeit(lambda: np.array([corrector(img) for img in stack]))
+    t_stack, new_stack = timeit(lambda: corrector(stack))
+
+    print(f'{"image correction":40s} {"time":>10s} {"frames/s":>10s} {"max diff":>10s}')
+    for name, t, result in (
+        ('affine_transform (per frame)', t_ref, ref),
+        ('StretchCorrector (per frame)', t_frames, new),
+        ('StretchCorrector (stack)', t_stack, new_stack),
+    ):
+        diff = np.abs(result - ref).max()
+        print(f'{name:40s} {t:9.3f}s {options.frames / t:10.1f} {diff:10.4f}')
+    print(f'{"StretchCorrector (setup)":40s} {t_init:9.3f}s')
+
+    print(f'\n{"correction maps":40s} {"time":>10s} {"max diff":>10s}')
+    with tempfile.TemporaryDirectory() as drc:
+        t_ref, ref = timeit(lambda: maps_from_scratch(shape, center), repeat=5)
+        t_cold, cold = timeit(lambda: get_displacement_maps(shape, center, AZIMUTH, AMPLITUDE, cache_drc=drc))
+        t_warm, warm = timeit(lambda: get_displacement_maps(shape, center + 1, AZIMUTH, AMPLITUDE, cache_drc=drc), repeat=5)
+        warm = get_displacement_maps(shape, center, AZIMUTH, AMPLITUDE, cache_drc=drc)
+
+        for name, t, result in (
+            ('from scratch', t_ref, ref),
+            ('cached (first call)', t_cold, cold),
+            ('cached (other center)', t_warm, warm),
+        ):
+            diff = max(np.abs(result[0] - ref[0]).max(), np.abs(result[1] - ref[1]).max())
+            print(f'{name:40s} {t * 1000:8.2f}ms {diff:10.2e}')
+
+
+if __name__ == '__main__':
+    main()
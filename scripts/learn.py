@@ -86,16 +86,21 @@ def main(file_pattern):
     diff_fns = find_isolated_crystals(image_fns)
     print(len(diff_fns), 'Patterns from isolated crystals')
 
-    lst = []
-    for fn in tqdm(diff_fns):
+    headers = []
+    images = []
+    for fn in tqdm(diff_fns, desc='Reading'):
         img, h = read_hdf5(fn)
+        images.append(neural_network.preprocess(img.astype(float)))
+        headers.append(h)
+
+    # score all patterns at once
+    predictions = neural_network.predict(np.array(images).reshape(-1, 150, 150, 1))
 
+    lst = []
+    for fn, h, prediction in zip(diff_fns, headers, predictions):
         frame = int(str(fn)[-12:-8])
         number = int(str(fn)[-7:-3])
 
-        img_processed = neural_network.preprocess(img.astype(np.float))
-        prediction = neural_network.predict(img_processed)
-
         if prediction < 0.5:
             # print fn, "prediction too low", prediction
             continue
@@ -113,7 +118,7 @@ def main(file_pattern):
             dx, dy = h['exp_scan_offset']
             cx, cy = h['exp_scan_center']
 
-        prediction = round(prediction, 4)
+        prediction = round(float(prediction), 4)
         size = round(size, 4)
         x = int(cx + dx)
         y = int(cy + dy)
@@ -16,43 +16,32 @@ import sys
 from pathlib import Path
 
 import numpy as np
-import tifffile
 
+from instamatic.dataset import Dataset
 from instamatic.processing.ImgConversionTVIPS import ImgConversionTVIPS as ImgConversion
 from instamatic.tools import get_acquisition_time
 from instamatic.tools import relativistic_wavelength
 
 
-def extract_image_number(s):
-    p = Path(s)
-    return int(p.stem.split('_')[-1])
-
-
 def img_convert(credlog, tiff_path=None, mrc_path='RED', smv_path='SMV'):
     credlog = Path(credlog)
     drc = credlog.parent
 
     pattern = 'tiff/*.tif*'
 
-    image_fns = list(drc.glob(pattern))
-
-    # sort by frame number (avoid confusion with _9.tif -> _10.tif)
-    image_numbers = [extract_image_number(fn) for fn in image_fns]
-    image_numbers, image_fns = zip(*sorted(zip(image_numbers, image_fns)))
+    # frames are sorted by frame number (avoid confusion with _9.tif -> _10.tif)
+    dataset = Dataset(drc, pattern=pattern)
 
-    nframes = len(image_fns)
+    nframes = len(dataset)
     if nframes == 0:
         print(f'No files found matching `{pattern}`')
         exit()
     else:
         print(nframes)
 
-    ims = [tifffile.TiffFile(fn) for fn in image_fns]
-    hs = [im.tvips_metadata for im in ims]
+    ts = dataset.timestamps
 
-    ts = [h['Time'] for h in hs]  # sort by timestamps
-
-    h0 = hs[0]
+    img, h0 = dataset[0]
     exposure_time = h0['ExposureTime']
 
     res = get_acquisition_time(timestamps=ts, exp_time=exposure_time, savefig=True, drc=drc)
@@ -150,19 +139,14 @@ def img_convert(credlog, tiff_path=None, mrc_path='RED', smv_path='SMV'):
 
     print()
     print('Reading data')
-    for i, fn in enumerate(image_fns):
+    for i, (number, img, h) in enumerate(dataset.iter_buffer()):
         j = i + 1  # j must be 1-indexed
 
-        im = ims[i]
-        h = hs[i]
-
-        img = im.asarray()
-
         if img.dtype.type is np.int16:
             if img.min() >= 0 and img.max() < 2**16:
                 img = img.astype(np.uint16)
 
-        assert img.dtype.type is np.uint16, f'Image (#{i}:{fn.stem}) dtype is {img.dtype} (must be np.uint16)'
+        assert img.dtype.type is np.uint16, f'Image (#{i}:{dataset.path(i).stem}) dtype is {img.dtype} (must be np.uint16)'
 
         h = {'ImageGetTime': timestamp, 'ImageExposureTime': exposure_time}
 
@@ -18,7 +18,72 @@ def test_get_image(ctrl):
     assert y1 == bin4 * y4
 
 
+def test_get_image_header(ctrl):
+    img, h = ctrl.get_image(exposure=0.1, header_keys=('StagePosition', 'Magnification'))
+
+    assert set(h) >= {'StagePosition', 'StagePositionEnd', 'StagePositionDelta', 'Magnification', 'ImageHeaderSkew'}
+    assert 'BeamShift' not in h
+    assert 'MagnificationEnd' not in h
+
+    # the header is collected while the camera is exposing, and the stage position again after the exposure
+    assert h['ImageGetTimeStart'] <= h['ImageHeaderTimeStart'] <= h['ImageGetTimeEnd'] <= h['ImageHeaderTimeEnd']
+    assert h['ImageHeaderSkew'] == h['ImageHeaderTimeEnd'] - h['ImageHeaderTimeStart']
+    assert h['StagePositionDelta'] == tuple(end - start for start, end in zip(h['StagePosition'], h['StagePositionEnd']))
+
+    # the rotation during the exposure is recorded
+    ctrl.stage.a = 0
+    speed = ctrl.tem._stage_dict['a']['speed']
+    ctrl.tem._stage_dict['a']['speed'] = 50.0  # degrees / s
+    try:
+        ctrl.stage.set(a=20, wait=False)
+        img, h = ctrl.get_image(exposure=0.2, header_keys='StagePosition')
+        ctrl.stage.wait()
+    finally:
+        ctrl.tem._stage_dict['a']['speed'] = speed
+    assert h['StagePositionDelta'].a > 5
+
+    img, h = ctrl.get_image(exposure=0.01, header_keys='BeamShift')
+    assert 'BeamShift' in h
+    assert 'StagePosition' not in h
+    assert 'ImageHeaderSkew' not in h
+
+
 def test_functions(ctrl):
     dims = ctrl.cam.getImageDimensions()
     assert isinstance(dims, tuple)
     assert len(dims) == 2
+
+
+def test_videostream(ctrl):
+    stream = ctrl.cam
+
+    frames = stream.subscribe(maxsize=100)
+
+    frame1 = stream.get_frame(exposure=0.01)
+    frame2 = stream.get_frame(exposure=0.01)
+    assert frame2.index > frame1.index
+    assert frame2.timestamp >= frame1.timestamp
+
+    imgs = stream.continuous_collection(exposure=0.01, n=5)
+    assert len(imgs) == 5
+
+    stream.unsubscribe(frames)
+    indices = [frame.index for frame in frames]
+    assert indices == sorted(set(indices))
+    assert frames.dropped == 0
+
+
+def test_videostream_iter_frames(ctrl):
+    stream = ctrl.cam
+
+    stream.start_stream(exposure=0.01, n=10)
+    frames = list(stream.iter_frames())
+    assert [frame.index for frame in frames] == list(range(1, 11))
+    assert stream.stream_stats == {'acquired': 10, 'dropped': 0}
+
+    # stop an open-ended stream
+    stream.start_stream(exposure=0.01)
+    for frame in stream.iter_frames():
+        if frame.index == 3:
+            stream.stop_stream()
+    assert stream.stream_stats['acquired'] >= 3
@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 import pytest
 
@@ -78,6 +80,41 @@ def test_stage(ctrl):
         stage.set('rawr')
 
 
+def test_settle_detection(ctrl):
+    from instamatic.TEMController.settle import SettleDetector
+
+    # stage creeping towards x=1000 with a time constant of 50 ms
+    t_move = time.perf_counter()
+
+    def getter():
+        t = time.perf_counter() - t_move
+        return 1000 - 1000 * np.exp(-t / 0.05), 0, 0, 0, 0
+
+    detector = SettleDetector(getter, interval=0.01, min_samples=3)
+    for _ in range(4):
+        t_move = time.perf_counter()
+        dt = detector.wait(axes='xy')
+        assert 0.1 < dt < 1.0
+        assert abs(getter()[0] - 1000) < 50
+
+    stats = detector.stats()
+    assert stats['x']['n'] == stats['y']['n'] == 4
+    assert stats['x']['median'] > stats['y']['median']
+    assert stats['timeouts'] == 0
+    assert 0 < detector.expected_settle_time('xy') < stats['x']['median']
+
+    stage = ctrl.stage
+    detector = stage.enable_settle_detection(interval=0.01)
+    try:
+        stage.set_xy_with_backlash_correction(x=100, y=100)
+        stage.eliminate_backlash_a()
+        assert stage.xy == (100, 100)
+        assert detector.stats()['x']['n'] == 2
+        assert detector.stats()['a']['n'] == 4
+    finally:
+        stage.disable_settle_detection()
+
+
 def test_deflectors(ctrl):
     for deflector in (
         ctrl.guntilt,
@@ -227,6 +264,101 @@ def test_align_to(ctrl):
     assert pos != ctrl.stage.xy
 
 
+def test_state_cache(ctrl):
+    calls = []
+    getter = ctrl.tem.getBeamShift
+
+    def counting_getter():
+        calls.append(1)
+        return getter()
+
+    counting_getter.__name__ = 'getBeamShift'
+    ctrl.beamshift._getter = counting_getter
+
+    try:
+        cache = ctrl.enable_state_cache(max_age=60)
+
+        changes = []
+        cache.subscribe(lambda name, value: changes.append((name, value)))
+
+        ctrl.beamshift.set(1000, 2000)
+        assert ctrl.beamshift.x == 1000
+        assert ctrl.beamshift.y == 2000
+        assert ctrl.beamshift.xy == (1000, 2000)
+        assert len(calls) == 1
+
+        # setters invalidate the cached value
+        ctrl.beamshift.x = 3000
+        assert ctrl.beamshift.get() == (3000, 2000)
+        assert len(calls) == 2
+        assert changes[-1] == ('getBeamShift', (3000, 2000))
+
+        # changing the mode invalidates all values
+        ctrl.mode.set('mag1')
+        ctrl.beamshift.get()
+        assert len(calls) == 3
+
+        # values changed behind the cache are picked up by the background refresher
+        getter.__self__.setBeamShift(4000, 4000)
+        assert ctrl.beamshift.get() == (3000, 2000)
+        cache.start(interval=0.01)
+        for _ in range(100):
+            if ('getBeamShift', (4000, 4000)) in changes:
+                break
+            time.sleep(0.01)
+        assert ctrl.beamshift.get() == (4000, 4000)
+    finally:
+        ctrl.disable_state_cache()
+        ctrl.beamshift._getter = getter
+
+    assert ctrl.beamshift._getter is getter
+    assert not cache.is_running
+
+
+def test_state_cache_stage_moving(ctrl):
+    ctrl.stage.set(a=0)
+    speed = ctrl.tem._stage_dict['a']['speed']
+    ctrl.tem._stage_dict['a']['speed'] = 50.0  # degrees / s
+    try:
+        ctrl.enable_state_cache(max_age=60)
+
+        # the position is not cached while the stage is moving
+        ctrl.stage.set(a=10, wait=False)
+        a0 = ctrl.stage.a
+        time.sleep(0.05)
+        a1 = ctrl.stage.a
+        assert 0 <= a0 < a1 < 10
+
+        ctrl.stage.wait()
+        assert ctrl.stage.a == 10
+        assert 'getStagePosition' in ctrl.state_cache.snapshot()
+    finally:
+        ctrl.disable_state_cache()
+        ctrl.tem._stage_dict['a']['speed'] = speed
+
+
+def test_calibrate_stage_resume(ctrl, tmp_path):
+    from instamatic import config
+    from instamatic.calibrate.calibrate_stagematrix import calibrate_stage_all
+
+    mags = sorted(config.calibration['mag1']['pixelsize'])[3:5]
+    resume_file = tmp_path / 'stagematrix.yaml'
+    kwargs = dict(mag_ranges={'mag1': mags}, min_n_step=3, max_n_step=3, coarse_binsize=4, workers=2, resume_file=resume_file)
+
+    cfg = calibrate_stage_all(ctrl, **kwargs)
+    assert sorted(cfg['mag1']['stagematrix']) == mags
+
+    # calibrated magnifications are skipped
+    calls = []
+    get_image = ctrl.get_image
+    ctrl.get_image = lambda *args, **kwargs: calls.append(1) or get_image(*args, **kwargs)
+    try:
+        assert calibrate_stage_all(ctrl, **kwargs) == cfg
+    finally:
+        del ctrl.get_image
+    assert not calls
+
+
 if __name__ == '__main__':
     test_ctrl()
 
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def test_dataset(tmp_path, monkeypatch):
+    from instamatic import dataset
+    from instamatic.formats import write_tiff
+
+    drc = tmp_path / 'tiff'
+    drc.mkdir()
+    for i in (1, 2, 10):
+        img = np.full((8, 8), i, dtype=np.uint16)
+        h = {'ImageGetTime': 100.0 + i, 'StagePosition': (0.0, 0.0, 0.0, 2.0 * i, 0.0), 'Other': 'x'}
+        write_tiff(drc / f'image_{i}.tiff', img, header=h)
+
+    ds = dataset.Dataset(tmp_path, pattern='tiff/*.tiff', workers=2)
+
+    assert len(ds) == 3
+    np.testing.assert_array_equal(ds.numbers, [1, 2, 10])  # not sorted as strings
+    np.testing.assert_array_equal(ds.timestamps, [101.0, 102.0, 110.0])
+    np.testing.assert_array_equal(ds.angles, [2.0, 4.0, 20.0])
+    assert ds.headers[0] == {'ImageGetTime': 101.0, 'StagePosition': (0.0, 0.0, 0.0, 2.0, 0.0)}
+    assert (tmp_path / dataset.INDEX_FILE).exists()
+
+    img, h = ds[2]
+    assert img[0, 0] == 10
+    assert h['Other'] == 'x'
+
+    buffer = ds.to_buffer()
+    assert [number for number, img, h in buffer] == [1, 2, 10]
+    assert [img[0, 0] for number, img, h in buffer] == [1, 2, 10]
+
+    # the index is reused, only new files are read
+    read = []
+
+    def read_headers(fns):
+        read.extend(fns)
+        return [{} for fn in fns]
+
+    monkeypatch.setattr(dataset, 'read_headers', read_headers)
+    write_tiff(drc / 'image_3.tiff', np.zeros((8, 8), dtype=np.uint16))
+
+    ds = dataset.Dataset(tmp_path, pattern='tiff/*.tiff', workers=2)
+
+    assert [fn.name for fn in read] == ['image_3.tiff']
+    np.testing.assert_array_equal(ds.numbers, [1, 2, 3, 10])
+    np.testing.assert_array_equal(ds.timestamps[:2], [101.0, 102.0])
@@ -88,3 +88,81 @@ def test_red(ctrl):
     red_exp.finalize()
 
     tempdrc.cleanup()
+
+
+def test_serialed_look_ahead(ctrl, tmp_path, monkeypatch):
+    from concurrent.futures import Future
+
+    import numpy as np
+
+    from instamatic.experiments.serialed.experiment import Experiment
+    from instamatic.processing.find_crystals import CrystalPosition
+
+    monkeypatch.setattr('builtins.input', lambda *args: '')
+
+    moves = []
+    set_stage = ctrl.stage.set
+
+    def recording_set(x=None, y=None, **kwargs):
+        moves.append((x, y))
+        set_stage(x=x, y=y, **kwargs)
+
+    monkeypatch.setattr(ctrl.stage, 'set', recording_set)
+
+    def run(look_ahead):
+        exp = Experiment.__new__(Experiment)
+        exp.ctrl = ctrl
+        exp.log = MagicMock()
+        exp.imagedir = exp.datadir = tmp_path
+        exp.look_ahead = look_ahead
+        exp.scan_ahead = False
+        exp.hdf5_stack = False
+        exp.flatfield = None
+        exp.scan_centers = np.array([[0, 0]])
+        exp.offsets = np.array([[0, 0], [1000, 0], [2000, 0], [3000, 0]])
+        exp.change_spotsize = False
+        exp.image_spotsize = exp.diff_spotsize = 1
+        exp.image_exposure = exp.diff_exposure = 0.01
+        exp.image_binsize = exp.diff_binsize = 1
+        exp.image_threshold = -1
+        exp.sample_rotation_angles = []
+        for attr in ('neutral_beamshift', 'neutral_diffshift', 'magnification', 'image_dimensions', 'diff_brightness',
+                     'diff_cameralength', 'diff_difffocus', 'diff_pixelsize'):
+            setattr(exp, attr, None)
+
+        # crystals are found in the 2nd and 4th image
+        images = []
+
+        def submit(img):
+            future = Future()
+            crystals = [CrystalPosition(10, 10, True, 1, 1.0, 1)] if len(images) in (1, 3) else []
+            future.set_result(crystals)
+            images.append(tuple(ctrl.stage.xy))
+            return future
+
+        exp.crystal_finder = MagicMock(submit=submit)
+
+        diffraction = []
+
+        def loop_crystals(crystal_coords):
+            diffraction.append(tuple(ctrl.stage.xy))
+            yield {}
+
+        exp.loop_crystals = loop_crystals
+        exp.initialize_microscope = exp.image_mode = exp.write_image = MagicMock()
+
+        moves.clear()
+        exp.run()
+        return list(moves), images, diffraction
+
+    # stage stays at every position until the diffraction data are collected
+    moves, images, diffraction = run(look_ahead=0)
+    assert moves == [(0, 0), (0, 0), (1000, 0), (2000, 0), (3000, 0)]
+    assert images == [(0, 0), (1000, 0), (2000, 0), (3000, 0)]
+    assert diffraction == [(1000, 0), (3000, 0)]
+
+    # the stage moves on while the image is segmented, and returns via the position it came from
+    moves, images, diffraction = run(look_ahead=1)
+    assert moves == [(0, 0), (0, 0), (1000, 0), (2000, 0), (0, 0), (1000, 0), (3000, 0), (1000, 0), (3000, 0)]
+    assert images == [(0, 0), (1000, 0), (2000, 0), (3000, 0)]
+    assert diffraction == [(1000, 0), (3000, 0)]
@@ -31,6 +31,51 @@ def test_tiff(data, header):
     assert header == h
 
 
+
+def test_tiff_metadata(tmp_path, data):
+    from datetime import date
+    from datetime import datetime
+    from datetime import timedelta
+    from datetime import timezone
+
+    import tifffile
+    import yaml
+
+    header = {
+        'int': np.int64(3),
+        'float': np.float32(0.5),
+        'tuple': (1, 2.5, 'a'),
+        'list': [1, (2, 3)],
+        'array': np.arange(4).reshape(2, 2),
+        'nested': {'none': None, 'bool': True},
+        'datetime': datetime(2020, 1, 31, 12, 30, 5, 500),
+        'datetime_s': datetime(2020, 1, 31, 12, 30, 5),
+        'datetime_tz': datetime(2020, 1, 31, 12, 30, 5, tzinfo=timezone(timedelta(hours=-2))),
+        'date': date(2020, 1, 31),
+    }
+
+    formats.write_tiff(tmp_path / 'new.tiff', data, header)
+
+    # legacy file with the header stored as yaml in ImageDescription
+    with tifffile.TiffWriter(tmp_path / 'old.tiff') as f:
+        f.save(data=data, software='instamatic', description=yaml.dump({'value': 123}))
+
+    img, h = formats.read_tiff(tmp_path / 'new.tiff')
+    assert h['int'] == 3
+    assert h['float'] == 0.5
+    assert h['tuple'] == (1, 2.5, 'a')
+    assert h['list'] == [1, (2, 3)]
+    np.testing.assert_array_equal(h['array'], header['array'])
+    assert h['nested'] == {'none': None, 'bool': True}
+    for key in ('datetime', 'datetime_s', 'datetime_tz', 'date'):
+        assert h[key] == header[key]
+        assert type(h[key]) is type(header[key])
+
+    h_new, h_old = formats.read_tiff_headers([tmp_path / 'new.tiff', tmp_path / 'old.tiff'])
+    assert h_new['tuple'] == (1, 2.5, 'a')
+    assert h_old == {'value': 123}
+
+
 def test_cbf(data, header):
     out = 'out.cbf'
 
@@ -38,9 +83,35 @@ def test_cbf(data, header):
 
     assert os.path.exists(out)
 
-    # Reader Not implemented:
-    with pytest.raises(NotImplementedError):
-        img, h = formats.read_image(out)
+    img, h = formats.read_image(out)
+
+    assert np.allclose(img, data)
+    assert img.dtype == data.dtype
+    assert img.shape == data.shape
+
+
+def test_cbf_byte_offset():
+    from instamatic.formats.xdscbf import compByteOffset
+    from instamatic.formats.xdscbf import decByteOffset
+
+    # deltas that need 1, 3, 7, and 15 bytes
+    data = np.array([0, 1, 2, 127, 0, -128, 0, 32767, 0, -32768, 0,
+                     2**31 - 1, 0, -2**31, 0, 2**40, -2**40, 5], dtype=np.int64)
+    stream = compByteOffset(data)
+
+    assert len(stream) == 5 * 1 + 4 * 3 + 4 * 7 + 5 * 15
+    assert stream[:7] == b'\x00\x01\x01\x7d\x81\x80\x80'
+    np.testing.assert_array_equal(decByteOffset(stream, data.size), data)
+
+    # escaped deltas with 0x80 bytes in their value
+    deltas = np.array([-32640, 0x8080, 0x80808080, -0x7f7f7f80, 0x8080808080, 1, -128, 128, -32768, -2**31])
+    data = np.cumsum(np.random.RandomState(0).choice(deltas, 1000))
+    stream = compByteOffset(data)
+    np.testing.assert_array_equal(decByteOffset(stream, data.size), data)
+    np.testing.assert_array_equal(decByteOffset(stream, 10), data[:10])
+
+    with pytest.raises(ValueError):
+        decByteOffset(stream[:-1], data.size)
 
 
 def test_mrc(data, header):
@@ -82,3 +153,85 @@ def test_hdf5(data, header):
 
     assert np.allclose(img, data)
     assert header == h
+
+
+def test_hdf5_stack(tmp_path):
+    fn = tmp_path / 'stack.h5'
+    frames = [np.full((16, 16), i, dtype=np.uint16) for i in range(5)]
+
+    with formats.HDF5StackWriter(fn) as f:
+        for i, img in enumerate(frames[:3]):
+            f.append(img, header={'value': i, 'string': 'test', 'pos': (i, -i)}, index=i + 1)
+
+    # append more frames later, with a new header key
+    with formats.HDF5StackWriter(fn, mode='a') as f:
+        for i, img in enumerate(frames[3:], start=3):
+            f.append(img, header={'value': i, 'new': 1.5}, index=i + 1)
+
+    f = formats.HDF5StackReader(fn)
+
+    assert len(f) == 5
+    np.testing.assert_array_equal(f.index, [1, 2, 3, 4, 5])
+
+    img, h = f[1]
+    np.testing.assert_array_equal(img, frames[1])
+    assert h == {'value': 1, 'string': 'test', 'pos': [1, -1]}
+
+    img, h = f[-1]
+    np.testing.assert_array_equal(img, frames[4])
+    assert h == {'value': 4, 'new': 1.5}
+
+    np.testing.assert_array_equal(f.get_column('value'), range(5))
+
+    fns = f.export(tmp_path / 'tiff', fmt='tiff')
+    assert [fn.name for fn in fns] == [f'{i:05d}.tiff' for i in range(1, 6)]
+
+    f.close()
+
+
+def test_hdf5_stack_mixed_types(tmp_path):
+    fn = tmp_path / 'stack.h5'
+    headers = [
+        {'x': 0, 'flag': True, 'y': 2.5, 'z': 1},
+        {'x': 1.75, 'flag': 0.5, 'y': 3, 'z': 2},
+        {'x': np.int64(3), 'flag': False, 'y': np.float32(0.25), 'z': 'three'},
+        {'x': True},
+    ]
+
+    with formats.HDF5StackWriter(fn) as f:
+        for h in headers[:2]:
+            f.append(np.zeros((4, 4)), header=h)
+    with formats.HDF5StackWriter(fn, mode='a') as f:
+        for h in headers[2:]:
+            f.append(np.zeros((4, 4)), header=h)
+
+    with formats.HDF5StackReader(fn) as f:
+        for n, expected in enumerate(headers):
+            img, h = f[n]
+            assert h == expected
+            assert {key: type(val) for key, val in h.items()} == {key: type(np.asarray(val).item()) for key, val in expected.items()}
+
+
+def test_mrc_stack(tmp_path):
+    from instamatic.formats.mrc import MRCStack
+
+    fn = tmp_path / 'stack.mrc'
+    frames = [np.full((32, 24), i, dtype=np.uint16) for i in range(7)]
+
+    # grows beyond the initial capacity
+    with MRCStack.create(fn, shape=(32, 24), dtype=np.uint16, capacity=2) as stack:
+        for img in frames:
+            stack.append(img)
+
+    stack = MRCStack.open(fn)
+
+    assert len(stack) == 7
+    assert stack.shape == (7, 32, 24)
+    assert stack.header['mrc_amax'] == 6
+    np.testing.assert_array_equal(stack[3], frames[3])
+    np.testing.assert_array_equal(stack[2:5], frames[2:5])
+
+    img, h = formats.read_mrc(fn, index=5)
+    np.testing.assert_array_equal(img, frames[5])
+
+    stack.close()
@@ -1,6 +1,59 @@
+import numpy as np
+
+
 def test_grid_mapping(ctrl):
     gm = ctrl.grid_montage()
     gm.setup(3, 3)
     gm.start()
 
     montage = gm.to_montage()
+
+
+def test_plan_stage_path():
+    from instamatic.stage_path import cost_matrix
+    from instamatic.stage_path import path_length
+    from instamatic.stage_path import plan_stage_path
+
+    rng = np.random.RandomState(6)
+    coords = rng.uniform(-50000, 50000, (40, 2))
+    start = (0, 0)
+
+    order = plan_stage_path(coords, start=start)
+    assert sorted(order) == list(range(len(coords)))
+    assert path_length(coords[order], start=start) < path_length(coords, start=start) / 2
+
+    # the cost matrix matches the travel of the individual moves
+    cost = cost_matrix(coords)
+    assert cost[0, 1] == path_length(coords[[0, 1]], start=coords[0])
+
+    # moves in the approach direction (+x) do not need backlash correction
+    line = np.array([(x, 0) for x in (30000, 0, 20000, 10000)])
+    order = plan_stage_path(line, start=(-100000, 0))
+    assert order.tolist() == [1, 3, 2, 0]
+
+
+def test_acquire_at_items(ctrl):
+    coords = np.array([(0, 0), (20000, 0), (10000, 0), (30000, 10000), (0, 10000)])
+    visited = []
+    processed = []
+
+    def acquire(ctrl):
+        visited.append((ctrl.current_i, ctrl.stage.xy))
+
+    def process(ctrl):
+        processed.append(ctrl.current_i)
+
+    for plan_path in (False, True):
+        visited.clear()
+        processed.clear()
+
+        ctrl.stage.set(x=-50000, y=-50000)
+        ctrl.acquire_at_items(coords, acquire=[acquire, process], plan_path=plan_path,
+                              overlap=True, settle_delay=0)
+
+        assert sorted(i for i, xy in visited) == list(range(len(coords)))
+        assert processed == [i for i, xy in visited]
+        for i, xy in visited:
+            np.testing.assert_allclose(xy, coords[i])
+
+    assert [i for i, xy in visited] == [0, 4, 2, 1, 3]
@@ -0,0 +1,314 @@
+import numpy as np
+
+
+def make_frames(indices=(1, 2, 3, 5, 6)):
+    rng = np.random.RandomState(0)
+    frames = []
+    for i in indices:
+        img = rng.poisson(5, (128, 128)).astype(float)
+        img[60:64, 70:74] += 500
+        h = {'ImageGetTime': 1000.0 + i, 'ImageExposureTime': 0.1}
+        frames.append((i, img, h))
+    return frames
+
+
+def test_imgconversion_stream(tmp_path):
+    from instamatic.formats import read_adsc
+    from instamatic.formats import read_tiff
+    from instamatic.processing.ImgConversionStream import ImgConversionStream
+    from instamatic.processing.ImgConversionTPX import ImgConversionTPX
+
+    kwargs = dict(start_angle=0.0, rotation_axis=0.1, flatfield=None, physical_pixelsize=0.055, wavelength=0.025)
+    final = dict(osc_angle=0.5, end_angle=3.0, acquisition_time=0.1, pixelsize=0.01)
+
+    frames = make_frames()
+    buffer = [(i, img, dict(h)) for i, img, h in frames]
+    img_conv = ImgConversionTPX(buffer=buffer, **kwargs, **final)
+    img_conv.threadpoolwriter(tiff_path=tmp_path / 'a' / 'tiff', smv_path=tmp_path / 'a' / 'SMV')
+
+    stream = ImgConversionStream(**kwargs, tiff_path=tmp_path / 'b' / 'tiff', smv_path=tmp_path / 'b' / 'SMV',
+                                 hdf5_path=tmp_path / 'b' / 'data.h5')
+    for i, img, h in frames:
+        stream.append((i, img, dict(h)))
+    stream.finalize(**final)
+
+    assert len(stream) == len(frames)
+    assert stream.missing_range == img_conv.missing_range == {4}
+    np.testing.assert_allclose(stream.mean_beam_center, img_conv.mean_beam_center)
+
+    for i, _, _ in frames:
+        img_a, h_a = read_adsc(tmp_path / 'a' / 'SMV' / 'data' / f'{i:05d}.img')
+        img_b, h_b = read_adsc(tmp_path / 'b' / 'SMV' / 'data' / f'{i:05d}.img')
+        np.testing.assert_array_equal(img_a, img_b)
+        assert h_a == h_b
+
+        img_a, h_a = read_tiff(tmp_path / 'a' / 'tiff' / f'{i:05d}.tiff')
+        img_b, h_b = read_tiff(tmp_path / 'b' / 'tiff' / f'{i:05d}.tiff')
+        np.testing.assert_array_equal(img_a, img_b)
+        assert h_a == h_b
+
+    # image data are released once written
+    assert not stream.data
+
+    from instamatic.formats import HDF5StackReader
+    with HDF5StackReader(tmp_path / 'b' / 'data.h5') as f:
+        assert sorted(f.index) == [i for i, _, _ in frames]
+
+    # aborted data collection
+    stream = ImgConversionStream(**kwargs, tiff_path=tmp_path / 'c' / 'tiff', smv_path=tmp_path / 'c' / 'SMV',
+                                 hdf5_path=tmp_path / 'c' / 'data.h5')
+    for i, img, h in frames[:2]:
+        stream.append((i, img, dict(h)))
+    stream.discard()
+    assert not [fn for fn in (tmp_path / 'c').rglob('*') if fn.is_file()]
+
+    # stretch correction is set from the arguments
+    stream = ImgConversionStream(**kwargs, stretch_amplitude=2.5, stretch_azimuth=30.0)
+    assert (stream.stretch_amplitude, stream.stretch_azimuth) == (2.5, 30.0)
+    assert stream.do_stretch_correction
+    stream = ImgConversionStream(**kwargs, stretch_amplitude=0.0)
+    assert not stream.do_stretch_correction
+
+
+def test_threadpoolwriter_process(tmp_path):
+    from instamatic.formats import read_adsc
+    from instamatic.formats import read_mrc
+    from instamatic.formats import read_tiff
+    from instamatic.processing.ImgConversionTPX import ImgConversionTPX
+
+    kwargs = dict(osc_angle=0.5, start_angle=0.0, end_angle=3.0, rotation_axis=0.1, acquisition_time=0.1,
+                  flatfield=None, pixelsize=0.01, physical_pixelsize=0.055, wavelength=0.025)
+
+    frames = make_frames()
+    img_conv = ImgConversionTPX(buffer=list(frames), **kwargs)
+
+    for executor in ('thread', 'process'):
+        root = tmp_path / executor
+        img_conv.threadpoolwriter(tiff_path=root / 'tiff', smv_path=root / 'SMV', mrc_path=root / 'RED',
+                                  workers=2, executor=executor)
+
+    for i, _, _ in frames:
+        for reader, subdrc, ext in ((read_tiff, 'tiff', 'tiff'), (read_adsc, 'SMV/data', 'img'), (read_mrc, 'RED', 'mrc')):
+            img_a, h_a = reader(tmp_path / 'thread' / subdrc / f'{i:05d}.{ext}')
+            img_b, h_b = reader(tmp_path / 'process' / subdrc / f'{i:05d}.{ext}')
+            np.testing.assert_array_equal(img_a, img_b)
+            assert h_a == h_b
+
+
+def test_threadpoolwriter_stack(tmp_path):
+    from instamatic.formats import HDF5StackReader
+    from instamatic.formats import read_adsc
+    from instamatic.formats import read_mrc
+    from instamatic.formats.mrc import MRCStack
+    from instamatic.processing.ImgConversionTPX import ImgConversionTPX
+
+    kwargs = dict(osc_angle=0.5, start_angle=0.0, end_angle=3.0, rotation_axis=0.1, acquisition_time=0.1,
+                  flatfield=None, pixelsize=0.01, physical_pixelsize=0.055, wavelength=0.025)
+
+    frames = make_frames()
+    img_conv = ImgConversionTPX(buffer=list(frames), **kwargs)
+    img_conv.threadpoolwriter(smv_path=tmp_path / 'a', mrc_path=tmp_path / 'RED',
+                              hdf5_stack=tmp_path / 'data.h5', mrc_stack=tmp_path / 'stack.mrc')
+
+    with HDF5StackReader(tmp_path / 'data.h5') as f:
+        assert list(f.index) == [i for i, _, _ in frames]
+        for n, (i, img, h) in enumerate(frames):
+            np.testing.assert_array_equal(f.read_frame(n)[0], img)
+
+    with MRCStack.open(tmp_path / 'stack.mrc') as stack:
+        assert len(stack) == len(frames)
+        for n, (i, _, _) in enumerate(frames):
+            np.testing.assert_array_equal(stack[n], read_mrc(tmp_path / 'RED' / f'{i:05d}.mrc')[0])
+
+    # per-frame files on demand from the HDF5 stack
+    img_conv = ImgConversionTPX.from_hdf5_stack(tmp_path / 'data.h5', **kwargs)
+    img_conv.threadpoolwriter(smv_path=tmp_path / 'b')
+
+    for i, _, _ in frames:
+        img_a, h_a = read_adsc(tmp_path / 'a' / 'data' / f'{i:05d}.img')
+        img_b, h_b = read_adsc(tmp_path / 'b' / 'data' / f'{i:05d}.img')
+        np.testing.assert_array_equal(img_a, img_b)
+        assert h_a == h_b
+
+
+def test_flatfield_corrector():
+    from instamatic.processing.flatfield import FlatfieldCorrector
+
+    rng = np.random.RandomState(1)
+    flatfield = rng.uniform(50, 150, (64, 64))
+    darkfield = rng.uniform(0, 5, (64, 64))
+    deadpixels = np.array([[10, 10], [0, 5], [63, 63], [30, 40]])
+
+    img = rng.poisson(20, (64, 64)).astype(np.uint16)
+
+    # reference: average of the 3x3 neighbourhood (clipped at the edges)
+    expected = img.astype(float)
+    for i, j in deadpixels:
+        expected[i, j] = img[max(i - 1, 0):i + 2, max(j - 1, 0):j + 2].mean()
+    expected = (expected - darkfield) * np.mean(flatfield - darkfield) / (flatfield - darkfield)
+
+    corrector = FlatfieldCorrector(flatfield, darkfield=darkfield, deadpixels=deadpixels)
+
+    np.testing.assert_allclose(corrector(img), expected)
+    assert img.dtype == np.uint16  # integer input is not modified
+
+    stack = np.stack([img, img, img]).astype(float)
+    out = corrector(stack, inplace=True)
+    assert out is stack
+    np.testing.assert_allclose(stack[2], expected)
+
+
+def test_find_beam_centers():
+    from instamatic.tools import find_beam_center
+    from instamatic.tools import find_beam_center_with_beamstop
+    from instamatic.tools import find_beam_centers
+    from instamatic.tools import find_beam_centers_with_beamstop
+
+    rng = np.random.RandomState(2)
+    yy, xx = np.mgrid[:128, :128]
+    centers = rng.uniform(40, 90, (5, 2))
+    stack = np.array([rng.poisson(5, (128, 128)) + 2000 * np.exp(-((yy - cx)**2 + (xx - cy)**2) / 18)
+                      for cx, cy in centers])
+
+    expected = np.array([find_beam_center(img, sigma=10) for img in stack])
+    np.testing.assert_allclose(find_beam_centers(stack, sigma=10), expected, atol=0.02)
+    np.testing.assert_allclose(find_beam_centers(list(stack), sigma=10), expected, atol=0.02)
+    np.testing.assert_allclose(expected, centers, atol=0.2)
+
+    expected = np.array([find_beam_center_with_beamstop(img, z=99) for img in stack])
+    np.testing.assert_array_equal(find_beam_centers_with_beamstop(stack, z=99, workers=2), expected)
+    np.testing.assert_array_equal(find_beam_centers_with_beamstop(stack, z=99, workers=1), expected)
+
+
+def test_stretch_correction(tmp_path):
+    from instamatic.processing.stretch_correction import affine_transform_ellipse_to_circle
+    from instamatic.processing.stretch_correction import apply_stretch_correction
+    from instamatic.processing.stretch_correction import apply_transform_to_image
+    from instamatic.processing.stretch_correction import get_displacement_maps
+
+    azimuth, amplitude = 30.0, 2.5
+    center = (60.3, 71.7)
+    transform = affine_transform_ellipse_to_circle(np.radians(azimuth), amplitude / 200)
+
+    stack = np.random.RandomState(3).uniform(0, 1000, (3, 128, 140))
+    expected = [apply_transform_to_image(img, transform, center=np.array(center)) for img in stack]
+
+    np.testing.assert_allclose(apply_stretch_correction(stack[0], center=center, azimuth=azimuth, amplitude=amplitude),
+                               expected[0], atol=1e-3)
+    np.testing.assert_allclose(apply_stretch_correction(stack, center=center, azimuth=azimuth, amplitude=amplitude),
+                               expected, atol=1e-3)
+
+    xi, yi = np.mgrid[0:128, 0:140]
+    coords = np.stack([xi.ravel(), yi.ravel()], axis=1) - center
+    new = coords.dot(transform) + center
+
+    for _ in range(2):  # computed, then read from the cache directory
+        xcorr, ycorr = get_displacement_maps((128, 140), center, azimuth, amplitude, cache_drc=tmp_path)
+        assert xcorr.dtype == np.float32
+        np.testing.assert_allclose(xcorr, new[:, 0].reshape(128, 140) - xi, atol=1e-4)
+        np.testing.assert_allclose(ycorr, new[:, 1].reshape(128, 140) - yi, atol=1e-4)
+
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_neural_network_batch():
+    from instamatic.neural_network import neural_network as nn
+
+    rng = np.random.RandomState(4)
+
+    x = rng.rand(6, 7, 3).astype(np.float32)
+    weight = rng.rand(3, 3, 3, 64).astype(np.float32)
+    offset = rng.rand(64).astype(np.float32)
+    expected = np.array([[np.tensordot(x[n:n + 3, p:p + 3], weight, axes=3) for p in range(5)] for n in range(4)]) + offset
+    np.testing.assert_allclose(nn.conv_layer(x, weight, offset), expected, rtol=1e-5)
+    np.testing.assert_array_equal(nn.max_pooling(x)[1, 2], x[2:4, 4:6].max(axis=(0, 1)))
+
+    images = rng.rand(3, 150, 150, 1)
+    predictions = nn.predict(images, batch_size=2)
+    assert predictions.shape == (3,)
+    np.testing.assert_allclose(predictions[1], nn.predict(images[1]), rtol=1e-5)
+
+
+def test_crystal_finder():
+    from instamatic import config
+    from instamatic.processing.find_crystals import CrystalFinder
+    from instamatic.processing.find_crystals import find_crystals_timepix
+
+    magnification = sorted(config.calibration['mag1']['pixelsize'])[5]
+
+    rng = np.random.RandomState(5)
+    img = rng.normal(200, 10, (516, 516))
+    yy, xx = np.mgrid[:516, :516]
+    for cx, cy in ((100, 120), (300, 400), (400, 150)):
+        img[(yy - cx)**2 + (xx - cy)**2 < 15**2] -= 120
+
+    expected = find_crystals_timepix(img, magnification)
+    assert len(expected) == 3
+
+    with CrystalFinder.timepix(magnification) as finder:
+        futures = [finder.submit(img) for _ in range(2)]
+        assert [future.result() for future in futures] == [expected, expected]
+
+    with CrystalFinder.timepix(magnification, mode='watershed') as finder:
+        crystals, = finder.map([img])
+        np.testing.assert_allclose(sorted(crystal[:2] for crystal in crystals),
+                                   sorted(crystal[:2] for crystal in expected), atol=2)
+
+
+def test_image_registration():
+    from scipy import ndimage
+    from skimage.registration import phase_cross_correlation
+
+    from instamatic.calibrate.registration import ImageRegistration
+    from instamatic.calibrate.registration import phase_cross_correlation_coarse_to_fine
+
+    rng = np.random.RandomState(7)
+    big = ndimage.gaussian_filter(rng.rand(700, 700), 1) * 1000
+    reference = big[50:562, 50:562] + rng.rand(512, 512) * 5
+
+    pairs = []
+    for offset in ((40.3, -20.6), (-3.2, 150.9)):
+        moving = ndimage.shift(big, offset, order=3)[50:562, 50:562] + rng.rand(512, 512) * 5
+        pairs.append((reference, moving))
+
+        expected, _, _ = phase_cross_correlation(reference, moving, upsample_factor=10)
+        shift, error, phasediff = phase_cross_correlation_coarse_to_fine(reference, moving, binsize=4, window=128)
+        np.testing.assert_allclose(shift, expected, atol=0.25)
+        np.testing.assert_allclose(shift, np.negative(offset), atol=0.25)
+
+    with ImageRegistration(coarse_binsize=4, window=128, workers=2) as registration:
+        future = registration.submit(*pairs[0])
+        results = list(registration.map(pairs))
+    np.testing.assert_array_equal(future.result()[0], results[0][0])
+    np.testing.assert_allclose(results[1][0], (3.2, -150.9), atol=0.25)
+
+
+def test_calibrate_stage_from_file(tmp_path):
+    import yaml
+    from scipy import ndimage
+
+    from instamatic.calibrate.calibrate_stagematrix import calibrate_stage_from_file
+    from instamatic.calibrate.calibrate_stagematrix import stagematrix_to_pixelsize
+    from instamatic.formats import write_tiff
+
+    pixelsize = 20  # nm / pixel
+    binning = 2
+    args = [(4, (1000, 0)), (4, (0, 1500)), (3, (800, 800))]
+
+    rng = np.random.RandomState(3)
+    pad = 260
+    big = ndimage.gaussian_filter(rng.rand(256 + 2 * pad, 256 + 2 * pad), 1) * 1000
+
+    for i, (n_steps, (dx, dy)) in enumerate(args):
+        for j in range(n_steps):
+            offset = np.array((dx, dy)) * j / pixelsize
+            img = ndimage.shift(big, offset, order=3)[pad:pad + 256, pad:pad + 256] + rng.rand(256, 256) * 5
+            write_tiff(tmp_path / f'{i}_{j}.tiff', img.astype(np.float32))
+
+    log = {'args': args, 'binning': binning}
+    yaml.dump(log, open(tmp_path / 'log.yaml', 'w'))
+
+    for coarse_binsize in (None, 4):
+        stagematrix = calibrate_stage_from_file(tmp_path, coarse_binsize=coarse_binsize)
+        assert stagematrix.shape == (2, 2)
+        np.testing.assert_allclose(stagematrix_to_pixelsize(stagematrix), pixelsize / binning, rtol=0.02)
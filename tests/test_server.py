@@ -0,0 +1,294 @@
+import queue
+import socket
+import threading
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def tem_server():
+    from instamatic.server import tem_server
+
+    q = queue.Queue(maxsize=100)
+    server = tem_server.TemServer(q=q)
+    server.daemon = True
+    server.start()
+
+    return tem_server, q
+
+
+def test_framing():
+    from instamatic.server.protocol import recv_frame
+    from instamatic.server.protocol import send_frame
+
+    payload = np.arange(1_000_000, dtype=np.uint32).tobytes()
+
+    a, b = socket.socketpair()
+    with a, b:
+        t = threading.Thread(target=send_frame, args=(a, 42, payload))
+        t.start()
+        request_id, data = recv_frame(b)
+        t.join()
+
+        assert request_id == 42
+        assert data == payload
+
+        a.close()
+        assert recv_frame(b) is None
+
+
+def test_tem_server_pipelined(tem_server):
+    from instamatic.server.protocol import recv_frame
+    from instamatic.server.protocol import send_frame
+    from instamatic.server.serializer import dumper
+    from instamatic.server.serializer import loader
+
+    module, q = tem_server
+
+    client, conn = socket.socketpair()
+    t = threading.Thread(target=module.handle, args=(conn, q), daemon=True)
+    t.start()
+
+    with client:
+        calls = ('getBeamShift', 'getStagePosition', 'getNonExistingFunction')
+        for i, func_name in enumerate(calls):
+            send_frame(client, 100 + i, dumper({'func_name': func_name}))
+
+        replies = dict(recv_frame(client) for _ in calls)
+        assert sorted(replies) == [100, 101, 102]
+
+        status, data = loader(replies[100])
+        assert status == 200
+        assert len(data) == 2
+
+        status, data = loader(replies[101])
+        assert status == 200
+        assert len(data) == 5
+
+        status, data = loader(replies[102])
+        assert status == 500
+        assert data[0] == 'AttributeError'
+
+
+def test_tem_server_batch(tem_server):
+    from instamatic.server.protocol import recv_frame
+    from instamatic.server.protocol import send_frame
+    from instamatic.server.serializer import dumper
+    from instamatic.server.serializer import loader
+
+    module, q = tem_server
+
+    client, conn = socket.socketpair()
+    t = threading.Thread(target=module.handle, args=(conn, q), daemon=True)
+    t.start()
+
+    calls = [
+        ('setBeamShift', (1, 2), {}),
+        ('getBeamShift', (), {}),
+        ('getNonExistingFunction', (), {}),
+        ('getStagePosition', (), {}),
+    ]
+
+    with client:
+        send_frame(client, 1, dumper({'func_name': 'batch', 'args': (calls, )}))
+        request_id, response = recv_frame(client)
+
+    status, rets = loader(response)
+    assert status == 200
+    assert len(rets) == len(calls)
+    assert rets[1] == (200, (1, 2))
+    assert rets[2][0] == 500
+    assert rets[3][0] == 200
+
+
+def test_request_dispatcher():
+    import time
+    from concurrent.futures import Future
+    from instamatic.server.dispatcher import RequestDispatcher
+
+    dispatcher = RequestDispatcher(max_workers=4)
+    log = []
+
+    def read(i):
+        time.sleep(0.1)
+        log.append(('read', i))
+        return i
+
+    def write():
+        log.append(('write', None))
+        return 'done'
+
+    t0 = time.perf_counter()
+
+    replies = []
+    for i in range(4):
+        reply = Future()
+        dispatcher.dispatch(lambda i=i: read(i), reply=reply, read_only=True)
+        replies.append(reply)
+
+    reply = Future()
+    dispatcher.dispatch(write, reply=reply, read_only=False)
+    replies.append(reply)
+
+    results = [reply.result() for reply in replies]
+    t1 = time.perf_counter()
+
+    assert results == [0, 1, 2, 3, 'done']
+    assert log[-1] == ('write', None)  # write waits for reads in flight
+    assert t1 - t0 < 0.3  # reads ran concurrently
+
+
+def test_async_server(tem_server):
+    import asyncio
+    from instamatic.server import async_server
+    from instamatic.server.protocol import AsyncConnection
+    from instamatic.server.serializer import dumper
+    from instamatic.server.serializer import loader
+
+    module, q = tem_server
+
+    async def run():
+        server = await async_server.serve(q, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+
+        try:
+            conn = await AsyncConnection.open('127.0.0.1', port)
+
+            await conn.request(dumper({'func_name': 'setBeamShift', 'args': (3, 4)}))
+
+            calls = ['getBeamShift'] * 10 + ['getStagePosition']
+            replies = await asyncio.gather(*(conn.request(dumper({'func_name': func_name})) for func_name in calls))
+
+            await conn.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        return [loader(reply) for reply in replies]
+
+    loop = asyncio.new_event_loop()
+    try:
+        replies = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    assert replies[:10] == [(200, (3, 4))] * 10
+    status, data = replies[-1]
+    assert status == 200
+    assert len(data) == 5
+
+
+def test_frame_ring():
+    pytest.importorskip('multiprocessing.shared_memory')
+    import gc
+    from instamatic.server.frame_ring import FrameRing
+
+    shape = (16, 16)
+    server = FrameRing.create(shape, np.uint16, nslots=3)
+    client = FrameRing.attach(server.name, shape, np.uint16, nslots=3)
+
+    try:
+        frames = []
+        for i in range(3):
+            slot, seq = server.write(np.full(shape, i, dtype=np.uint16))
+            frames.append(client.view(slot, seq))
+
+        # all slots are leased, nothing is overwritten
+        assert server.write(np.zeros(shape, dtype=np.uint16)) is None
+        assert [int(frame[0, 0]) for frame in frames] == [0, 1, 2]
+
+        # releasing the first frame frees up its slot
+        del frames[0]
+        gc.collect()
+        assert server.free_slots() == 1
+
+        slot, seq = server.write(np.full(shape, 3, dtype=np.uint16))
+        assert slot == 0
+        frame = client.view(slot, seq)
+        assert frame[0, 0] == 3
+        assert [int(frame[0, 0]) for frame in frames] == [1, 2]
+
+        del frame, frames
+        gc.collect()
+        assert server.free_slots() == 3
+    finally:
+        client.shm.close()
+        server.close()
+
+
+def test_array_codec():
+    import pickle
+    from instamatic.server.protocol import recv_frame
+    from instamatic.server.protocol import send_frame
+    from instamatic.server.serializer import array_dumper
+    from instamatic.server.serializer import array_loader
+    from instamatic.server.serializer import json_dumper
+    from instamatic.server.serializer import json_loader
+
+    arr = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    data = (200, {'image': arr.T, 'frames': [arr, arr[::2]], 'header': {'exposure': 0.1}})
+
+    a, b = socket.socketpair()
+    with a, b:
+        send_frame(a, 1, array_dumper(data))
+        request_id, payload = recv_frame(b)
+
+    status, ret = array_loader(payload)
+    assert status == 200
+    assert ret['header'] == {'exposure': 0.1}
+    np.testing.assert_array_equal(ret['image'], arr.T)
+    np.testing.assert_array_equal(ret['frames'][1], arr[::2])
+    assert ret['image'].flags.writeable
+
+    # read-only input (asyncio), metadata with json
+    payload = b''.join(array_dumper(data, dumper=json_dumper))
+    status, ret = array_loader(payload, loader=json_loader)
+    np.testing.assert_array_equal(ret['frames'][0], arr)
+    assert ret['frames'][0].flags.writeable
+
+    # messages without arrays are passed through
+    assert array_dumper((200, 'ok')) == pickle.dumps((200, 'ok'))
+    assert array_loader(pickle.dumps((200, 'ok'))) == (200, 'ok')
+
+
+def test_frame_stream():
+    import time
+    from instamatic.server.frame_stream import FrameStream
+
+    def acquire():
+        return np.zeros((4, 4))
+
+    responses = []
+    stream = FrameStream(acquire, responses.append, n=5)
+    stream.start()
+    stream.join(timeout=5)
+
+    assert [data['index'] for status, data in responses] == [1, 2, 3, 4, 5, None]
+    assert responses[-1] == (200, {'index': None, 'acquired': 5, 'dropped': 0, 'error': None})
+
+    # slow client, frames are dropped instead of blocking acquisition
+    def slow_push(response):
+        time.sleep(0.01)
+        responses.append(response)
+
+    responses = []
+    stream = FrameStream(acquire, slow_push, n=50, maxsize=2)
+    stream.start()
+    stream.join(timeout=5)
+
+    status, stats = responses[-1]
+    assert stats['acquired'] == 50
+    assert stats['dropped'] > 0
+    assert len(responses) - 1 + stats['dropped'] == 50
+
+    # acquisition errors end the stream
+    def fail():
+        raise ValueError('no camera')
+
+    responses = []
+    stream = FrameStream(fail, responses.append)
+    stream.start()
+    stream.join(timeout=5)
+
+    assert responses == [(200, {'index': None, 'acquired': 0, 'dropped': 0, 'error': ('ValueError', ('no camera', ))})]